@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""Benchmarks for the bumper database layer.
+
+Fills temporary databases with synthetic users, bots, clients and tokens at
+each size, then times the public db functions and the confserver login flow.
+Results are written as JSON; two result files can be compared to spot
+regressions.
+
+    python benchmarks/bench_db.py run -o results.json
+    python benchmarks/bench_db.py run --sizes 10 100 --backend sqlite
+    python benchmarks/bench_db.py compare base.json results.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+import bumper
+
+default_sizes = [10, 100, 1000, 10000]
+default_iterations = 200
+full_scan_budget = 20000  # Records touched per full-table op, bounds *_get_all runs
+
+
+def percentile(latencies, pct):
+    ordered = sorted(latencies)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(latencies):
+    total = sum(latencies)
+    return {
+        "count": len(latencies),
+        "ops_per_sec": len(latencies) / total if total else None,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def dataset(size):
+    # size records per table, in the TinyDB file layout
+    users, tokens, bots, clients = {}, {}, {}, {}
+    expiration = time.time() + bumper.token_validity_seconds
+    for i in range(size):
+        doc_id = str(i + 1)
+        userid = "user_{}".format(i)
+        user = bumper.BumperUser()
+        user.userid = userid
+        user.devices = ["dev_{}".format(i)]
+        users[doc_id] = user.asdict()
+        tokens[doc_id] = {
+            "userid": userid,
+            "token": "token_{}".format(i),
+            "authcode": "auth_{}".format(i),
+            "expiration": expiration,
+        }
+        bots[doc_id] = bumper.VacBotDevice(
+            "did_{}".format(i), "ls1ok3", "res", "sn_{}".format(i), "", "eco-ng"
+        ).asdict()
+        clients[doc_id] = bumper.VacBotClient(
+            userid, "ecouser.net", "resource_{}".format(i)
+        ).asdict()
+
+    return {"users": users, "tokens": tokens, "bots": bots, "clients": clients}
+
+
+def populate(tmp, size):
+    # Written as a file rather than through the db functions, which would make
+    # building large TinyDB datasets quadratic
+    path = os.path.join(tmp, "bench.json")
+    with open(path, "w") as f:
+        json.dump(dataset(size), f)
+
+    if bumper.db_backend == "sqlite":
+        bumper.db = os.path.join(tmp, "bench.sqlite")
+        bumper.db_migrate_tinydb(path)
+    else:
+        bumper.db = path
+
+    bumper.db_get()  # Open and index the data
+
+
+def timed(func, args_for, iterations, setup=None):
+    latencies = []
+    for n in range(iterations):
+        args = args_for(n)
+        if setup:
+            setup(n)
+        start = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - start)
+
+    return latencies
+
+
+def expire_one(n):
+    # An already expired token for revoke_expired_tokens to remove
+    bumper.db_get().table("tokens").insert(
+        {"userid": "user_0", "token": "expired_{}".format(n), "expiration": 0}
+    )
+
+
+def db_cases(size):
+    pick = lambda n: random.randrange(size)
+    same = lambda i, *formats: [f.format(i) for f in formats]  # Matching record
+    return {
+        "user_get": (bumper.user_get, lambda n: ["user_{}".format(pick(n))], None),
+        "user_by_deviceid": (
+            bumper.user_by_deviceid,
+            lambda n: ["dev_{}".format(pick(n))],
+            None,
+        ),
+        "user_get_tokens": (
+            bumper.user_get_tokens,
+            lambda n: ["user_{}".format(pick(n))],
+            None,
+        ),
+        "check_token": (
+            bumper.check_token,
+            lambda n: same(pick(n), "fuid_user_{}", "token_{}"),
+            None,
+        ),
+        "check_authcode": (
+            bumper.check_authcode,
+            lambda n: same(pick(n), "user_{}", "auth_{}"),
+            None,
+        ),
+        "loginByItToken": (
+            bumper.loginByItToken,
+            lambda n: ["auth_{}".format(pick(n))],
+            None,
+        ),
+        "user_add_token": (
+            bumper.user_add_token,
+            lambda n: ["user_{}".format(pick(n)), "bench_token_{}".format(n)],
+            None,
+        ),
+        "user_add_bot": (
+            bumper.user_add_bot,
+            lambda n: ["user_{}".format(pick(n)), "did_{}".format(pick(n))],
+            None,
+        ),
+        "revoke_expired_tokens": (bumper.revoke_expired_tokens, lambda n: [], expire_one),
+        "bot_get": (bumper.bot_get, lambda n: ["did_{}".format(pick(n))], None),
+        "bot_get_all": (bumper.bot_get_all, lambda n: [], None),
+        "bot_add": (
+            bumper.bot_add,
+            lambda n: ["sn_new", "did_new_{}".format(n), "ls1ok3", "res", "eco-ng"],
+            None,
+        ),
+        "bot_set_nick": (
+            bumper.bot_set_nick,
+            lambda n: ["did_{}".format(pick(n)), "nick_{}".format(n)],
+            None,
+        ),
+        "client_get": (
+            bumper.client_get,
+            lambda n: ["resource_{}".format(pick(n))],
+            None,
+        ),
+        "client_get_all": (bumper.client_get_all, lambda n: [], None),
+        "client_add": (
+            bumper.client_add,
+            lambda n: ["user_0", "ecouser.net", "resource_new_{}".format(n)],
+            None,
+        ),
+        "client_set_mqtt": (
+            bumper.client_set_mqtt,
+            lambda n: ["resource_{}".format(pick(n)), n % 2 == 0],
+            None,
+        ),
+    }
+
+
+def bench_login(size, iterations):
+    # The whole confserver login: user lookup, all bots, token, device, bots
+    auth = bumper.ConfServer.ConfServer_AuthHandler()
+    request = SimpleNamespace(path="/v1/private/us/en/dev_0/ecoglobe/1/0/0/user/login", query={})
+
+    async def run():
+        latencies = []
+        for n in range(iterations):
+            devid = "dev_{}".format(random.randrange(size))
+            start = time.perf_counter()
+            await auth._auth_any(devid, "ecoglobe", "us", request)
+            latencies.append(time.perf_counter() - start)
+
+        return latencies
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+def run_size(size, iterations):
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="bumper-bench-") as tmp:
+        start = time.perf_counter()
+        populate(tmp, size)
+        results["load"] = summarize([time.perf_counter() - start])
+
+        for name, (func, args_for, setup) in db_cases(size).items():
+            count = iterations
+            if name.endswith("_get_all"):
+                count = max(5, min(iterations, full_scan_budget // size))
+            results[name] = summarize(timed(func, args_for, count, setup))
+
+        results["login"] = summarize(bench_login(size, max(5, min(iterations, 50))))
+        bumper.db_close()
+
+    return results
+
+
+def run(args):
+    random.seed(args.seed)
+    bumper.db_backend = args.backend
+    output = {
+        "meta": {
+            "backend": args.backend,
+            "iterations": args.iterations,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": datetime.utcnow().isoformat(),
+        },
+        "results": {},
+    }
+    for size in args.sizes:
+        print("Running size {}".format(size), file=sys.stderr)
+        output["results"][str(size)] = run_size(size, args.iterations)
+
+    text = json.dumps(output, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)["results"]
+    with open(args.new) as f:
+        new = json.load(f)["results"]
+
+    regressions = []
+    print("{:>6}  {:<24}{:>12}{:>12}{:>9}".format("size", "op", "base p50", "new p50", "change"))
+    for size in sorted(set(base) & set(new), key=int):
+        for op in sorted(set(base[size]) & set(new[size])):
+            old_p50 = base[size][op]["p50_ms"]
+            new_p50 = new[size][op]["p50_ms"]
+            change = (new_p50 - old_p50) / old_p50 if old_p50 else 0.0
+            flag = ""
+            if change > args.threshold:
+                flag = "  REGRESSION"
+                regressions.append((size, op))
+            print(
+                "{:>6}  {:<24}{:>10.3f}ms{:>10.3f}ms{:>+8.0%}{}".format(
+                    size, op, old_p50, new_p50, change, flag
+                )
+            )
+
+    if regressions:
+        print("{} regression(s) over {:.0%}".format(len(regressions), args.threshold))
+        return 1
+
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the bumper database")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    run_parser = commands.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument("--sizes", type=int, nargs="+", default=default_sizes,
+                            help="Records per table (default: 10 100 1000 10000)")
+    run_parser.add_argument("--iterations", type=int, default=default_iterations,
+                            help="Timed calls per function")
+    run_parser.add_argument("--backend", choices=["tinydb", "sqlite"], default="tinydb")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("-o", "--output", help="Write JSON results to file")
+
+    compare_parser = commands.add_parser("compare", help="Compare two result files")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+                                help="p50 slowdown reported as a regression (default: 0.1)")
+
+    args = parser.parse_args(argv)
+    logging.disable(logging.CRITICAL)  # Keep per-call logging out of the timings
+    if args.command == "run":
+        run(args)
+        return 0
+
+    return compare(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,15 +1,24 @@
 #!/usr/bin/env python3
 
 from bumper.confserver import ConfServer
-from bumper.mqttserver import MQTTServer, MQTTHelperBot
+from bumper.mqttserver import (
+    MQTTServer,
+    MQTTHelperBot,
+    MQTTHelperBotInProcess,
+    MQTTHelperBotPool,
+)
 from bumper.models import *
 from bumper.db import *
+from bumper.presence import PresenceRegistry
+from bumper.botcommands import BotCommands, CommandJobs
 import asyncio
+import json
 import os
 import logging
 from logging.handlers import RotatingFileHandler
 import socket
 import sys
+import time
 
 import importlib
 import pkgutil
@@ -52,10 +61,84 @@ bumper_debug = strtobool(os.environ.get("BUMPER_DEBUG")) or False
 use_auth = False
 token_validity_seconds = 3600  # 1 hour
 db = None
+db_backend = (os.environ.get("BUMPER_DB_BACKEND") or "tinydb").lower()  # tinydb or sqlite
+db_write_cache_size = 100  # Cached database writes before forcing a flush to disk
+db_import_batch_size = 1000  # NDJSON import records applied per batched write
+db_export_page_size = 1000  # NDJSON export records read from the db at a time
+db_compact_interval_seconds = int(
+    os.environ.get("BUMPER_DB_COMPACT_INTERVAL") or 86400
+)  # 0 disables scheduled compaction
+client_max_idle_seconds = 90 * 86400  # Clients not seen for this long are removed
+db_backup_dir = os.path.join(data_dir, "backups")
+db_backup_count = 5  # Backups kept, oldest are removed
+db_backup_compress = True  # gzip backups
+db_backup_interval_seconds = int(
+    os.environ.get("BUMPER_DB_BACKUP_INTERVAL") or 86400
+)  # 0 disables scheduled backups
+
+helperbot_pool_size = int(
+    os.environ.get("BUMPER_HELPERBOT_POOL") or 1
+)  # Helperbot MQTT connections bot commands are spread over
+helperbot_in_process = strtobool(
+    os.environ.get("BUMPER_HELPERBOT_IN_PROCESS")
+)  # Send bot commands straight into the broker instead of over MQTT
+
+bot_coalesce_commands = {  # Read-only commands concurrent duplicates of share one send
+    # XML bots
+    "GetBatteryInfo",
+    "GetChargeState",
+    "GetCleanState",
+    "GetLifeSpan",
+    "GetWKVer",
+    "GetCleanSum",
+    "GetError",
+    # JSON bots
+    "getBattery",
+    "getChargeState",
+    "getCleanInfo",
+    "getStats",
+    "getLifeSpan",
+    "getSpeed",
+    "getWaterInfo",
+    "getError",
+}
+
+bot_state_ttl_seconds = {  # How long cached bot state answers Get* commands
+    "BatteryInfo": 60,
+    "Battery": 60,
+    "ChargeState": 10,
+    "CleanState": 10,
+    "CleanInfo": 10,
+    "Stats": 10,
+    "LifeSpan": 300,
+    "WKVer": 3600,
+}
+bot_state_aliases = {"CleanReport": "CleanState"}  # Broadcast -> Get* state names
+bot_command_concurrency = 2  # Commands in flight per bot, more are queued
+bot_command_queue_depth = 20  # Queued commands per bot, more are rejected
+bot_command_queue_timeout_seconds = 10  # Longest wait in a bot's queue
+bot_command_lanes = {  # cmdName -> lane for bulk pulls, other commands are interactive
+    "GetCleanLogs": "background",
+    "GetMapM": "background",
+    "PullM": "background",
+    "PullMP": "background",
+    "getMapSet": "background",
+    "getMajorMap": "background",
+    "getMinorMap": "background",
+}
+bot_breaker_failures = 3  # Consecutive timeouts before commands to a bot fail fast
+bot_breaker_cooldown_seconds = 30  # Then a command is let through to probe it
+bot_fanout_concurrency = 10  # Bots a fleet-wide command is in flight to at once
+bot_job_ttl_seconds = 300  # How long results of finished command jobs are kept
+bot_job_max = 1000  # Command jobs kept, finished or not
+bot_job_wait_max_seconds = 30  # Longest long-poll for a command job
 
 mqtt_server = None
 mqtt_helperbot = None
+bot_commands = BotCommands()  # Bot commands from the confserver go through this
+bot_jobs = CommandJobs()  # Bot commands submitted as jobs, polled for results
 conf_server = None
+presence_registry = PresenceRegistry()  # Live MQTT sessions of bots and clients
 conf_server_2 = None
 
 # Plugins
@@ -69,6 +152,8 @@ discovered_plugins = {
 }
 
 shutting_down = False
+last_db_backup = time.time()
+last_db_compact = time.time()
 
 # Set format for all logs
 logformat = logging.Formatter(
@@ -181,7 +266,12 @@ async def start():
     global mqtt_server
     mqtt_server = MQTTServer((bumper_listen, mqtt_listen_port))
     global mqtt_helperbot
-    mqtt_helperbot = MQTTHelperBot((bumper_listen, mqtt_listen_port))
+    if helperbot_in_process:
+        mqtt_helperbot = MQTTHelperBotInProcess(mqtt_server.broker)
+    else:
+        mqtt_helperbot = MQTTHelperBotPool(
+            (bumper_listen, mqtt_listen_port), helperbot_pool_size
+        )
     global conf_server
     conf_server = ConfServer((bumper_listen, conf1_listen_port), usessl=True)
     global conf_server_2
@@ -194,10 +284,7 @@ async def start():
     asyncio.create_task(mqtt_helperbot.start_helper_bot())
 
     # Wait for helperbot to connect first
-    while mqtt_helperbot.Client is None:
-        await asyncio.sleep(0.1)
-
-    while not mqtt_helperbot.Client.session.transitions.state == "connected":
+    while not mqtt_helperbot.is_connected():
         await asyncio.sleep(0.1)
 
     # Start web servers
@@ -212,7 +299,24 @@ async def start():
 
 
 async def maintenance():
-    revoke_expired_tokens()
+    global last_db_backup
+    global last_db_compact
+
+    await async_revoke_expired_tokens()
+    await presence_registry.snapshot()  # Write connection changes to the db
+    if (
+        db_backup_interval_seconds
+        and time.time() - last_db_backup >= db_backup_interval_seconds
+    ):
+        last_db_backup = time.time()
+        await async_db_backup()
+    if (
+        db_compact_interval_seconds
+        and time.time() - last_db_compact >= db_compact_interval_seconds
+    ):
+        last_db_compact = time.time()
+        await async_db_compact()
+    await async_db_flush()  # Write cached database changes to disk
 
 
 async def shutdown():
@@ -228,7 +332,7 @@ async def shutdown():
                 await asyncio.sleep(0.1)
             if mqtt_server.broker.transitions.state == "started":
                 await mqtt_server.broker.shutdown()
-                await mqtt_helperbot.Client.disconnect()
+                await mqtt_helperbot.disconnect()
         global shutting_down
         shutting_down = True
 
@@ -239,6 +343,9 @@ async def shutdown():
         bumperlog.info("Exception: {}".format(e))
 
     finally:
+        presence_registry.clear()  # Nothing is connected once stopped
+        await presence_registry.snapshot()
+        await async_db_flush()  # Ensure cached database changes are on disk
         bumperlog.info("Shutdown complete")
 
 
@@ -327,9 +434,50 @@ def main(argv=None):
             help="announce address to bots on checkin",
         )
         parser.add_argument("--debug", action="store_true", help="enable debug logs")
+        parser.add_argument(
+            "--restore",
+            type=str,
+            default=None,
+            metavar="BACKUP",
+            help="replace the database with a backup file and exit",
+        )
+        commands = parser.add_subparsers(dest="command")
+        export_parser = commands.add_parser(
+            "export", help="write users, bots and clients as NDJSON and exit"
+        )
+        export_parser.add_argument(
+            "file", nargs="?", default="-", help="output file (default: stdout)"
+        )
+        import_parser = commands.add_parser(
+            "import", help="add or update users, bots and clients from NDJSON and exit"
+        )
+        import_parser.add_argument("file", help="input file, - for stdin")
 
         args = parser.parse_args(args=argv)
 
+        if args.restore:
+            db_restore(args.restore)
+            db_close()
+            return
+
+        if args.command == "export":
+            if args.file == "-":
+                sys.stdout.writelines(db_export())
+            else:
+                with open(args.file, "w") as f:
+                    f.writelines(db_export())
+            return
+
+        if args.command == "import":
+            if args.file == "-":
+                summary = db_import(sys.stdin)
+            else:
+                with open(args.file) as f:
+                    summary = db_import(f)
+            db_close()
+            print(json.dumps(summary))
+            return
+
         if args.debug:
             bumper_debug = True
 
@@ -0,0 +1,625 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict, deque
+import xml.etree.ElementTree as ET
+import bumper
+from bumper.metrics import Histogram
+
+helperbotlog = logging.getLogger("helperbot")
+
+LANES = ("interactive", "background")  # In dispatch order
+
+
+def _field(name):
+    # State a Get*/get* command reads or an atr broadcast reports
+    for prefix in ("Get", "get", "on"):
+        if name.startswith(prefix) and name[len(prefix):len(prefix) + 1].isupper():
+            name = name[len(prefix):]
+            break
+    return bumper.bot_state_aliases.get(name, name)
+
+
+def _params(cmdjson):
+    # Normalized command arguments, None if they can't be compared
+    payload = cmdjson.get("payload")
+    try:
+        if cmdjson.get("payloadType") == "x":
+            if not payload:
+                return ""
+            ctl = ET.fromstring(payload)
+            attrib = {k: v for k, v in ctl.attrib.items() if k not in ("td", "id")}
+            if len(ctl):
+                return None
+            return json.dumps(attrib, sort_keys=True) if attrib else ""
+
+        data = (payload or {}).get("body", {}).get("data")
+        return json.dumps(data, sort_keys=True) if data else ""
+
+    except Exception:
+        return None
+
+
+class BotStateCache:
+    """Last known state of each bot, per field (BatteryInfo, ChargeState, ...).
+
+    Fed by iot/atr broadcasts and by responses to Get* commands, so matching
+    Get* commands can be answered without asking the bot while an entry is
+    younger than its bot_state_ttl_seconds.
+    """
+
+    def __init__(self):
+        self._bots = {}  # did -> {(field, params): (time, resp)}
+
+    def get(self, did, field, params=""):
+        entry = self._bots.get(did, {}).get((field, params))
+        ttl = bumper.bot_state_ttl_seconds.get(field)
+        if entry is None or ttl is None or time.time() - entry[0] > ttl:
+            return None
+        return entry[1]
+
+    def set(self, did, field, params, resp):
+        if field in bumper.bot_state_ttl_seconds:
+            self._bots.setdefault(did, {})[(field, params)] = (time.time(), resp)
+
+    def forget(self, did):
+        self._bots.pop(did, None)
+
+    def clear(self):
+        self._bots.clear()
+
+    def answer(self, cmdjson, requestid):
+        # Response to a Get* command from fresh cached state, or None
+        params = _params(cmdjson)
+        if params is None:
+            return None
+
+        resp = self.get(cmdjson.get("toId"), _field(cmdjson.get("cmdName", "")), params)
+        if resp is None:
+            return None
+        return {"id": requestid, "ret": "ok", "resp": resp}
+
+    def response(self, cmdjson, resp):
+        # Remember a bot's successful reply to a command
+        params = _params(cmdjson)
+        try:
+            if isinstance(resp, dict):
+                ok = resp.get("body", {}).get("code") == 0
+            else:
+                ok = ET.fromstring(resp).get("ret") == "ok"
+        except Exception:
+            ok = False
+
+        if ok and params is not None:
+            self.set(cmdjson.get("toId"), _field(cmdjson["cmdName"]), params, resp)
+
+    def broadcast(self, topic, payload):
+        # iot/atr/{td}/{did}/{class}/{resource}/{x|j}
+        topic = str(topic).split("/")
+        field = _field(topic[2])
+        if field not in bumper.bot_state_ttl_seconds:
+            return
+
+        try:
+            if topic[6] == "j":
+                resp = json.loads(payload)
+                body = resp.setdefault("body", {})
+                body.setdefault("code", 0)
+                body.setdefault("msg", "ok")
+            else:  # Same shape as a response, without the broadcast's td
+                ctl = ET.fromstring(payload)
+                ctl.attrib.pop("td", None)
+                ctl.attrib.pop("ts", None)
+                ctl.set("ret", "ok")
+                resp = ET.tostring(ctl, encoding="unicode")
+
+        except Exception as e:
+            helperbotlog.debug("Unreadable Broadcast - Topic: {} - {}".format(topic, e))
+            return
+
+        self.set(topic[3], field, "", resp)
+
+
+class CircuitBreaker:
+    """Stops sending commands to a bot that stopped answering.
+
+    Opens after bot_breaker_failures consecutive timeouts, or when the bot
+    disconnects from the broker; commands then fail straight away. After
+    bot_breaker_cooldown_seconds it's half open: one command is let through
+    as a probe and its outcome closes or reopens the breaker. The bot
+    connecting again closes it.
+    """
+
+    def __init__(self):
+        self.state = "closed"
+        self.failures = 0  # Consecutive timeouts
+        self.opened = 0.0
+        self.probing = False
+
+    def allow(self):
+        if self.state == "open":
+            if time.time() - self.opened < bumper.bot_breaker_cooldown_seconds:
+                return False
+            self.state = "half_open"
+
+        if self.state == "half_open":
+            if self.probing:
+                return False
+            self.probing = True
+
+        return True
+
+    def success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == "half_open" or self.failures >= bumper.bot_breaker_failures:
+            self.open()
+
+    def open(self):
+        self.state = "open"
+        self.opened = time.time()
+        self.probing = False
+
+
+def _timed_out(resp):
+    return isinstance(resp, dict) and resp.get("ret") == "fail" and resp.get("errno") == 500
+
+
+def select_bots(bots, selector):
+    # Bots matching {"all": true}, {"class": "ls1ok3"} or {"dids": [...]}
+    bots = [bot for bot in bots if "did" in bot and "class" in bot]
+    if selector.get("dids") is not None:
+        dids = set(selector["dids"])
+        return [bot for bot in bots if bot["did"] in dids]
+    if selector.get("class"):
+        return [bot for bot in bots if bot["class"] == selector["class"]]
+    if selector.get("all"):
+        return bots
+    return []
+
+
+class BotCommands:
+    """Front door for commands sent to bots by the confserver.
+
+    Get* commands are answered from the bot state cache when it's fresh.
+    Identical read-only commands to the same bot that are already in flight
+    are coalesced: later callers wait for the first one's response instead of
+    sending their own. At most bot_command_concurrency commands are in flight
+    per bot, others queue up to bot_command_queue_depth and are rejected
+    beyond that. Queued interactive commands go before background ones, which
+    never take a bot's last slot. Commands to bots whose circuit breaker is
+    open fail fast. fan_out() sends one command to many bots at once, at most
+    bot_fanout_concurrency in flight.
+    """
+
+    def __init__(self):
+        self._inflight = {}  # coalesce key -> Future of the first command
+        self._queues = {}  # did -> in flight/queued commands and counters
+        self._breakers = {}  # did -> CircuitBreaker
+        self.lanes = {  # Latency incl. queueing, and time queued, per lane
+            lane: {"latency": Histogram(), "queue_wait": Histogram()} for lane in LANES
+        }
+        self.state = BotStateCache()
+        self.stats = {
+            "sent": 0,
+            "coalesced": 0,
+            "cached": 0,
+            "rejected": 0,
+            "failed_fast": 0,
+        }
+
+    def coalesce_key(self, cmdjson):
+        # None for commands that have to be sent every time
+        if cmdjson.get("cmdName") not in bumper.bot_coalesce_commands:
+            return None
+
+        payload = cmdjson.get("payload")
+        if isinstance(payload, dict):  # The header only carries a timestamp
+            payload = {k: v for k, v in payload.items() if k != "header"}
+        return (
+            cmdjson.get("toId"),
+            cmdjson["cmdName"],
+            json.dumps(payload, sort_keys=True),
+        )
+
+    async def send(self, cmdjson, requestid):
+        resp = self._from_cache(cmdjson, requestid)
+        if resp is None:
+            resp = await self._send(cmdjson, requestid)
+            self._remember(cmdjson, resp)
+        return resp
+
+    async def send_batch(self, cmdjsons):
+        # Several commands to one bot, sent together; responses in order
+        requestids = [bumper.mqtt_helperbot.new_request_id() for _ in cmdjsons]
+        resps = [self._from_cache(c, r) for c, r in zip(cmdjsons, requestids)]
+        unanswered = [i for i, resp in enumerate(resps) if resp is None]
+        if unanswered:
+            cmds = [cmdjsons[i] for i in unanswered]
+            ids = [requestids[i] for i in unanswered]
+            sent = await self._dispatch(
+                cmds, ids, lambda: bumper.mqtt_helperbot.send_commands(cmds, ids)
+            )
+            for i, cmdjson, resp in zip(unanswered, cmds, sent):
+                self._remember(cmdjson, resp)
+                resps[i] = resp
+
+        return resps
+
+    async def fan_out(self, cmdjson, selector):
+        # Send cmdjson to every selected bot, yielding {"did", "class", "resp"} as they answer
+        selected = select_bots(await bumper.async_bot_get_all(), selector)
+        limit = asyncio.Semaphore(bumper.bot_fanout_concurrency)
+
+        async def send(bot):
+            if not (
+                bot.get("company") == "eco-ng"
+                and bumper.presence_registry.is_online(bot["did"])
+            ):
+                resp = {"ret": "fail", "errno": 503, "debug": "bot not connected"}
+            else:
+                async with limit:
+                    resp = await self.send(
+                        dict(
+                            cmdjson,
+                            toId=bot["did"],
+                            toType=bot["class"],
+                            toRes=bot.get("resource"),
+                        ),
+                        bumper.mqtt_helperbot.new_request_id(),
+                    )
+            return {"did": bot["did"], "class": bot["class"], "resp": resp}
+
+        helperbotlog.info(
+            "Fan-out Command - Command: {} - Bots: {}".format(
+                cmdjson.get("cmdName"), len(selected)
+            )
+        )
+        tasks = [asyncio.ensure_future(send(bot)) for bot in selected]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:  # Caller went away, don't leave commands queued
+            for task in tasks:
+                task.cancel()
+
+    def _from_cache(self, cmdjson, requestid):
+        # Cached response to a Get* command, None if it has to be sent
+        cmdname = cmdjson.get("cmdName", "")
+        if cmdname[:3].lower() != "get":  # May change the bot's state
+            self.state.forget(cmdjson.get("toId"))
+            return None
+
+        if _field(cmdname) not in bumper.bot_state_ttl_seconds:
+            return None
+
+        resp = self.state.answer(cmdjson, requestid)
+        if resp is not None:
+            self.stats["cached"] += 1
+            helperbotlog.debug(
+                "Answered From Cache - Did: {} - Command: {}".format(
+                    cmdjson.get("toId"), cmdname
+                )
+            )
+        return resp
+
+    def _remember(self, cmdjson, resp):
+        query = cmdjson.get("cmdName", "")[:3].lower() == "get"
+        if query and isinstance(resp, dict) and resp.get("ret") == "ok":
+            self.state.response(cmdjson, resp.get("resp"))
+
+    async def _send(self, cmdjson, requestid):
+        key = self.coalesce_key(cmdjson)
+        if key is None:
+            return await self._dispatch_one(cmdjson, requestid)
+
+        inflight = self._inflight.get(key)
+        if inflight is None:
+            inflight = asyncio.ensure_future(self._dispatch_one(cmdjson, requestid))
+            self._inflight[key] = inflight
+            inflight.add_done_callback(lambda f: self._inflight.pop(key, None))
+            return await asyncio.shield(inflight)
+
+        self.stats["coalesced"] += 1
+        helperbotlog.debug(
+            "Coalesced Command - Did: {} - Command: {}".format(key[0], key[1])
+        )
+        resp = await asyncio.shield(inflight)  # Others may still wait for it
+        if isinstance(resp, dict) and "id" in resp:
+            resp = dict(resp, id=requestid)
+        return resp
+
+    def breaker(self, did):
+        breaker = self._breakers.get(did)
+        if breaker is None:
+            breaker = self._breakers[did] = CircuitBreaker()
+        return breaker
+
+    def breaker_state(self, did):
+        breaker = self._breakers.get(did)
+        return breaker.state if breaker is not None else "closed"
+
+    def bot_connected(self, did):
+        if did in self._breakers:  # Reachable again, don't hold commands behind a probe
+            self._breakers[did].success()
+
+    def bot_disconnected(self, did):
+        self.breaker(did).open()
+
+    async def _dispatch_one(self, cmdjson, requestid):
+        async def send():
+            return [await bumper.mqtt_helperbot.send_command(cmdjson, requestid)]
+
+        return (await self._dispatch([cmdjson], [requestid], send))[0]
+
+    async def _dispatch(self, cmdjsons, requestids, send):
+        # Run send() for commands to one bot, through its circuit breaker and queue
+        did = cmdjsons[0].get("toId")
+        breaker = self.breaker(did)
+        if not breaker.allow():
+            self.stats["failed_fast"] += len(cmdjsons)
+            return [
+                {
+                    "id": requestid,
+                    "errno": 503,
+                    "ret": "fail",
+                    "debug": "bot unreachable, circuit open",
+                }
+                for requestid in requestids
+            ]
+
+        probe = breaker.state == "half_open"  # allow() let this one through as the probe
+        resps = None
+        try:
+            resps = await self._dispatch_queued(cmdjsons, requestids, send)
+        finally:
+            if resps is None and probe:
+                breaker.probing = False  # Cancelled, the next command probes instead
+
+        if all(_timed_out(resp) for resp in resps):
+            breaker.failure()
+            if breaker.state == "open":
+                helperbotlog.warning(
+                    "Circuit Open - Did: {} - {} consecutive timeouts".format(
+                        did, breaker.failures
+                    )
+                )
+        elif any(isinstance(resp, dict) and resp.get("ret") == "ok" for resp in resps):
+            breaker.success()
+        else:
+            breaker.probing = False  # Rejected, the next command probes instead
+        return resps
+
+    def lane(self, cmdjson):
+        # background for the bulk pulls in bot_command_lanes, interactive otherwise
+        return bumper.bot_command_lanes.get(cmdjson.get("cmdName", ""), "interactive")
+
+    def _lane_limit(self, lane):
+        # Background commands leave a slot free for interactive ones
+        limit = bumper.bot_command_concurrency
+        if lane == "background" and limit > 1:
+            limit -= 1
+        return limit
+
+    async def _dispatch_queued(self, cmdjsons, requestids, send):
+        # Send through the bot's queue, a batch takes one slot
+        did = cmdjsons[0].get("toId")
+        queue = self._queues.get(did)
+        if queue is None:
+            queue = self._queues[did] = {
+                "inflight": 0,
+                "waiting": {lane: deque() for lane in LANES},
+                "sent": 0,
+                "rejected": 0,
+                "max_queued": 0,
+            }
+
+        lanes = set(self.lane(cmdjson) for cmdjson in cmdjsons)
+        lane = "interactive" if "interactive" in lanes else "background"
+        start = time.perf_counter()
+        reason = await self._acquire(queue, lane)
+        if reason is not None:
+            queue["rejected"] += len(cmdjsons)
+            self.stats["rejected"] += len(cmdjsons)
+            helperbotlog.warning(
+                "Rejected Command - Did: {} - Command: {} - {}".format(
+                    did, ", ".join(c.get("cmdName", "") for c in cmdjsons), reason
+                )
+            )
+            return [
+                {"id": requestid, "errno": 503, "ret": "fail", "debug": reason}
+                for requestid in requestids
+            ]
+
+        self.lanes[lane]["queue_wait"].observe(time.perf_counter() - start)
+        try:
+            queue["sent"] += len(cmdjsons)
+            self.stats["sent"] += len(cmdjsons)
+            return await send()
+        finally:
+            self._release(queue)
+            self.lanes[lane]["latency"].observe(time.perf_counter() - start)
+
+    async def _acquire(self, queue, lane):
+        # Take an in flight slot, None when taken or why the command can't be sent
+        ahead = LANES[: LANES.index(lane) + 1]  # Lanes queued commands go first from
+        if queue["inflight"] < self._lane_limit(lane) and not any(
+            queue["waiting"][other] for other in ahead
+        ):
+            queue["inflight"] += 1
+            return None
+
+        queued = sum(len(waiting) for waiting in queue["waiting"].values())
+        if queued >= bumper.bot_command_queue_depth:
+            return "bot busy, command queue full"
+
+        waiter = asyncio.get_event_loop().create_future()
+        queue["waiting"][lane].append(waiter)
+        queue["max_queued"] = max(queue["max_queued"], queued + 1)
+        try:
+            await asyncio.wait_for(waiter, bumper.bot_command_queue_timeout_seconds)
+            return None  # The slot was handed over by _release
+
+        except asyncio.TimeoutError:
+            return "bot busy, timed out waiting in command queue"
+
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release(queue)  # Handed a slot just as the caller left
+            raise
+
+        finally:
+            if not waiter.done() or waiter.cancelled():
+                try:
+                    queue["waiting"][lane].remove(waiter)
+                except ValueError:
+                    pass
+
+    def _release(self, queue):
+        # Hand the slot to the next queued command, interactive ones first
+        for lane in LANES:
+            waiting = queue["waiting"][lane]
+            if lane == "background" and queue["inflight"] - 1 >= self._lane_limit(lane):
+                break
+
+            while waiting:
+                waiter = waiting.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    return
+
+        queue["inflight"] -= 1
+
+    def status(self):
+        queues = {
+            did: {
+                "inflight": queue["inflight"],
+                "queued": sum(len(waiting) for waiting in queue["waiting"].values()),
+                "max_queued": queue["max_queued"],
+                "sent": queue["sent"],
+                "rejected": queue["rejected"],
+            }
+            for did, queue in self._queues.items()
+        }
+        breakers = {
+            did: {"state": breaker.state, "failures": breaker.failures}
+            for did, breaker in self._breakers.items()
+        }
+        lanes = {
+            lane: {
+                "latency": metrics["latency"].asdict(),
+                "queue_wait": metrics["queue_wait"].asdict(),
+            }
+            for lane, metrics in self.lanes.items()
+        }
+        return dict(
+            self.stats,
+            inflight=len(self._inflight),
+            queues=queues,
+            breakers=breakers,
+            lanes=lanes,
+        )
+
+
+class CommandJobs:
+    """Bot commands run in the background, for callers that poll for results.
+
+    submit() returns the helperbot request id as the job id straight away;
+    the command goes through bot_commands. A job ends "done" when the bot
+    answered ok, "failed" otherwise. Finished jobs are kept for
+    bot_job_ttl_seconds, at most bot_job_max jobs are kept in all.
+    """
+
+    def __init__(self):
+        self._jobs = OrderedDict()  # requestid -> job, oldest first
+        self.stats = {"submitted": 0, "rejected": 0, "expired": 0}
+
+    def submit(self, cmdjson):
+        # Job id, None if the store is full of unfinished jobs
+        self.prune()
+        if len(self._jobs) >= bumper.bot_job_max:
+            self.stats["rejected"] += 1
+            return None
+
+        requestid = bumper.mqtt_helperbot.new_request_id()
+        job = {
+            "id": requestid,
+            "did": cmdjson.get("toId"),
+            "cmdName": cmdjson.get("cmdName"),
+            "status": "pending",
+            "submitted": time.time(),
+            "finished": None,
+            "resp": None,
+        }
+        job["future"] = asyncio.ensure_future(
+            bumper.bot_commands.send(cmdjson, requestid)
+        )
+        job["future"].add_done_callback(lambda f: self._finished(job, f))
+        self._jobs[requestid] = job
+        self.stats["submitted"] += 1
+        return requestid
+
+    def _finished(self, job, future):
+        job["finished"] = time.time()
+        if future.cancelled():
+            job["status"] = "cancelled"
+        elif future.exception() is not None:
+            job["status"] = "failed"
+            job["resp"] = {
+                "id": job["id"],
+                "errno": 500,
+                "ret": "fail",
+                "debug": str(future.exception()),
+            }
+        elif not future.result():  # Never answered, e.g. the helperbot is down
+            job["status"] = "failed"
+            job["resp"] = {
+                "id": job["id"],
+                "errno": 503,
+                "ret": "fail",
+                "debug": "no response from helperbot",
+            }
+        else:  # Failed when the bot or helperbot answered with an error
+            job["resp"] = future.result()
+            job["status"] = "done" if job["resp"].get("ret") == "ok" else "failed"
+
+    def prune(self):
+        # Drop expired jobs, then the oldest finished ones while over bot_job_max
+        expired = time.time() - bumper.bot_job_ttl_seconds
+        finished = [
+            requestid for requestid, job in self._jobs.items() if job["finished"] is not None
+        ]
+        for requestid in finished:
+            if self._jobs[requestid]["finished"] < expired or len(self._jobs) >= bumper.bot_job_max:
+                del self._jobs[requestid]
+                self.stats["expired"] += 1
+
+    def get(self, jobid):
+        job = self._jobs.get(jobid)
+        if job is None:
+            return None
+        if job["finished"] is not None and (
+            time.time() - job["finished"] > bumper.bot_job_ttl_seconds
+        ):
+            del self._jobs[jobid]
+            self.stats["expired"] += 1
+            return None
+        return {key: value for key, value in job.items() if key != "future"}
+
+    async def wait(self, jobid, timeout):
+        # Long-poll: the job once it finished or timeout passed, None if unknown
+        job = self._jobs.get(jobid)
+        if job is not None and timeout > 0 and not job["future"].done():
+            await asyncio.wait([job["future"]], timeout=timeout)
+        return self.get(jobid)
+
+    def status(self):
+        pending = sum(1 for job in self._jobs.values() if job["finished"] is None)
+        return dict(self.stats, pending=pending, kept=len(self._jobs))
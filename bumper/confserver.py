@@ -49,7 +49,19 @@ class ConfServer:
         self.site = None
         self.runner = None
         self.runners = []
-        self.excludelogging = ["base", "remove-bot", "remove-client", "restart-service"]
+        self.excludelogging = [
+            "base",
+            "remove-bot",
+            "remove-client",
+            "restart-service",
+            "backup",
+            "db-export",
+            "db-load",
+            "db-stats",
+            "bots-stats",
+            "bots-command",
+            "job-get",
+        ]
 
     def get_milli_time(self, timetoconvert):
         return int(round(timetoconvert * 1000))
@@ -67,6 +79,14 @@ class ConfServer:
                 web.get("/bot/remove/{did}", self.handle_RemoveBot, name='remove-bot'),       
                 web.get("/client/remove/{resource}", self.handle_RemoveClient, name='remove-client'),      
                 web.get("/restart_{service}", self.handle_RestartService, name='restart-service'),                
+                web.get("/backup", self.handle_Backup, name='backup'),
+                web.get("/db/export", self.handle_DBExport, name='db-export'),
+                web.get("/db/stats", self.handle_DBStats, name='db-stats'),
+                web.post("/db/import", self.handle_DBImport, name='db-load'),
+                web.get("/bots/stats", self.handle_BotsStats, name='bots-stats'),
+                web.post("/bots/command", self.handle_BotsCommand, name='bots-command'),
+                web.post("/jobs", self.handle_JobSubmit, name='job-submit'),
+                web.get("/jobs/{jobid}", self.handle_JobGet, name='job-get'),
                 web.post("/lookup.do", self.handle_lookup),
         
             ]
@@ -176,9 +196,16 @@ class ConfServer:
     async def handle_base(self, request):
         try:
 
-            bots = bumper.db_get().table("bots").all()
-            clients = bumper.db_get().table("clients").all()
-            helperbot = bumper.mqtt_helperbot.Client.session.transitions.state
+            bots = await bumper.async_bot_get_all()
+            clients = await bumper.async_client_get_all()
+            for bot in bots:  # Show live connection state
+                bot["mqtt_connection"] = bumper.presence_registry.is_online(bot["did"])
+                bot["commands"] = bumper.bot_commands.breaker_state(bot["did"])
+            for client in clients:
+                client["mqtt_connection"] = bumper.presence_registry.is_online(
+                    client["resource"]
+                )
+            helperbot = bumper.mqtt_helperbot.status()
             mqttserver = bumper.mqtt_server.broker
             mq_sessions = []
             for sess in mqttserver._sessions:
@@ -193,7 +220,7 @@ class ConfServer:
             all = {
                 "bots": bots,
                 "clients": clients,
-                "helperbot": [{"state": helperbot}],
+                "helperbot": helperbot,
                 "mqtt_server": [
                     {"state": mqttserver.transitions.state},
                     {
@@ -309,7 +336,7 @@ class ConfServer:
 
     async def restart_Helper(self):
 
-        await bumper.mqtt_helperbot.Client.disconnect()
+        await bumper.mqtt_helperbot.disconnect()
         asyncio.create_task(bumper.mqtt_helperbot.start_helper_bot())
 
     async def restart_MQTT(self):
@@ -354,11 +381,148 @@ class ConfServer:
             confserverlog.exception("{}".format(e))
             pass
 
+    async def handle_Backup(self, request):
+        try:
+            path = await bumper.async_db_backup()
+            return web.json_response({"status": "complete", "backup": path})
+
+        except Exception as e:
+            confserverlog.exception("{}".format(e))
+            return web.json_response({"status": "failed to back up database"})
+
+    async def handle_DBExport(self, request):
+        try:
+            response = web.StreamResponse(
+                headers={"Content-Type": "application/x-ndjson"}
+            )
+            await response.prepare(request)
+            async for line in bumper.async_db_export():
+                await response.write(line.encode("utf-8"))
+
+            await response.write_eof()
+            return response
+
+        except Exception as e:
+            confserverlog.exception("{}".format(e))
+
+    async def handle_DBStats(self, request):
+        try:
+            stats = await bumper.async_db_stats()
+            if "reset" in request.query:
+                await bumper.async_db_call(bumper.db_stats_reset)
+            return web.json_response(stats)
+
+        except Exception as e:
+            confserverlog.exception("{}".format(e))
+
+    async def handle_BotsStats(self, request):
+        try:
+            stats = dict(
+                bumper.bot_commands.status(),
+                latency=bumper.MQTTHelperBot.latency.asdict(),
+                jobs=bumper.bot_jobs.status(),
+            )
+            if "reset" in request.query:
+                bumper.MQTTHelperBot.latency.reset()
+            return web.json_response(stats)
+
+        except Exception as e:
+            confserverlog.exception("{}".format(e))
+
+    async def handle_BotsCommand(self, request):
+        # {"all": true} / {"class": ...} / {"dids": [...]} plus cmdName, payload, payloadType, td
+        try:
+            json_body = json.loads(await request.text())
+            selector = {
+                key: json_body.pop(key)
+                for key in ("all", "class", "dids")
+                if key in json_body
+            }
+            response = web.StreamResponse(
+                headers={"Content-Type": "application/x-ndjson"}
+            )
+            await response.prepare(request)
+            summary = {"bots": 0, "ok": 0, "failed": 0}
+            async for result in bumper.bot_commands.fan_out(json_body, selector):
+                summary["bots"] += 1
+                if result["resp"].get("ret") == "ok":
+                    summary["ok"] += 1
+                else:
+                    summary["failed"] += 1
+                await response.write((json.dumps(result) + "\n").encode("utf-8"))
+
+            await response.write((json.dumps({"summary": summary}) + "\n").encode("utf-8"))
+            await response.write_eof()
+            return response
+
+        except Exception as e:
+            confserverlog.exception("{}".format(e))
+
+    async def handle_JobSubmit(self, request):
+        # A devmanager command body, answered with a job id to poll at /jobs/{jobid}
+        try:
+            json_body = json.loads(await request.text())
+            did = json_body.get("toId", "")
+            bot = await bumper.async_bot_get(did) if did != "" else None
+            if not (bot and bot["company"] == "eco-ng"):
+                return web.json_response(
+                    {"ret": "fail", "errno": bumper.ERR_COMMON, "debug": "unknown bot"}
+                )
+
+            json_body.setdefault("toType", bot["class"])
+            json_body.setdefault("toRes", bot["resource"])
+            jobid = bumper.bot_jobs.submit(json_body)
+            if jobid is None:
+                return web.json_response(
+                    {"ret": "fail", "errno": 503, "debug": "too many pending jobs"}
+                )
+
+            return web.json_response({"ret": "ok", "id": jobid, "status": "pending"})
+
+        except Exception as e:
+            confserverlog.exception("{}".format(e))
+
+    async def handle_JobGet(self, request):
+        # ?wait=seconds long-polls until the job finished
+        try:
+            jobid = request.match_info.get("jobid", "")
+            try:
+                wait = float(request.query.get("wait", 0))
+            except ValueError:
+                wait = None
+            if wait is None or not 0 <= wait < float("inf"):  # Also rejects nan
+                return web.json_response(
+                    {"ret": "fail", "errno": bumper.ERR_COMMON, "debug": "invalid wait"},
+                    status=400,
+                )
+
+            wait = min(wait, bumper.bot_job_wait_max_seconds)
+            job = await bumper.bot_jobs.wait(jobid, wait)
+            if job is None:
+                return web.json_response(
+                    {"ret": "fail", "errno": bumper.ERR_COMMON, "debug": "unknown job"},
+                    status=404,
+                )
+
+            return web.json_response(dict(job, ret="ok"))
+
+        except Exception as e:
+            confserverlog.exception("{}".format(e))
+
+    async def handle_DBImport(self, request):
+        try:
+            summary = await bumper.async_db_import(request.content)
+            return web.json_response(dict(summary, status="complete"))
+
+        except Exception as e:
+            confserverlog.exception("{}".format(e))
+            return web.json_response({"status": "failed to import records"})
+
     async def handle_RemoveBot(self, request):
         try:
             did = request.match_info.get("did", "")
-            bumper.bot_remove(did)
-            if bumper.bot_get(did):
+            await bumper.async_bot_remove(did)
+            if await bumper.async_bot_get(did):
                 return web.json_response({"status": "failed to remove bot"})
             else:
                 return web.json_response({"status": "successfully removed bot"})
@@ -370,8 +534,8 @@ class ConfServer:
     async def handle_RemoveClient(self, request):
         try:           
             resource = request.match_info.get("resource", "")
-            bumper.client_remove(resource)
-            if bumper.client_get(resource):
+            await bumper.async_client_remove(resource)
+            if await bumper.async_client_get(resource):
                return web.json_response({"status": "failed to remove client"})
             else:
                return web.json_response({"status": "successfully removed client"})
@@ -392,9 +556,9 @@ class ConfServer:
                 if (
                     not user_devid == ""
                 ):  # Performing basic "auth" using devid, super insecure
-                    user = bumper.user_by_deviceid(user_devid)
+                    user = await bumper.async_user_by_deviceid(user_devid)
                     if "checkLogin" in request.path:
-                        self.check_token(
+                        await self.check_token(
                             apptype, countrycode, user, request.query["accessToken"]
                         )
                     else:
@@ -410,9 +574,9 @@ class ConfServer:
                             login_details = EcoVacs_Login()
 
                         # Deactivate old tokens and authcodes
-                        bumper.user_revoke_expired_tokens(user["userid"])
+                        await bumper.async_user_revoke_expired_tokens(user["userid"])
 
-                        login_details.accessToken = self.generate_token(user)
+                        login_details.accessToken = await self.generate_token(user)
                         login_details.uid = "fuid_{}".format(user["userid"])
                         login_details.username = "fusername_{}".format(user["userid"])
                         login_details.country = countrycode
@@ -445,7 +609,7 @@ class ConfServer:
 
             else:
                 return web.json_response(
-                    self._auth_any(user_devid, apptype, countrycode, request)
+                    await self._auth_any(user_devid, apptype, countrycode, request)
                 )
 
         except Exception as e:
@@ -519,19 +683,19 @@ class ConfServer:
             self.get_milli_time = bumper.ConfServer.ConfServer_GeneralFunctions().get_milli_time
             pass
         
-        def generate_token(self, user):
+        async def generate_token(self, user):
             try:
                 tmpaccesstoken = uuid.uuid4().hex
-                bumper.user_add_token(user["userid"], tmpaccesstoken)
+                await bumper.async_user_add_token(user["userid"], tmpaccesstoken)
                 return tmpaccesstoken
 
             except Exception as e:
                 confserverlog.exception("{}".format(e))
 
-        def generate_authcode(self, user, countrycode, token):
+        async def generate_authcode(self, user, countrycode, token):
             try:
                 tmpauthcode = "{}_{}".format(countrycode, uuid.uuid4().hex)
-                bumper.user_add_authcode(user["userid"], token, tmpauthcode)
+                await bumper.async_user_add_authcode(user["userid"], token, tmpauthcode)
                 return tmpauthcode
 
             except Exception as e:
@@ -550,9 +714,9 @@ class ConfServer:
                         if (
                             not user_devid == ""
                         ):  # Performing basic "auth" using devid, super insecure
-                            user = bumper.user_by_deviceid(user_devid)
+                            user = await bumper.async_user_by_deviceid(user_devid)
                             if "checkLogin" in request.path:
-                                self.check_token(
+                                await self.check_token(
                                     apptype, countrycode, user, request.query["accessToken"]
                                 )
                             else:
@@ -568,9 +732,9 @@ class ConfServer:
                                     login_details = EcoVacs_Login()
 
                                 # Deactivate old tokens and authcodes
-                                bumper.user_revoke_expired_tokens(user["userid"])
+                                await bumper.async_user_revoke_expired_tokens(user["userid"])
 
-                                login_details.accessToken = self.generate_token(user)
+                                login_details.accessToken = await self.generate_token(user)
                                 login_details.uid = "fuid_{}".format(user["userid"])
                                 login_details.username = "fusername_{}".format(user["userid"])
                                 login_details.country = countrycode
@@ -603,7 +767,7 @@ class ConfServer:
 
                     else:
                         return web.json_response(
-                            self._auth_any(user_devid, apptype, countrycode, request)
+                            await self._auth_any(user_devid, apptype, countrycode, request)
                         )
 
                 except Exception as e:
@@ -618,17 +782,17 @@ class ConfServer:
                     user_devid = request.query["deviceId"]  # Ecovacs Home
 
                 if not user_devid == "":
-                    user = bumper.user_by_deviceid(user_devid)
+                    user = await bumper.async_user_by_deviceid(user_devid)
                     token = ""
                     if user:
                         if "accessToken" in request.query:
-                            token = bumper.user_get_token(
+                            token = await bumper.async_user_get_token(
                                 user["userid"], request.query["accessToken"]
                             )
                         if token:
                             authcode = ""
                             if not "authcode" in token:
-                                authcode = self.generate_authcode(
+                                authcode = await self.generate_authcode(
                                     user,
                                     request.match_info.get("country", "us"),
                                     request.query["accessToken"],
@@ -674,9 +838,9 @@ class ConfServer:
             except Exception as e:
                 confserverlog.exception("{}".format(e))                    
 
-        def check_token(self, apptype, countrycode, user, token):
+        async def check_token(self, apptype, countrycode, user, token):
             try:
-                if bumper.check_token(user["userid"], token):
+                if await bumper.async_check_token(user["userid"], token):
 
                     if "global_" in apptype:  # EcoVacs Home
                         login_details = EcoVacsHome_Login()
@@ -719,55 +883,44 @@ class ConfServer:
             except Exception as e:
                 confserverlog.exception("{}".format(e))                
 
-        def _auth_any(self, devid, apptype, country, request):
+        async def _auth_any(self, devid, apptype, country, request):
             try:
                 user_devid = devid
                 countrycode = country
-                user = bumper.user_by_deviceid(user_devid)
-                bots = bumper.db_get().table("bots").all()
-
-                if user:  # Default to user 0
-                    tmpuser = user
-                    if "global_" in apptype:  # EcoVacs Home
-                        login_details = EcoVacsHome_Login()
-                        login_details.ucUid = "fuid_{}".format(tmpuser["userid"])
-                        login_details.loginName = "fusername_{}".format(tmpuser["userid"])
-                        login_details.mobile = None
-                    else:
-                        login_details = EcoVacs_Login()
-
-                    login_details.accessToken = self.generate_token(tmpuser)
-                    login_details.uid = "fuid_{}".format(tmpuser["userid"])
-                    login_details.username = "fusername_{}".format(tmpuser["userid"])
-                    login_details.country = countrycode
-                    login_details.email = "null@null.com"
-                    bumper.user_add_device(tmpuser["userid"], user_devid)
-                else:
-                    bumper.user_add("tmpuser")  # Add a new user
-                    tmpuser = bumper.user_get("tmpuser")
-                    if "global_" in apptype:  # EcoVacs Home
-                        login_details = EcoVacsHome_Login()
-                        login_details.ucUid = "fuid_{}".format(tmpuser["userid"])
-                        login_details.loginName = "fusername_{}".format(tmpuser["userid"])
-                        login_details.mobile = None
-                    else:
-                        login_details = EcoVacs_Login()
-
-                    login_details.accessToken = self.generate_token(tmpuser)
-                    login_details.uid = "fuid_{}".format(tmpuser["userid"])
-                    login_details.username = "fusername_{}".format(tmpuser["userid"])
-                    login_details.country = countrycode
-                    login_details.email = "null@null.com"
-                    bumper.user_add_device(tmpuser["userid"], user_devid)
+                user = await bumper.async_user_by_deviceid(user_devid)
+                bots = await bumper.async_bot_get_all()
 
+                dids = []
                 for bot in bots:  # Add all bots to the user
                     if "did" in bot:
-                        bumper.user_add_bot(tmpuser["userid"], bot["did"])
+                        dids.append(bot["did"])
                     else:
                         confserverlog.error("No DID for bot: {}".format(bot))
 
+                # Default to user 0, or add a new user. The user, device, token
+                # and bots are written in a single batch.
+                userid = user["userid"] if user else "tmpuser"
+                accesstoken = uuid.uuid4().hex
+                tmpuser = await bumper.async_user_login(
+                    userid, user_devid, accesstoken, dids
+                )
+
+                if "global_" in apptype:  # EcoVacs Home
+                    login_details = EcoVacsHome_Login()
+                    login_details.ucUid = "fuid_{}".format(tmpuser["userid"])
+                    login_details.loginName = "fusername_{}".format(tmpuser["userid"])
+                    login_details.mobile = None
+                else:
+                    login_details = EcoVacs_Login()
+
+                login_details.accessToken = accesstoken
+                login_details.uid = "fuid_{}".format(tmpuser["userid"])
+                login_details.username = "fusername_{}".format(tmpuser["userid"])
+                login_details.country = countrycode
+                login_details.email = "null@null.com"
+
                 if "checkLogin" in request.path:  # If request was to check a token do so
-                    checkToken = self.check_token(
+                    checkToken = await self.check_token(
                         apptype, countrycode, tmpuser, request.query["accessToken"]
                     )
                     isGood = json.loads(checkToken.text)
@@ -775,7 +928,7 @@ class ConfServer:
                         return isGood
 
                 # Deactivate old tokens and authcodes
-                bumper.user_revoke_expired_tokens(tmpuser["userid"])
+                await bumper.async_user_revoke_expired_tokens(tmpuser["userid"])
 
                 body = {
                     "code": bumper.RETURN_API_SUCCESS,
@@ -797,12 +950,12 @@ class ConfServer:
                 confserverlog.exception("{}".format(e))     
 
 
-        def getUserAccountInfo(self, request):
+        async def getUserAccountInfo(self, request):
             try:
                 user_devid = request.match_info.get("devid", "")
                 countrycode = request.match_info.get("country", "us")
                 apptype = request.match_info.get("apptype", "")
-                user = bumper.user_by_deviceid(user_devid)
+                user = await bumper.async_user_by_deviceid(user_devid)
 
                 if "global_" in apptype:  # EcoVacs Home
                     login_details = EcoVacsHome_Login()
@@ -869,11 +1022,11 @@ class ConfServer:
             try:
                 user_devid = request.match_info.get("devid", "")
                 if not user_devid == "":
-                    user = bumper.user_by_deviceid(user_devid)
+                    user = await bumper.async_user_by_deviceid(user_devid)
                     if user:
-                        if bumper.check_token(user["userid"], request.query["accessToken"]):
+                        if await bumper.async_check_token(user["userid"], request.query["accessToken"]):
                             # Deactivate old tokens and authcodes
-                            bumper.user_revoke_token(
+                            await bumper.async_user_revoke_token(
                                 user["userid"], request.query["accessToken"]
                             )
 
@@ -1,12 +1,24 @@
 #!/usr/bin/env python3
 import bumper
+from bumper.metrics import CallMetrics
 from bumper.models import VacBotClient, VacBotDevice, BumperUser, EcoVacsHomeProducts
-from tinydb import TinyDB, Query
-from tinydb.storages import MemoryStorage
-from datetime import datetime, timedelta
+from tinydb import TinyDB
+from tinydb.database import Document
+from tinydb.storages import JSONStorage, MemoryStorage
+from tinydb.middlewares import CachingMiddleware
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import asyncio
+import contextlib
+import functools
+import glob
+import gzip
+import heapq
 import os
 import json
 import logging
+import sqlite3
+import time
 
 
 bumperlog = logging.getLogger("bumper")
@@ -20,22 +32,937 @@ def db_file():
 
 
 def os_db_path():  # createdir=True):
+    if bumper.db_backend == "sqlite":
+        return os.path.join(bumper.data_dir, "bumper.sqlite")
+
     return os.path.join(bumper.data_dir, "bumper.db")
 
 
+# Indexed fields per table, list fields index each element
+db_indexes = {
+    "users": ["userid", "devices"],
+    "clients": ["resource"],
+    "bots": ["did"],
+    "tokens": ["userid", "token", "authcode"],
+}
+
+# Tables whose records expire, mapped to the field holding the epoch deadline
+db_ttl_fields = {
+    "tokens": "expiration",
+}
+
+
+# Instrumentation, see db_stats()
+db_call_metrics = CallMetrics()  # Calls and latency of the public functions
+db_storage_stats = {"reads": 0, "writes": 0, "bytes_written": 0}
+_instrumented = db_call_metrics.timed
+
+
+class _CountingJSONStorage(JSONStorage):
+    """JSONStorage that counts file reads, writes and bytes written."""
+
+    def read(self):
+        db_storage_stats["reads"] += 1
+        return super().read()
+
+    def write(self, data):
+        super().write(data)
+        db_storage_stats["writes"] += 1
+        db_storage_stats["bytes_written"] += self._handle.tell()
+
+
+def _ttl_epoch(value):
+    # Older databases stored deadlines as ISO strings (local time)
+    if isinstance(value, str):
+        return datetime.fromisoformat(value).timestamp()
+
+    return value
+
+
+class _IndexedTable:
+    """A TinyDB table mirrored in memory with hash indexes on some fields.
+
+    get_by/search_by resolve through the indexes instead of scanning the table
+    with a Query. Changes must go through this wrapper to keep them in sync.
+    """
+
+    def __init__(self, table, fields):
+        self.name = table.name
+        self._table = table
+        self._fields = fields
+        self.rebuild()
+
+    def rebuild(self):
+        self._docs = {}
+        self._indexes = {field: {} for field in self._fields}
+        for doc in self._table.all():
+            self._add(doc)
+
+    def _keys(self, doc, field):
+        value = doc.get(field)
+        if value is None:
+            return []
+        if isinstance(value, list):
+            return value
+        return [value]
+
+    def _add(self, doc):
+        self._docs[doc.doc_id] = doc
+        for field, index in self._indexes.items():
+            for key in self._keys(doc, field):
+                index.setdefault(key, set()).add(doc.doc_id)
+
+    def _discard(self, doc_id):
+        doc = self._docs.pop(doc_id)
+        for field, index in self._indexes.items():
+            for key in self._keys(doc, field):
+                doc_ids = index.get(key)
+                if doc_ids is not None:
+                    doc_ids.discard(doc_id)
+                    if not doc_ids:
+                        del index[key]
+
+    def _copy(self, doc):
+        # Hand out copies so callers can't modify the indexed documents
+        return Document(
+            {k: list(v) if isinstance(v, list) else v for k, v in doc.items()},
+            doc.doc_id,
+        )
+
+    def _lookup(self, field, value):
+        return sorted(self._indexes[field].get(value, ()))
+
+    def __len__(self):
+        return len(self._docs)
+
+    def all(self):
+        return [self._copy(doc) for doc in self._docs.values()]
+
+    def get_by(self, field, value):
+        doc_ids = self._lookup(field, value)
+        if doc_ids:
+            return self._copy(self._docs[doc_ids[0]])
+
+        return None
+
+    def search_by(self, field, value):
+        return [self._copy(self._docs[doc_id]) for doc_id in self._lookup(field, value)]
+
+    def page(self, after=0, limit=1000):
+        # Documents with a doc_id above after, in doc_id order
+        doc_ids = sorted(doc_id for doc_id in self._docs if doc_id > after)[:limit]
+        return [self._copy(self._docs[doc_id]) for doc_id in doc_ids]
+
+    def insert(self, document):
+        doc_id = self._table.insert(document)
+        self._add(self._copy(Document(document, doc_id)))
+        return doc_id
+
+    def insert_multiple(self, documents):
+        # One table write for all documents, rather than one per insert
+        documents = list(documents)
+        doc_ids = self._table.insert_multiple(documents)
+        for document, doc_id in zip(documents, doc_ids):
+            self._add(self._copy(Document(document, doc_id)))
+
+        return doc_ids
+
+    def update(self, fields, doc_ids):
+        self._table.update(fields, doc_ids=doc_ids)
+        for doc_id in doc_ids:
+            doc = self._copy(self._docs[doc_id])
+            doc.update(fields)
+            self._discard(doc_id)
+            self._add(doc)
+
+    def update_multiple(self, updates):
+        # Apply {doc_id: fields} with one table write
+        docs = []
+        for doc_id, fields in updates.items():
+            doc = self._copy(self._docs[doc_id])
+            doc.update(fields)
+            docs.append(doc)
+
+        self._table.write_back(list(docs), doc_ids=list(updates))  # Empties the list
+        for doc in docs:
+            self._discard(doc.doc_id)
+            self._add(doc)
+
+    def upsert_by(self, field, value, fields):
+        doc_ids = self._lookup(field, value)
+        if doc_ids:
+            self.update(fields, doc_ids)
+        else:
+            self.insert(fields)
+
+    def remove(self, doc_ids):
+        self._table.remove(doc_ids=doc_ids)
+        for doc_id in doc_ids:
+            self._discard(doc_id)
+
+    def remove_by(self, field, value):
+        doc_ids = self._lookup(field, value)
+        if doc_ids:
+            self.remove(doc_ids)
+
+    def truncate(self):
+        self._table.purge()
+        self.rebuild()
+
+
+class _TTLTable(_IndexedTable):
+    """An _IndexedTable whose records expire at the epoch time in ttl_field.
+
+    Deadlines are kept in a min-heap, so finding the k records that are due
+    costs O(k log n). Removing them still goes through TinyDB, which rewrites
+    the whole table, so expire() removes all of them with one remove() per
+    sweep: O(n) per sweep rather than per expired record. Entries left behind
+    by updates and removals are skipped when popped, and dropped whenever the
+    heap grows well past the table size.
+    """
+
+    def __init__(self, table, fields, ttl_field):
+        self.ttl_field = ttl_field
+        super().__init__(table, fields)
+
+    def rebuild(self):
+        self._heap = []
+        super().rebuild()
+
+        legacy = [d for d in self._docs.values() if isinstance(d.get(self.ttl_field), str)]
+        for doc in legacy:
+            self.update({self.ttl_field: doc[self.ttl_field]}, [doc.doc_id])
+
+    def _rebuild_heap(self):
+        self._heap = []
+        for doc in self._docs.values():
+            self._push(doc)
+
+        heapq.heapify(self._heap)
+
+    def _push(self, doc):
+        deadline = doc.get(self.ttl_field)
+        if isinstance(deadline, (int, float)):
+            heapq.heappush(self._heap, (deadline, doc.doc_id))
+
+    def _add(self, doc):
+        super()._add(doc)
+        self._push(doc)
+
+    def _normalize(self, fields):
+        if isinstance(fields.get(self.ttl_field), str):
+            fields = dict(fields)
+            fields[self.ttl_field] = _ttl_epoch(fields[self.ttl_field])
+
+        return fields
+
+    def insert(self, document):
+        return super().insert(self._normalize(document))
+
+    def insert_multiple(self, documents):
+        return super().insert_multiple(self._normalize(d) for d in documents)
+
+    def update(self, fields, doc_ids):
+        super().update(self._normalize(fields), doc_ids)
+
+    def update_multiple(self, updates):
+        super().update_multiple({k: self._normalize(v) for k, v in updates.items()})
+
+    def remove(self, doc_ids):
+        super().remove(doc_ids)
+        if len(self._heap) > 2 * len(self._docs) + 64:
+            self._rebuild_heap()
+
+    def expire(self, now=None):
+        # Remove and return the records whose deadline has passed
+        now = time.time() if now is None else now
+        due = {}
+        while self._heap and self._heap[0][0] <= now:
+            deadline, doc_id = heapq.heappop(self._heap)
+            doc = self._docs.get(doc_id)
+            if doc is not None and doc.get(self.ttl_field) == deadline:
+                due[doc_id] = self._copy(doc)
+
+        if due:
+            self.remove(list(due))  # One table rewrite for the whole sweep
+
+        return list(due.values())
+
+
+class _IndexedTinyDB:
+    """TinyDB file with a write-behind cache and indexed tables."""
+
+    backend = "tinydb"
+
+    def __init__(self, path):
+        self.path = path
+        self._batches = 0
+        self._pending_before = 0  # Cached writes when the outermost batch began
+        self.storage = CachingMiddleware(_CountingJSONStorage)
+        self.storage.WRITE_CACHE_SIZE = bumper.db_write_cache_size
+
+        # Will create the database if it doesn't exist
+        self._db = TinyDB(path, storage=self.storage)
+
+        # Will create the tables if they don't exist, and index what's loaded
+        self._tables = {}
+        for name, fields in db_indexes.items():
+            if name in db_ttl_fields:
+                table = _TTLTable(self._db.table(name), fields, db_ttl_fields[name])
+            else:
+                table = _IndexedTable(self._db.table(name), fields)
+
+            self._tables[name] = table
+
+    def table(self, name):
+        return self._tables[name]
+
+    def begin(self):
+        # Hold every write in the cache until the outermost batch ends
+        if self._batches == 0:
+            self._pending_before = self.storage._cache_modified_count
+        self._batches += 1
+        self.storage.WRITE_CACHE_SIZE = float("inf")
+
+    def end(self):
+        self._batches -= 1
+        if self._batches == 0:
+            # The batch counts as one cached write, flushed like any other
+            self.storage.WRITE_CACHE_SIZE = bumper.db_write_cache_size
+            if self.storage._cache_modified_count > self._pending_before:
+                self.storage._cache_modified_count = self._pending_before + 1
+                if self.storage._cache_modified_count >= bumper.db_write_cache_size:
+                    self.flush()
+
+    def flush(self):
+        self.storage.flush()
+
+    def compact(self):
+        self.flush()  # The whole file is rewritten on every flush
+
+    def size(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def close(self):
+        self._db.close()  # Flushes cached changes before closing the file
+
+
+class _SQLiteTable:
+    """A SQLite table of JSON documents, with the same interface as _IndexedTable.
+
+    Scalar fields from db_indexes are stored in indexed columns, list fields
+    get a side table holding one indexed row per element.
+    """
+
+    def __init__(self, db, name, fields):
+        self.name = name
+        self._db = db
+        self._conn = db.connection
+        self._columns = [f for f in fields if f not in _sqlite_list_fields.get(name, [])]
+        self._lists = [f for f in fields if f in _sqlite_list_fields.get(name, [])]
+
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS {} (id INTEGER PRIMARY KEY{}, data TEXT NOT NULL)".format(
+                name, "".join(", {}".format(c) for c in self._columns)
+            )
+        )
+        existing = [row[1] for row in self._conn.execute("PRAGMA table_info({})".format(name))]
+        added = [c for c in self._columns if c not in existing]
+        for column in added:  # Indexed field added since the table was created
+            self._conn.execute("ALTER TABLE {} ADD COLUMN {}".format(name, column))
+        for column in self._columns:
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS {0}_{1} ON {0} ({1})".format(name, column)
+            )
+        for field in self._lists:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS {0}_{1} (doc_id INTEGER NOT NULL, value)".format(
+                    name, field
+                )
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS {0}_{1}_value ON {0}_{1} (value)".format(
+                    name, field
+                )
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS {0}_{1}_doc_id ON {0}_{1} (doc_id)".format(
+                    name, field
+                )
+            )
+
+        for doc in self.all() if added else []:
+            self.update({}, [doc.doc_id])  # Fill in the new columns
+
+    def _documents(self, rows):
+        db_storage_stats["reads"] += 1
+        return [Document(json.loads(data), doc_id) for doc_id, data in rows]
+
+    def _write_lists(self, doc_id, document):
+        for field in self._lists:
+            self._conn.execute(
+                "DELETE FROM {}_{} WHERE doc_id = ?".format(self.name, field), (doc_id,)
+            )
+            values = document.get(field) or []
+            if not isinstance(values, list):
+                values = [values]
+            self._conn.executemany(
+                "INSERT INTO {}_{} (doc_id, value) VALUES (?, ?)".format(self.name, field),
+                [(doc_id, value) for value in values],
+            )
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM {}".format(self.name)).fetchone()[0]
+
+    def all(self):
+        return self._documents(
+            self._conn.execute("SELECT id, data FROM {} ORDER BY id".format(self.name))
+        )
+
+    def get_by(self, field, value):
+        docs = self.search_by(field, value)
+        if docs:
+            return docs[0]
+
+        return None
+
+    def search_by(self, field, value):
+        if field in self._lists:
+            sql = (
+                "SELECT t.id, t.data FROM {0} t JOIN {0}_{1} l ON l.doc_id = t.id"
+                " WHERE l.value = ? ORDER BY t.id".format(self.name, field)
+            )
+        elif field in self._columns:
+            sql = "SELECT id, data FROM {} WHERE {} = ? ORDER BY id".format(self.name, field)
+        else:
+            raise KeyError(field)
+
+        return self._documents(self._conn.execute(sql, (value,)))
+
+    def page(self, after=0, limit=1000):
+        return self._documents(
+            self._conn.execute(
+                "SELECT id, data FROM {} WHERE id > ? ORDER BY id LIMIT ?".format(
+                    self.name
+                ),
+                (after, limit),
+            )
+        )
+
+    def insert(self, document):
+        data = json.dumps(document)
+        db_storage_stats["bytes_written"] += len(data)
+        cursor = self._conn.execute(
+            "INSERT INTO {} ({}data) VALUES ({}?)".format(
+                self.name,
+                "".join("{}, ".format(c) for c in self._columns),
+                "?, " * len(self._columns),
+            ),
+            [document.get(c) for c in self._columns] + [data],
+        )
+        self._write_lists(cursor.lastrowid, document)
+        self._db.changed()
+        return cursor.lastrowid
+
+    def insert_multiple(self, documents):
+        return [self.insert(document) for document in documents]
+
+    def update(self, fields, doc_ids):
+        for doc_id in doc_ids:
+            db_storage_stats["reads"] += 1
+            row = self._conn.execute(
+                "SELECT data FROM {} WHERE id = ?".format(self.name), (doc_id,)
+            ).fetchone()
+            if row is None:
+                continue
+
+            document = json.loads(row[0])
+            document.update(fields)
+            data = json.dumps(document)
+            db_storage_stats["bytes_written"] += len(data)
+            self._conn.execute(
+                "UPDATE {} SET {}data = ? WHERE id = ?".format(
+                    self.name, "".join("{} = ?, ".format(c) for c in self._columns)
+                ),
+                [document.get(c) for c in self._columns] + [data, doc_id],
+            )
+            self._write_lists(doc_id, document)
+
+        self._db.changed()
+
+    def update_multiple(self, updates):
+        for doc_id, fields in updates.items():
+            self.update(fields, [doc_id])
+
+    def upsert_by(self, field, value, fields):
+        doc_ids = [doc.doc_id for doc in self.search_by(field, value)]
+        if doc_ids:
+            self.update(fields, doc_ids)
+        else:
+            self.insert(fields)
+
+    def remove(self, doc_ids):
+        params = [(doc_id,) for doc_id in doc_ids]
+        self._conn.executemany("DELETE FROM {} WHERE id = ?".format(self.name), params)
+        for field in self._lists:
+            self._conn.executemany(
+                "DELETE FROM {}_{} WHERE doc_id = ?".format(self.name, field), params
+            )
+
+        self._db.changed()
+
+    def remove_by(self, field, value):
+        doc_ids = [doc.doc_id for doc in self.search_by(field, value)]
+        if doc_ids:
+            self.remove(doc_ids)
+
+    def truncate(self):
+        self._conn.execute("DELETE FROM {}".format(self.name))
+        for field in self._lists:
+            self._conn.execute("DELETE FROM {}_{}".format(self.name, field))
+
+        self._db.changed()
+
+
+class _SQLiteTTLTable(_SQLiteTable):
+    """A _SQLiteTable whose records expire at the epoch time in ttl_field.
+
+    The deadline is an indexed column, so expire() is a range scan over the
+    records that are due.
+    """
+
+    def __init__(self, db, name, fields, ttl_field):
+        self.ttl_field = ttl_field
+        super().__init__(db, name, fields + [ttl_field])
+
+        legacy = self._conn.execute(
+            "SELECT id, {0} FROM {1} WHERE typeof({0}) = 'text'".format(ttl_field, name)
+        ).fetchall()
+        for doc_id, deadline in legacy:
+            self.update({ttl_field: deadline}, [doc_id])
+
+    def _normalize(self, fields):
+        if isinstance(fields.get(self.ttl_field), str):
+            fields = dict(fields)
+            fields[self.ttl_field] = _ttl_epoch(fields[self.ttl_field])
+
+        return fields
+
+    def insert(self, document):
+        return super().insert(self._normalize(document))
+
+    def update(self, fields, doc_ids):
+        super().update(self._normalize(fields), doc_ids)
+
+    def expire(self, now=None):
+        # Remove and return the records whose deadline has passed
+        now = time.time() if now is None else now
+        expired = self._documents(
+            self._conn.execute(
+                "SELECT id, data FROM {} WHERE {} <= ? ORDER BY {}".format(
+                    self.name, self.ttl_field, self.ttl_field
+                ),
+                (now,),
+            )
+        )
+        if expired:
+            self.remove([doc.doc_id for doc in expired])
+
+        return expired
+
+
+# Indexed fields that hold lists, stored in side tables by the SQLite backend
+_sqlite_list_fields = {"users": ["devices"]}
+
+
+class _SQLiteDB:
+    """SQLite database in WAL mode, committed like the TinyDB write-behind cache."""
+
+    backend = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self._pending = 0
+        self._batches = 0
+        self._pending_before = 0  # Pending writes when the outermost batch began
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self._tables = {}
+        for name, fields in db_indexes.items():
+            if name in db_ttl_fields:
+                table = _SQLiteTTLTable(self, name, fields, db_ttl_fields[name])
+            else:
+                table = _SQLiteTable(self, name, fields)
+
+            self._tables[name] = table
+        self.connection.commit()
+
+    def table(self, name):
+        return self._tables[name]
+
+    def changed(self):
+        self._pending += 1
+        if self._pending >= bumper.db_write_cache_size and self._batches == 0:
+            self.flush()
+
+    def begin(self):
+        # Keep every write in one transaction until the outermost batch ends
+        if self._batches == 0:
+            self._pending_before = self._pending
+        self._batches += 1
+
+    def end(self):
+        self._batches -= 1
+        if self._batches == 0:
+            # The batch counts as one pending write, committed like any other
+            if self._pending > self._pending_before:
+                self._pending = self._pending_before + 1
+                if self._pending >= bumper.db_write_cache_size:
+                    self.flush()
+
+    def flush(self):
+        if self._pending > 0:
+            self.connection.commit()
+            db_storage_stats["writes"] += 1
+            self._pending = 0
+
+    def compact(self):
+        self.connection.commit()
+        self._pending = 0
+        self.connection.execute("VACUUM")
+        self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def size(self):
+        return sum(
+            os.path.getsize(path)
+            for path in (self.path, self.path + "-wal")
+            if os.path.exists(path)
+        )
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+_db = None  # Process-wide database handle, opened on first use
+
+
 def db_get():
-    # Will create the database if it doesn't exist
-    db = TinyDB(db_file())
+    global _db
+
+    path = db_file()
+    if _db is None or _db.path != path or _db.backend != bumper.db_backend:
+        # Open (or reopen if the location changed), call db_close() before
+        # removing or replacing the file
+        db_close()
+        if bumper.db_backend == "sqlite":
+            tinydb_path = os.path.join(bumper.data_dir, "bumper.db")
+            migrate = (
+                not bumper.db
+                and not os.path.exists(path)
+                and os.path.exists(tinydb_path)
+            )
+            _db = _SQLiteDB(path)
+            if migrate:  # First start on SQLite, bring over the existing TinyDB data
+                db_migrate_tinydb(tinydb_path)
+        else:
+            _db = _IndexedTinyDB(path)
+
+    return _db
+
+
+@_instrumented
+def db_migrate_tinydb(tinydb_path):
+    # Copy every document from a TinyDB file into the current database
+    bumperlog.info("Migrating TinyDB database {} to {}".format(tinydb_path, db_file()))
+    with open(tinydb_path) as f:
+        content = f.read()
+    data = json.loads(content) if content.strip() else {}
+
+    count = _db_load(data)
+    bumperlog.info("Migrated {} records from {}".format(count, tinydb_path))
+    return count
+
+
+def _db_load(data, replace=False):
+    # Insert the tables of a TinyDB style image ({table: {doc_id: doc}})
+    count = 0
+    with db_batch():
+        for name in db_indexes:
+            table = db_get().table(name)
+            if replace:
+                table.truncate()
+
+            docs = data.get(name, {})
+            table.insert_multiple(docs[doc_id] for doc_id in sorted(docs, key=int))
+            count += len(docs)
+
+    return count
+
+
+@_instrumented
+def db_snapshot():
+    # Point-in-time copy of every table, in the TinyDB file layout. Callers on
+    # the event loop should use async_db_backup() so this runs on the db thread.
+    return {
+        name: {str(doc.doc_id): dict(doc) for doc in db_get().table(name).all()}
+        for name in db_indexes
+    }
+
+
+def db_write_backup(image, backup_dir=None, keep=None, compress=None):
+    # Write a snapshot to a new file in backup_dir and remove the oldest
+    # backups past keep. Written to a temp file first, so a backup file is
+    # either complete or absent.
+    backup_dir = backup_dir or bumper.db_backup_dir
+    keep = bumper.db_backup_count if keep is None else keep
+    compress = bumper.db_backup_compress if compress is None else compress
+    os.makedirs(backup_dir, exist_ok=True)
+
+    name = "bumper-{}.json".format(datetime.now().strftime("%Y%m%d-%H%M%S-%f"))
+    if compress:
+        name += ".gz"
+    path = os.path.join(backup_dir, name)
+
+    data = json.dumps(image).encode("utf-8")
+    with open(path + ".tmp", "wb") as f:
+        if compress:
+            with gzip.GzipFile(fileobj=f, mode="wb") as gz:
+                gz.write(data)
+        else:
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+    backups = sorted(
+        b for b in glob.glob(os.path.join(backup_dir, "bumper-*.json*"))
+        if not b.endswith(".tmp")
+    )
+    for old in backups[: max(len(backups) - keep, 0)]:
+        os.remove(old)
+
+    bumperlog.info("Database backed up to {}".format(path))
+    return path
+
+
+@_instrumented
+def db_backup(backup_dir=None, keep=None, compress=None):
+    return db_write_backup(db_snapshot(), backup_dir, keep, compress)
+
+
+@_instrumented
+def db_restore(path):
+    # Replace the contents of the database with a backup
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt") as f:
+        image = json.load(f)
+
+    count = _db_load(image, replace=True)
+    bumperlog.info("Restored {} records from {}".format(count, path))
+    return count
+
+
+# Record types for NDJSON import/export: table, model and key field
+db_record_types = {
+    "user": ("users", BumperUser, "userid"),
+    "bot": ("bots", VacBotDevice, "did"),
+    "client": ("clients", VacBotClient, "resource"),
+}
+
+
+def db_validate_record(record):
+    # Check an import record against its model, returning the table, key field
+    # and full document. Raises ValueError if it doesn't fit.
+    if not isinstance(record, dict):
+        raise ValueError("Record is not an object")
+
+    rtype = record.get("type")
+    if rtype not in db_record_types:
+        raise ValueError("Unknown record type: {}".format(rtype))
+
+    table, model, key = db_record_types[rtype]
+    document = model().asdict()
+    for field, value in record.items():
+        if field == "type":
+            continue
+        if field not in document:
+            raise ValueError("Unknown {} field: {}".format(rtype, field))
+
+        expected = type(document[field])
+        if expected is float:
+            expected = (int, float)
+        if not (isinstance(value, expected) or (value is None and expected is str)):
+            raise ValueError(
+                "{} field {} should be {}".format(rtype, field, type(document[field]).__name__)
+            )
+        document[field] = value
+
+    if not document[key]:
+        raise ValueError("{} record has no {}".format(rtype, key))
+
+    return table, key, document
+
+
+@_instrumented
+def db_import_records(records):
+    # Upsert validated (table, key, document) records by key, with one write
+    # per table
+    grouped = {}
+    for table, key, document in records:
+        grouped.setdefault((table, key), {})[document[key]] = document  # Last wins
+
+    with db_batch():
+        for (name, key), documents in grouped.items():
+            table = db_get().table(name)
+            updates, inserts = {}, []
+            for value, document in documents.items():
+                existing = table.get_by(key, value)
+                if existing:
+                    updates[existing.doc_id] = document
+                else:
+                    inserts.append(document)
+
+            if updates:
+                table.update_multiple(updates)
+            if inserts:
+                table.insert_multiple(inserts)
+
+    return sum(len(documents) for documents in grouped.values())
+
+
+class NDJSONImport:
+    """Parses NDJSON lines into batches for db_import_records.
+
+    feed() returns a full batch once bumper.db_import_batch_size records are
+    waiting, so only one batch is held in memory. Invalid lines are counted
+    and skipped.
+    """
+
+    max_errors = 20  # Error messages kept for the summary
+
+    def __init__(self):
+        self.line = 0
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+        self._batch = []
+
+    def feed(self, line):
+        self.line += 1
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        if not line.strip():
+            return None
+
+        try:
+            self._batch.append(db_validate_record(json.loads(line)))
+        except ValueError as e:  # Includes JSON decode errors
+            self.failed += 1
+            if len(self.errors) < self.max_errors:
+                self.errors.append("line {}: {}".format(self.line, e))
+            return None
+
+        if len(self._batch) >= bumper.db_import_batch_size:
+            return self.take()
+
+        return None
+
+    def take(self):
+        batch, self._batch = self._batch, []
+        return batch
+
+    def applied(self, count):
+        self.imported += count
+
+    def summary(self):
+        return {"imported": self.imported, "failed": self.failed, "errors": self.errors}
+
+
+def db_import(lines):
+    # Import NDJSON lines (e.g. an open file)
+    importer = NDJSONImport()
+    for line in lines:
+        batch = importer.feed(line)
+        if batch:
+            importer.applied(db_import_records(batch))
+
+    importer.applied(db_import_records(importer.take()))
+    bumperlog.info("Imported records: {}".format(importer.summary()))
+    return importer.summary()
+
+
+@_instrumented
+def db_export_page(rtype, after=0):
+    # One page of records of a type, tagged for NDJSON export
+    name = db_record_types[rtype][0]
+    docs = db_get().table(name).page(after, bumper.db_export_page_size)
+    return [dict(doc, type=rtype) for doc in docs], docs[-1].doc_id if docs else None
+
+
+def db_export():
+    # Yield NDJSON lines for every user, bot and client
+    for rtype in db_record_types:
+        after = 0
+        while after is not None:
+            records, after = db_export_page(rtype, after)
+            for record in records:
+                yield json.dumps(record) + "\n"
+
+
+@contextlib.contextmanager
+def db_batch():
+    # Group several changes into a single write to disk:
+    #   with db_batch():
+    #       user_add_device(...)
+    #       user_add_token(...)
+    # Batches nest; the outermost one counts as a single cached write, so it
+    # is flushed after db_write_cache_size writes or by db_flush(). Changes
+    # are not rolled back if the block raises.
+    db = db_get()
+    db.begin()
+    try:
+        yield db
+    finally:
+        db.end()
 
-    # Will create the tables if they don't exist
-    db.table("users", cache_size=0)
-    db.table("clients", cache_size=0)
-    db.table("bots", cache_size=0)
-    db.table("tokens", cache_size=0)
 
-    return db
+@_instrumented
+def db_flush():
+    # Write any cached changes to disk
+    if _db is not None:
+        _db.flush()
+
+
+def db_stats():
+    # Call counts and latency of the db functions, storage reads/writes and
+    # bytes written since start (or db_stats_reset), and the current file size
+    db = db_get()
+    return {
+        "backend": db.backend,
+        "file_size": db.size(),
+        "storage": dict(db_storage_stats),
+        "functions": db_call_metrics.asdict(),
+    }
+
+
+def db_stats_reset():
+    db_call_metrics.reset()
+    for key in db_storage_stats:
+        db_storage_stats[key] = 0
+
 
+def db_close():
+    global _db
 
+    if _db is not None:
+        _db.close()
+
+    _db = None
+
+
+@_instrumented
 def user_add(userid):
     newuser = BumperUser()
     newuser.userid = userid
@@ -46,218 +973,195 @@ def user_add(userid):
         user_full_upsert(newuser.asdict())
 
 
+@_instrumented
 def user_get(userid):
     users = db_get().table("users")
-    User = Query()
-    return users.get(User.userid == userid)
+    return users.get_by("userid", userid)
 
 
+@_instrumented
 def user_by_deviceid(deviceid):
     users = db_get().table("users")
-    User = Query()
-    return users.get(User.devices.any([deviceid]))
+    return users.get_by("devices", deviceid)
 
 
+@_instrumented
 def user_full_upsert(user):
-    opendb = db_get()
-    with opendb:
-        users = opendb.table("users")
-        User = Query()
-        users.upsert(user, User.did == user["userid"])
+    users = db_get().table("users")
+    users.upsert_by("userid", user["userid"], user)
 
 
+@_instrumented
 def user_add_device(userid, devid):
-    opendb = db_get()
-    with opendb:
-        users = opendb.table("users")
-        User = Query()
-        user = users.get(User.userid == userid)
-        userdevices = list(user["devices"])
-        if not devid in userdevices:
-            userdevices.append(devid)
-
-        users.upsert({"devices": userdevices}, User.userid == userid)
+    users = db_get().table("users")
+    user = users.get_by("userid", userid)
+    userdevices = list(user["devices"])
+    if not devid in userdevices:
+        userdevices.append(devid)
+        users.upsert_by("userid", userid, {"devices": userdevices})
 
 
+@_instrumented
 def user_remove_device(userid, devid):
-    opendb = db_get()
-    with opendb:
-        users = opendb.table("users")
-        User = Query()
-        user = users.get(User.userid == userid)
-        userdevices = list(user["devices"])
-        if devid in userdevices:
-            userdevices.remove(devid)
+    users = db_get().table("users")
+    user = users.get_by("userid", userid)
+    userdevices = list(user["devices"])
+    if devid in userdevices:
+        userdevices.remove(devid)
 
-        users.upsert({"devices": userdevices}, User.userid == userid)
+    users.upsert_by("userid", userid, {"devices": userdevices})
 
 
+@_instrumented
 def user_add_bot(userid, did):
-    opendb = db_get()
-    with opendb:
-        users = opendb.table("users")
-        User = Query()
-        user = users.get(User.userid == userid)
-        userbots = list(user["bots"])
-        if not did in userbots:
-            userbots.append(did)
+    user_add_bots(userid, [did])
+
+
+@_instrumented
+def user_add_bots(userid, dids):
+    # Add several bots with one read and one update of the user
+    users = db_get().table("users")
+    user = users.get_by("userid", userid)
+    userbots = list(user["bots"])
+    added = [did for did in dids if not did in userbots]
+    if added:
+        userbots.extend(dict.fromkeys(added))  # Keep order, drop duplicates
+        users.upsert_by("userid", userid, {"bots": userbots})
+
+
+@_instrumented
+def user_login(userid, devid, token, dids):
+    # Everything a login changes, written to disk once
+    with db_batch():
+        user_add(userid)
+        user_add_device(userid, devid)
+        user_add_token(userid, token)
+        user_add_bots(userid, dids)
 
-        users.upsert({"bots": userbots}, User.userid == userid)
+    return user_get(userid)
 
 
+@_instrumented
 def user_remove_bot(userid, did):
-    opendb = db_get()
-    with opendb:
-        users = opendb.table("users")
-        User = Query()
-        user = users.get(User.userid == userid)
-        userbots = list(user["bots"])
-        if did in userbots:
-            userbots.remove(did)
+    users = db_get().table("users")
+    user = users.get_by("userid", userid)
+    userbots = list(user["bots"])
+    if did in userbots:
+        userbots.remove(did)
 
-        users.upsert({"bots": userbots}, User.userid == userid)
+    users.upsert_by("userid", userid, {"bots": userbots})
 
 
+@_instrumented
 def user_get_tokens(userid):
     tokens = db_get().table("tokens")
-    return tokens.search((Query().userid == userid))
+    return tokens.search_by("userid", userid)
 
 
+@_instrumented
 def user_get_token(userid, token):
     tokens = db_get().table("tokens")
-    return tokens.get((Query().userid == userid) & (Query().token == token))
-
+    for tmptoken in tokens.search_by("token", token):
+        if tmptoken["userid"] == userid:
+            return tmptoken
 
-def user_add_token(userid, token):
-    opendb = db_get()
-    with opendb:
-        tokens = opendb.table("tokens")
-        tmptoken = tokens.get((Query().userid == userid) & (Query().token == token))
-        if not tmptoken:
-            bumperlog.debug("Adding token {} for userid {}".format(token, userid))
-            tokens.insert(
-                {
-                    "userid": userid,
-                    "token": token,
-                    "expiration": "{}".format(
-                        datetime.now()
-                        + timedelta(seconds=bumper.token_validity_seconds)
-                    ),
-                }
-            )
+    return None
 
 
+@_instrumented
+def user_add_token(userid, token):
+    tokens = db_get().table("tokens")
+    tmptoken = user_get_token(userid, token)
+    if not tmptoken:
+        bumperlog.debug("Adding token {} for userid {}".format(token, userid))
+        tokens.insert(
+            {
+                "userid": userid,
+                "token": token,
+                "expiration": time.time() + bumper.token_validity_seconds,
+            }
+        )
+
+
+@_instrumented
 def user_revoke_all_tokens(userid):
-    opendb = db_get()
-    with opendb:
-        tokens = opendb.table("tokens")
-        tsearch = tokens.search(Query().userid == userid)
-        for i in tsearch:
-            tokens.remove(doc_ids=[i.doc_id])
+    tokens = db_get().table("tokens")
+    tokens.remove_by("userid", userid)
 
 
+@_instrumented
 def user_revoke_expired_tokens(userid):
-    opendb = db_get()
-    with opendb:
-        tokens = opendb.table("tokens")
-        tsearch = tokens.search(Query().userid == userid)
-        for i in tsearch:
-            if datetime.now() >= datetime.fromisoformat(i["expiration"]):
-                bumperlog.debug(
-                    "Removing token {} due to expiration".format(i["token"])
-                )
-                tokens.remove(doc_ids=[i.doc_id])
+    # Expiry only touches tokens that are due, so it's done for every user
+    revoke_expired_tokens()
 
 
+@_instrumented
 def user_revoke_token(userid, token):
-    opendb = db_get()
-    with opendb:
-        tokens = opendb.table("tokens")
-        tmptoken = tokens.get((Query().userid == userid) & (Query().token == token))
-        if tmptoken:
-            tokens.remove(doc_ids=[tmptoken.doc_id])
+    tokens = db_get().table("tokens")
+    tmptoken = user_get_token(userid, token)
+    if tmptoken:
+        tokens.remove([tmptoken.doc_id])
 
 
+@_instrumented
 def user_add_authcode(userid, token, authcode):
-    opendb = db_get()
-    with opendb:
-        tokens = opendb.table("tokens")
-        tmptoken = tokens.get((Query().userid == userid) & (Query().token == token))
-        if tmptoken:
-            tokens.upsert(
-                {"authcode": authcode},
-                ((Query().userid == userid) & (Query().token == token)),
-            )
+    tokens = db_get().table("tokens")
+    tmptoken = user_get_token(userid, token)
+    if tmptoken:
+        tokens.update({"authcode": authcode}, [tmptoken.doc_id])
 
 
+@_instrumented
 def user_revoke_authcode(userid, token, authcode):
-    opendb = db_get()
-    with opendb:
-        tokens = opendb.table("tokens")
-        tmptoken = tokens.get((Query().userid == userid) & (Query().token == token))
-        if tmptoken:
-            tokens.upsert(
-                {"authcode": ""},
-                ((Query().userid == userid) & (Query().token == token)),
-            )
+    tokens = db_get().table("tokens")
+    tmptoken = user_get_token(userid, token)
+    if tmptoken:
+        tokens.update({"authcode": ""}, [tmptoken.doc_id])
 
 
+@_instrumented
 def check_authcode(uid, authcode):
     bumperlog.debug("Checking for authcode: {}".format(authcode))
     tokens = db_get().table("tokens")
-    tmpauth = tokens.get(
-        (Query().authcode == authcode)
-        & (  # Match authcode
-            (Query().userid == uid.replace("fuid_", ""))
-            | (Query().userid == "fuid_{}".format(uid))
-        )  # Userid with or without fuid_
-    )
-    if tmpauth:
-        return True
+    userids = (uid.replace("fuid_", ""), "fuid_{}".format(uid))  # Userid with or without fuid_
+    for tmpauth in tokens.search_by("authcode", authcode):
+        if tmpauth["userid"] in userids:
+            return True
 
     return False
 
 
+@_instrumented
 def loginByItToken(authcode):
     bumperlog.debug("Checking for authcode: {}".format(authcode))
     tokens = db_get().table("tokens")
-    tmpauth = tokens.get(
-        (Query().authcode == authcode)
-        # & (  # Match authcode
-        #    (Query().userid == uid.replace("fuid_", ""))
-        #    | (Query().userid == "fuid_{}".format(uid))
-        # )  # Userid with or without fuid_
-    )
+    tmpauth = tokens.get_by("authcode", authcode)
     if tmpauth:
         return {"token": tmpauth["token"], "userid": tmpauth["userid"]}
 
     return {}
 
 
+@_instrumented
 def check_token(uid, token):
     bumperlog.debug("Checking for token: {}".format(token))
     tokens = db_get().table("tokens")
-    tmpauth = tokens.get(
-        (Query().token == token)
-        & (  # Match token
-            (Query().userid == uid.replace("fuid_", ""))
-            | (Query().userid == "fuid_{}".format(uid))
-        )  # Userid with or without fuid_
-    )
-    if tmpauth:
-        return True
+    userids = (uid.replace("fuid_", ""), "fuid_{}".format(uid))  # Userid with or without fuid_
+    for tmpauth in tokens.search_by("token", token):
+        if tmpauth["userid"] in userids:
+            return True
 
     return False
 
 
+@_instrumented
 def revoke_expired_tokens():
-    tokens = db_get().table("tokens").all()
-    for i in tokens:
-        if datetime.now() >= datetime.fromisoformat(i["expiration"]):
-            bumperlog.debug("Removing token {} due to expiration".format(i["token"]))
-            db_get().table("tokens").remove(doc_ids=[i.doc_id])
+    tokens = db_get().table("tokens")
+    for i in tokens.expire():
+        bumperlog.debug("Removing token {} due to expiration".format(i["token"]))
 
 
+@_instrumented
 def bot_add(sn, did, devclass, resource, company):
     newbot = VacBotDevice()
     newbot.did = did
@@ -277,17 +1181,22 @@ def bot_add(sn, did, devclass, resource, company):
             bot_full_upsert(newbot.asdict())
 
 
+@_instrumented
 def bot_remove(did):
     bots = db_get().table("bots")
-    bot = bot_get(did)
-    if bot:
-        bots.remove(doc_ids=[bot.doc_id])
+    bots.remove_by("did", did)
 
 
+@_instrumented
 def bot_get(did):
     bots = db_get().table("bots")
-    Bot = Query()
-    return bots.get(Bot.did == did)
+    return bots.get_by("did", did)
+
+
+@_instrumented
+def bot_get_all():
+    bots = db_get().table("bots")
+    return bots.all()
 
 
 def bot_toEcoVacsHome_JSON(bot):  # EcoVacs Home
@@ -301,58 +1210,348 @@ def bot_toEcoVacsHome_JSON(bot):  # EcoVacs Home
             )  # , indent=4)
 
 
+@_instrumented
 def bot_full_upsert(vacbot):
     bots = db_get().table("bots")
-    Bot = Query()
     if "did" in vacbot:
-        bots.upsert(vacbot, Bot.did == vacbot["did"])
+        bots.upsert_by("did", vacbot["did"], vacbot)
     else:
         bumperlog.error("No DID in vacbot: {}".format(vacbot))
 
 
+@_instrumented
 def bot_set_nick(did, nick):
     bots = db_get().table("bots")
-    Bot = Query()
-    bots.upsert({"nick": nick}, Bot.did == did)
+    bots.upsert_by("did", did, {"nick": nick})
 
 
+@_instrumented
 def bot_set_mqtt(did, mqtt):
     bots = db_get().table("bots")
-    Bot = Query()
-    bots.upsert({"mqtt_connection": mqtt}, Bot.did == did)
+    bots.upsert_by("did", did, {"mqtt_connection": mqtt})
 
 
+@_instrumented
 def client_add(userid, realm, resource):
     newclient = VacBotClient()
     newclient.userid = userid
     newclient.realm = realm
     newclient.resource = resource
+    newclient.last_seen = time.time()
 
     client = client_get(resource)
     if not client:
         bumperlog.info("Adding new client with resource {}".format(newclient.resource))
         client_full_upsert(newclient.asdict())
 
+
+@_instrumented
 def client_remove(resource):
     clients = db_get().table("clients")
-    client = client_get(resource)
-    if client:
-        clients.remove(doc_ids=[client.doc_id])
+    clients.remove_by("resource", resource)
+
 
+@_instrumented
 def client_get(resource):
     clients = db_get().table("clients")
-    Client = Query()
-    return clients.get(Client.resource == resource)
+    return clients.get_by("resource", resource)
+
+
+@_instrumented
+def client_get_all():
+    clients = db_get().table("clients")
+    return clients.all()
 
 
+@_instrumented
 def client_full_upsert(client):
     clients = db_get().table("clients")
-    Client = Query()
-    clients.upsert(client, Client.resource == client["resource"])
+    clients.upsert_by("resource", client["resource"], client)
 
 
+@_instrumented
 def client_set_mqtt(resource, mqtt):
     clients = db_get().table("clients")
-    Client = Query()
-    clients.upsert({"mqtt_connection": mqtt}, Client.resource == resource)
+    clients.upsert_by(
+        "resource", resource, {"mqtt_connection": mqtt, "last_seen": time.time()}
+    )
+
+
+@_instrumented
+def db_compact(client_max_idle_seconds=None):
+    # Remove clients not seen for client_max_idle_seconds, tokens of users that
+    # no longer exist and deleted bots from user bot lists, then rewrite the
+    # storage. Returns what was removed and the bytes reclaimed.
+    if client_max_idle_seconds is None:
+        client_max_idle_seconds = bumper.client_max_idle_seconds
+
+    db = db_get()
+    db.flush()
+    size_before = db.size()
+    now = time.time()
+    report = {"clients": 0, "tokens": 0, "user_bots": 0}
+    with db_batch():
+        clients = db.table("clients")
+        idle, unstamped = [], []
+        for client in clients.all():
+            if bumper.presence_registry.is_online(client["resource"]):
+                continue  # Connected now, the stored flag may be stale
+            if not client.get("last_seen"):
+                unstamped.append(client.doc_id)  # Idle time counts from now
+            elif now - client["last_seen"] > client_max_idle_seconds:
+                idle.append(client.doc_id)
+
+        if unstamped:
+            clients.update({"last_seen": now}, unstamped)
+        if idle:
+            clients.remove(idle)
+        report["clients"] = len(idle)
+
+        users = db.table("users")
+        userids = set(user["userid"] for user in users.all())
+        tokens = db.table("tokens")
+        orphans = [t.doc_id for t in tokens.all() if t.get("userid") not in userids]
+        if orphans:
+            tokens.remove(orphans)
+        report["tokens"] = len(orphans)
+
+        dids = set(bot["did"] for bot in db.table("bots").all())
+        updates = {}
+        for user in users.all():
+            userbots = [did for did in user.get("bots", []) if did in dids]
+            if len(userbots) < len(user.get("bots", [])):
+                updates[user.doc_id] = {"bots": userbots}
+                report["user_bots"] += len(user["bots"]) - len(userbots)
+        if updates:
+            users.update_multiple(updates)
+
+    db.compact()
+    report["records"] = report["clients"] + report["tokens"] + report["user_bots"]
+    report["bytes_before"] = size_before
+    report["bytes_after"] = db.size()
+    report["bytes_reclaimed"] = size_before - report["bytes_after"]
+    bumperlog.info("Database compacted: {}".format(report))
+    return report
+
+
+# Async API - storage work runs on a dedicated single-thread executor so the
+# event loop (and the MQTT broker on it) never waits on file I/O, and all
+# database access from coroutines is serialized.
+
+_executor = None
+
+
+def _db_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bumper-db")
+
+    return _executor
+
+
+async def async_db_call(func, *args):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_db_executor(), functools.partial(func, *args))
+
+
+async def async_db_batch(func, *args):
+    # Run func inside a db_batch on the database thread
+    def batch():
+        with db_batch():
+            return func(*args)
+
+    return await async_db_call(batch)
+
+
+async def async_db_backup(backup_dir=None, keep=None, compress=None):
+    # Only the in-memory snapshot holds the db thread; serializing and writing
+    # the file happen on the default executor while requests carry on
+    image = await async_db_call(db_snapshot)
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        None, db_write_backup, image, backup_dir, keep, compress
+    )
+
+
+async def async_db_restore(path):
+    return await async_db_call(db_restore, path)
+
+
+async def async_db_import(lines):
+    # Import NDJSON lines from an async iterable (e.g. a request body); only
+    # one batch is held in memory while it is written
+    importer = NDJSONImport()
+    async for line in lines:
+        batch = importer.feed(line)
+        if batch:
+            importer.applied(await async_db_call(db_import_records, batch))
+
+    importer.applied(await async_db_call(db_import_records, importer.take()))
+    bumperlog.info("Imported records: {}".format(importer.summary()))
+    return importer.summary()
+
+
+async def async_db_export():
+    # Async version of db_export(), reading a page at a time on the db thread
+    for rtype in db_record_types:
+        after = 0
+        while after is not None:
+            records, after = await async_db_call(db_export_page, rtype, after)
+            for record in records:
+                yield json.dumps(record) + "\n"
+
+
+async def async_db_compact(client_max_idle_seconds=None):
+    return await async_db_call(db_compact, client_max_idle_seconds)
+
+
+async def async_db_stats():
+    return await async_db_call(db_stats)
+
+
+async def async_db_flush():
+    return await async_db_call(db_flush)
+
+
+async def async_db_close():
+    return await async_db_call(db_close)
+
+
+async def async_user_add(userid):
+    return await async_db_call(user_add, userid)
+
+
+async def async_user_get(userid):
+    return await async_db_call(user_get, userid)
+
+
+async def async_user_by_deviceid(deviceid):
+    return await async_db_call(user_by_deviceid, deviceid)
+
+
+async def async_user_full_upsert(user):
+    return await async_db_call(user_full_upsert, user)
+
+
+async def async_user_add_device(userid, devid):
+    return await async_db_call(user_add_device, userid, devid)
+
+
+async def async_user_remove_device(userid, devid):
+    return await async_db_call(user_remove_device, userid, devid)
+
+
+async def async_user_add_bot(userid, did):
+    return await async_db_call(user_add_bot, userid, did)
+
+
+async def async_user_add_bots(userid, dids):
+    return await async_db_call(user_add_bots, userid, dids)
+
+
+async def async_user_login(userid, devid, token, dids):
+    return await async_db_call(user_login, userid, devid, token, dids)
+
+
+async def async_user_remove_bot(userid, did):
+    return await async_db_call(user_remove_bot, userid, did)
+
+
+async def async_user_get_tokens(userid):
+    return await async_db_call(user_get_tokens, userid)
+
+
+async def async_user_get_token(userid, token):
+    return await async_db_call(user_get_token, userid, token)
+
+
+async def async_user_add_token(userid, token):
+    return await async_db_call(user_add_token, userid, token)
+
+
+async def async_user_revoke_all_tokens(userid):
+    return await async_db_call(user_revoke_all_tokens, userid)
+
+
+async def async_user_revoke_expired_tokens(userid):
+    return await async_db_call(user_revoke_expired_tokens, userid)
+
+
+async def async_user_revoke_token(userid, token):
+    return await async_db_call(user_revoke_token, userid, token)
+
+
+async def async_user_add_authcode(userid, token, authcode):
+    return await async_db_call(user_add_authcode, userid, token, authcode)
+
+
+async def async_user_revoke_authcode(userid, token, authcode):
+    return await async_db_call(user_revoke_authcode, userid, token, authcode)
+
+
+async def async_check_authcode(uid, authcode):
+    return await async_db_call(check_authcode, uid, authcode)
+
+
+async def async_loginByItToken(authcode):
+    return await async_db_call(loginByItToken, authcode)
+
+
+async def async_check_token(uid, token):
+    return await async_db_call(check_token, uid, token)
+
+
+async def async_revoke_expired_tokens():
+    return await async_db_call(revoke_expired_tokens)
+
+
+async def async_bot_add(sn, did, devclass, resource, company):
+    return await async_db_call(bot_add, sn, did, devclass, resource, company)
+
+
+async def async_bot_remove(did):
+    return await async_db_call(bot_remove, did)
+
+
+async def async_bot_get(did):
+    return await async_db_call(bot_get, did)
+
+
+async def async_bot_get_all():
+    return await async_db_call(bot_get_all)
+
+
+async def async_bot_full_upsert(vacbot):
+    return await async_db_call(bot_full_upsert, vacbot)
+
+
+async def async_bot_set_nick(did, nick):
+    return await async_db_call(bot_set_nick, did, nick)
+
+
+async def async_bot_set_mqtt(did, mqtt):
+    return await async_db_call(bot_set_mqtt, did, mqtt)
+
+
+async def async_client_add(userid, realm, resource):
+    return await async_db_call(client_add, userid, realm, resource)
+
+
+async def async_client_remove(resource):
+    return await async_db_call(client_remove, resource)
+
+
+async def async_client_get(resource):
+    return await async_db_call(client_get, resource)
+
+
+async def async_client_get_all():
+    return await async_db_call(client_get_all)
+
+
+async def async_client_full_upsert(client):
+    return await async_db_call(client_full_upsert, client)
+
 
+async def async_client_set_mqtt(resource, mqtt):
+    return await async_db_call(client_set_mqtt, resource, mqtt)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+import bisect
+import functools
+import time
+
+
+class Histogram:
+    """Latency histogram (seconds) with fixed exponential buckets.
+
+    Cheap enough to update on every call; percentiles are estimated as the
+    upper bound of the bucket they fall in.
+    """
+
+    buckets = (
+        0.0001, 0.00025, 0.0005,
+        0.001, 0.0025, 0.005,
+        0.01, 0.025, 0.05,
+        0.1, 0.25, 0.5,
+        1, 2.5, 5,
+        10, 25, 60,
+    )
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)  # Last is overflow
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, pct):
+        if not self.count:
+            return None
+
+        rank = pct / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+
+        return self.max
+
+    def asdict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "buckets": {
+                str(bound): count
+                for bound, count in zip(self.buckets + ("inf",), self.counts)
+                if count
+            },
+        }
+
+
+class CallMetrics:
+    """Call counts, errors and latency histograms per function name."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = {}
+
+    def observe(self, name, seconds, error=False):
+        stats = self.calls.get(name)
+        if stats is None:
+            stats = self.calls[name] = {"calls": 0, "errors": 0, "latency": Histogram()}
+
+        stats["calls"] += 1
+        if error:
+            stats["errors"] += 1
+        stats["latency"].observe(seconds)
+
+    def timed(self, func):
+        # Decorator recording every call of func
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            error = True
+            try:
+                result = func(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                self.observe(func.__name__, time.perf_counter() - start, error)
+
+        return wrapper
+
+    def asdict(self):
+        return {
+            name: {
+                "calls": stats["calls"],
+                "errors": stats["errors"],
+                "latency": stats["latency"].asdict(),
+            }
+            for name, stats in sorted(self.calls.items())
+        }
+
+
+class CommandLatency:
+    """Bot response latency histograms, per (bot class, cmdName) and per did.
+
+    timeout() derives a command's response timeout from a high percentile of
+    what was observed for that kind of command (or that bot), clamped to a
+    floor and ceiling; without enough samples the default is used.
+    """
+
+    def __init__(self, percentile=99, multiplier=2, floor=1, ceiling=10, min_samples=20):
+        self.percentile = percentile
+        self.multiplier = multiplier  # Headroom over the observed percentile
+        self.floor = floor
+        self.ceiling = ceiling
+        self.min_samples = min_samples
+        self.reset()
+
+    def reset(self):
+        self.commands = {}  # (class, cmdName) -> Histogram
+        self.bots = {}  # did -> Histogram
+        self.timeouts = {}  # (class, cmdName) -> count
+
+    def _histograms(self, cmdjson):
+        command = (cmdjson.get("toType"), cmdjson.get("cmdName"))
+        if command not in self.commands:
+            self.commands[command] = Histogram()
+        if cmdjson.get("toId") not in self.bots:
+            self.bots[cmdjson.get("toId")] = Histogram()
+        return command, self.commands[command], self.bots[cmdjson.get("toId")]
+
+    def observe(self, cmdjson, seconds, timedout=False):
+        # Timeouts are observed at the timeout applied, so slow bots raise
+        # their own; cancelled commands aren't observed at all
+        command, by_command, by_bot = self._histograms(cmdjson)
+        by_command.observe(seconds)
+        by_bot.observe(seconds)
+        if timedout:
+            self.timeouts[command] = self.timeouts.get(command, 0) + 1
+
+    def timeout(self, cmdjson, default):
+        for histogram in (
+            self.commands.get((cmdjson.get("toType"), cmdjson.get("cmdName"))),
+            self.bots.get(cmdjson.get("toId")),
+        ):
+            if histogram is not None and histogram.count >= self.min_samples:
+                estimate = histogram.percentile(self.percentile) * self.multiplier
+                return min(self.ceiling, max(self.floor, estimate))
+
+        return default
+
+    def asdict(self):
+        return {
+            "commands": {
+                "{}/{}".format(botclass, cmdname): dict(
+                    histogram.asdict(),
+                    timeouts=self.timeouts.get((botclass, cmdname), 0),
+                    timeout=self.timeout(
+                        {"toType": botclass, "cmdName": cmdname}, None
+                    ),
+                )
+                for (botclass, cmdname), histogram in sorted(
+                    self.commands.items(), key=lambda item: str(item[0])
+                )
+            },
+            "bots": {did: histogram.asdict() for did, histogram in self.bots.items()},
+        }
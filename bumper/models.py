@@ -50,6 +50,7 @@ class VacBotClient(object):
         self.realm = realm
         self.resource = token
         self.mqtt_connection = False
+        self.last_seen = 0.0  # Epoch time of the last connect/disconnect
 
     def asdict(self):
         return {
@@ -57,6 +58,7 @@ class VacBotClient(object):
             "realm": self.realm,
             "resource": self.resource,
             "mqtt_connection": self.mqtt_connection,
+            "last_seen": self.last_seen,
         }
 
 
@@ -10,25 +10,111 @@ from hbmqtt.mqtt.constants import QOS_0, QOS_1, QOS_2
 import pkg_resources
 import time
 import bumper
+import itertools
 import json
-from datetime import datetime, timedelta
+import random
+import string
+import zlib
+from collections import OrderedDict
 import bumper
+from bumper.metrics import CommandLatency
 from passlib.apps import custom_app_context as pwd_context
 
 helperbotlog = logging.getLogger("helperbot")
 boterrorlog = logging.getLogger("boterror")
 mqttserverlog = logging.getLogger("mqttserver")
 
+def _letters(number, width=6):
+    # number in base 52 using ascii letters, padded to width
+    digits = []
+    while number or len(digits) < width:
+        number, digit = divmod(number, len(string.ascii_letters))
+        digits.append(string.ascii_letters[digit])
+    return "".join(reversed(digits))
+
+
+# Starts at a random offset so ids don't repeat those of a previous run, which
+# bots may still be answering
+_request_ids = itertools.count(random.randrange(52 ** 5))
+
+
 class MQTTHelperBot:
 
     Client = None
-    wait_resp_timeout_seconds = 10
+    wait_resp_timeout_seconds = 10  # Until latency of a command is known
     expire_msg_seconds = 10
+    max_unclaimed_responses = 1000
+    latency = CommandLatency()  # Shared by all helperbots, sets response timeouts
 
-    def __init__(self, address):
+    def __init__(self, address, client_id="helperbot@bumper/helperbot"):
         self.address = address
-        self.client_id = "helperbot@bumper/helperbot"
-        self.command_responses = []
+        self.client_id = client_id
+        self.broadcasts = True  # Also subscribe to broadcasts, not only responses
+        self.pending = {}  # requestid -> Future of the command's response
+        # Responses nobody was waiting for yet, oldest first
+        self.command_responses = OrderedDict()
+        self._expire_timer = None
+        self._reconnecting = False
+        # Health
+        self.connects = 0
+        self.commands = 0
+        self.responses = 0
+        self.errors = 0
+        self.last_error = None
+
+    @staticmethod
+    def new_request_id():
+        # Unique letters-only id for a command (request ids are topic levels)
+        return _letters(next(_request_ids))
+
+    @property
+    def resource(self):
+        return self.client_id.split("/")[-1]
+
+    @property
+    def state(self):
+        if self.Client is None or self.Client.session is None:
+            return "not_started"
+        return self.Client.session.transitions.state
+
+    def is_connected(self):
+        return self.Client is not None and self.Client._connected_state.is_set()
+
+    def needs_reconnect(self):
+        # Disconnected and hbmqtt isn't already trying to reconnect
+        if self.is_connected() or self._reconnecting:
+            return False
+        if self.Client is None:
+            return True
+        closing = self.Client._disconnect_task
+        return closing is None or closing.done()
+
+    async def reconnect(self):
+        self._reconnecting = True
+        try:
+            helperbotlog.info("Reconnecting helperbot {}".format(self.client_id))
+            await self.start_helper_bot()
+        finally:
+            self._reconnecting = False
+
+    def health(self):
+        return {
+            "client_id": self.client_id,
+            "state": self.state,
+            "connects": self.connects,
+            "commands": self.commands,
+            "responses": self.responses,
+            "errors": self.errors,
+            "pending": len(self.pending),
+            "last_error": self.last_error,
+        }
+
+    def status(self):
+        return [self.health()]
+
+    async def disconnect(self):
+        if self.is_connected():
+            await self.Client.disconnect()
 
     async def start_helper_bot(self):
 
@@ -42,13 +128,13 @@ class MQTTHelperBot:
                 "mqtts://{}:{}/".format(self.address[0], self.address[1]),
                 cafile=bumper.ca_cert,
             )
-            await self.Client.subscribe(
-                [
-                    ("iot/p2p/+/+/+/+/helperbot/bumper/helperbot/+/+/+", QOS_0),
-                    ("iot/p2p/+", QOS_0),
-                    ("iot/atr/+", QOS_0),
-                ]
-            )
+            subscriptions = [
+                ("iot/p2p/+/+/+/+/helperbot/bumper/{}/+/+/+".format(self.resource), QOS_0)
+            ]
+            if self.broadcasts:
+                subscriptions += [("iot/p2p/+", QOS_0), ("iot/atr/+", QOS_0)]
+            await self.Client.subscribe(subscriptions)
+            self.connects += 1
 
 #        except ConnectionRefusedError as e:
 #            helperbotlog.Error(e)
@@ -62,84 +148,310 @@ class MQTTHelperBot:
 #            pass
 
         except Exception as e:
+            self.errors += 1
+            self.last_error = "{}".format(e)
             helperbotlog.exception("{}".format(e))
 
-    async def wait_for_resp(self, requestid):
+    def handle_response(self, topic, payload):
+        # Called by the broker plugin for .../helperbot/bumper/helperbot/p/{requestid}/{j|x}
+        topic = str(topic).split("/")
+        requestid = topic[10]
+        self.responses += 1
+        future = self.pending.get(requestid)
+        if future is not None and not future.done():
+            future.set_result(self._response(requestid, topic[11], payload))
+        else:
+            self.store_response(requestid, "/".join(topic), payload)
+
+    def store_response(self, requestid, topic, payload):
+        # Keep an unclaimed response until it's claimed or expires
+        responses = self.command_responses
+        responses.pop(requestid, None)  # A repeat moves to the back
+        responses[requestid] = {"time": time.time(), "topic": topic, "payload": payload}
+        while len(responses) > self.max_unclaimed_responses:
+            requestid, msg = responses.popitem(last=False)
+            helperbotlog.debug(
+                "Dropping Unclaimed Message - Message Topic: {}".format(msg["topic"])
+            )
+
+        self._schedule_expiry()
+
+    def _schedule_expiry(self):
+        # One timer, due when the oldest response expires
+        if self._expire_timer is None and self.command_responses:
+            oldest = next(iter(self.command_responses.values()))
+            delay = oldest["time"] + self.expire_msg_seconds - time.time()
+            self._expire_timer = asyncio.get_event_loop().call_later(
+                max(0, delay), self.expire_responses
+            )
+
+    def expire_responses(self):
+        self._expire_timer = None
+        now = time.time()
+        responses = self.command_responses
+        while responses:
+            requestid, msg = next(iter(responses.items()))
+            if msg["time"] + self.expire_msg_seconds > now:
+                break
+
+            del responses[requestid]
+            helperbotlog.debug(
+                "Pruning Message Due To Expiration - Message Topic: {}".format(
+                    msg["topic"]
+                )
+            )
+
+        self._schedule_expiry()
+
+    def _response(self, requestid, payloadtype, payload):
+        if payloadtype == "j":
+            payload = json.loads(payload)
+        return {"id": requestid, "ret": "ok", "resp": payload}
+
+    def _timeout(self, requestid):
+        return {
+            "id": requestid,
+            "errno": 500,
+            "ret": "fail",
+            "debug": "wait for response timed out",
+        }
+
+    def expect_resp(self, requestid):
+        # Register for a response, before the command is sent so it can't be missed
+        future = self.pending.get(requestid)
+        if future is None:
+            future = self.pending[requestid] = asyncio.get_event_loop().create_future()
+
+        msg = self.command_responses.pop(requestid, None)
+        if msg is not None:  # Response arrived first
+            topic = msg["topic"].split("/")
+            future.set_result(self._response(requestid, topic[11], msg["payload"]))
+
+        return future
+
+    def response_timeout(self, cmdjson):
+        return self.latency.timeout(cmdjson, self.wait_resp_timeout_seconds)
+
+    async def wait_for_resp(self, requestid, timeout=None):
         try:
+            return await asyncio.wait_for(
+                self.expect_resp(requestid), timeout or self.wait_resp_timeout_seconds
+            )
 
-            t_end = (
-                datetime.now() + timedelta(seconds=self.wait_resp_timeout_seconds)
-            ).timestamp()
-
-            while time.time() < t_end:
-                await asyncio.sleep(0.1)
-                if len(self.command_responses) > 0:
-                    for msg in self.command_responses:
-                        topic = str(msg["topic"]).split("/")
-                        if topic[6] == "helperbot" and topic[10] == requestid:
-                            if topic[11] == "j":
-                                resppayload = json.loads(msg["payload"])
-                            else:
-                                resppayload = str(msg["payload"])
-                            resp = {"id": requestid, "ret": "ok", "resp": resppayload}
-                            self.command_responses.remove(msg)
-                            return resp
-
-            return {
-                "id": requestid,
-                "errno": 500,
-                "ret": "fail",
-                "debug": "wait for response timed out",
-            }
-        except asyncio.CancelledError as e:
+        except asyncio.TimeoutError:
+            return self._timeout(requestid)
+
+        except asyncio.CancelledError:
             helperbotlog.debug("wait_for_resp cancelled by asyncio")
-            return {
-                "id": requestid,
-                "errno": 500,
-                "ret": "fail",
-                "debug": "wait for response timed out",
-            }
+            raise  # The caller went away, the bot didn't time out
+
         except Exception as e:
             helperbotlog.exception("{}".format(e))
-            return {
-                "id": requestid,
-                "errno": 500,
-                "ret": "fail",
-                "debug": "wait for response timed out",
-            }
+            return self._timeout(requestid)
+
+        finally:
+            self.pending.pop(requestid, None)
+
+    async def publish(self, topic, data):
+        await self.Client.publish(topic, data, QOS_0)
+
+    async def _publish_command(self, cmdjson, requestid):
+        ttopic = "iot/p2p/{}/helperbot/bumper/{}/{}/{}/{}/q/{}/{}".format(
+            cmdjson["cmdName"],
+            self.resource,
+            cmdjson["toId"],
+            cmdjson["toType"],
+            cmdjson["toRes"],
+            requestid,
+            cmdjson["payloadType"],
+        )
+        self.expect_resp(requestid)
+        self.commands += 1
+        try:
+            if cmdjson["payloadType"] == "x":
+                await self.publish(ttopic, str(cmdjson["payload"]).encode())
+
+            if cmdjson["payloadType"] == "j":
+                await self.publish(ttopic, json.dumps(cmdjson["payload"]).encode())
+
+        except Exception as e:
+            self.errors += 1
+            self.last_error = "{}".format(e)
+            helperbotlog.exception("{}".format(e))
+
+    async def _wait_command(self, cmdjson, requestid, start):
+        # Cancelled waits raise before anything is recorded
+        timeout = self.response_timeout(cmdjson)
+        resp = await self.wait_for_resp(requestid, timeout)
+        if resp.get("ret") == "fail" and resp.get("errno") == 500:
+            self.latency.observe(cmdjson, timeout, timedout=True)
+        else:
+            self.latency.observe(cmdjson, time.perf_counter() - start)
+        return resp
 
     async def send_command(self, cmdjson, requestid):
-        if not self.Client._handler.writer is None:
-            try:
-                ttopic = "iot/p2p/{}/helperbot/bumper/helperbot/{}/{}/{}/q/{}/{}".format(
-                    cmdjson["cmdName"],
-                    cmdjson["toId"],
-                    cmdjson["toType"],
-                    cmdjson["toRes"],
-                    requestid,
-                    cmdjson["payloadType"],
+        if not self.is_connected():
+            return self._not_connected(requestid)
+
+        try:
+            await self._publish_command(cmdjson, requestid)
+            resp = await self._wait_command(cmdjson, requestid, time.perf_counter())
+
+            return resp
+
+        except asyncio.CancelledError:
+            self.pending.pop(requestid, None)
+            raise
+
+        except Exception as e:
+            helperbotlog.exception("{}".format(e))
+            self.pending.pop(requestid, None)
+            return {}
+
+    async def send_commands(self, cmdjsons, requestids):
+        # Publish all commands back to back, then wait for the responses together
+        if not self.is_connected():
+            return [self._not_connected(requestid) for requestid in requestids]
+
+        try:
+            start = time.perf_counter()
+            for cmdjson, requestid in zip(cmdjsons, requestids):
+                await self._publish_command(cmdjson, requestid)
+
+            return await asyncio.gather(
+                *(
+                    self._wait_command(cmdjson, requestid, start)
+                    for cmdjson, requestid in zip(cmdjsons, requestids)
                 )
-                try:
-                    if cmdjson["payloadType"] == "x":
-                        await self.Client.publish(
-                            ttopic, str(cmdjson["payload"]).encode(), QOS_0
-                        )
+            )
 
-                    if cmdjson["payloadType"] == "j":
-                        await self.Client.publish(
-                            ttopic, json.dumps(cmdjson["payload"]).encode(), QOS_0
-                        )
+        except asyncio.CancelledError:
+            for requestid in requestids:
+                self.pending.pop(requestid, None)
+            raise
+
+        except Exception as e:
+            helperbotlog.exception("{}".format(e))
+            for requestid in requestids:
+                self.pending.pop(requestid, None)
+            return [{} for requestid in requestids]
+
+    def _not_connected(self, requestid):
+        return {
+            "id": requestid,
+            "errno": 503,
+            "ret": "fail",
+            "debug": "helperbot not connected",
+        }
+
+
+class MQTTHelperBotInProcess(MQTTHelperBot):
+    """Helperbot that publishes commands straight into the embedded broker.
+
+    Skips the TLS loopback connection: commands are handed to the broker's
+    broadcast queue, responses still arrive through BumperMQTTServer_Plugin.
+    """
+
+    def __init__(self, broker, client_id="helperbot@bumper/helperbot"):
+        super().__init__(None, client_id)
+        self.broker = broker
+
+    @property
+    def state(self):
+        if self.broker.transitions.state == "started":
+            return "connected"
+        return self.broker.transitions.state
+
+    def is_connected(self):
+        return self.broker.transitions.state == "started"
+
+    def needs_reconnect(self):
+        return False  # Nothing to reconnect, the broker is in this process
+
+    async def start_helper_bot(self):
+        self.connects += 1
+
+    async def disconnect(self):
+        pass
+
+    async def publish(self, topic, data):
+        # The plugin doesn't see internal messages, log like a client publish
+        helperbotlog.debug(
+            "Send Command - Topic: {} - Message: {}".format(topic, data.decode("utf-8"))
+        )
+        await self.broker.internal_message_broadcast(topic, data)
+
+
+class MQTTHelperBotPool:
+    """Several helperbot connections, with commands sharded over them by did.
+
+    Member 0 is the original helperbot@bumper/helperbot client, the others
+    use resources helperbot1, helperbot2, ... Bots reply to the resource a
+    command came from, which routes each response back to its member.
+    """
+
+    def __init__(self, address, size=1):
+        self.address = address
+        self.members = []
+        for i in range(max(1, size)):
+            resource = "helperbot{}".format(i) if i else "helperbot"
+            member = MQTTHelperBot(address, "helperbot@bumper/{}".format(resource))
+            member.broadcasts = i == 0  # One subscriber is enough
+            self.members.append(member)
+        self._by_resource = {member.resource: member for member in self.members}
+
+    new_request_id = staticmethod(MQTTHelperBot.new_request_id)
+
+    @property
+    def Client(self):
+        return self.members[0].Client
 
-                except Exception as e:
-                    helperbotlog.exception("{}".format(e))
+    @property
+    def client_id(self):
+        return self.members[0].client_id
 
-                resp = await self.wait_for_resp(requestid)
+    async def start_helper_bot(self):
+        await asyncio.gather(*(member.start_helper_bot() for member in self.members))
+
+    async def disconnect(self):
+        await asyncio.gather(*(member.disconnect() for member in self.members))
+
+    def is_connected(self):
+        return any(member.is_connected() for member in self.members)
+
+    def status(self):
+        return [member.health() for member in self.members]
+
+    def member_for(self, did):
+        # The member a did hashes to, or the next connected one while it's down
+        first = zlib.crc32(str(did).encode()) % len(self.members)
+        for offset in range(len(self.members)):
+            member = self.members[(first + offset) % len(self.members)]
+            if member.is_connected():
+                return member
+            if member.needs_reconnect():
+                asyncio.ensure_future(member.reconnect())
+
+        return None
 
-                return resp
+    async def send_command(self, cmdjson, requestid):
+        member = self.member_for(cmdjson["toId"])
+        if member is None:
+            return self.members[0]._not_connected(requestid)
+        return await member.send_command(cmdjson, requestid)
+
+    async def send_commands(self, cmdjsons, requestids):
+        # All to the same bot, so to the same member
+        member = self.member_for(cmdjsons[0]["toId"])
+        if member is None:
+            return [self.members[0]._not_connected(requestid) for requestid in requestids]
+        return await member.send_commands(cmdjsons, requestids)
 
-            except Exception as e:
-                helperbotlog.exception("{}".format(e))
-                return {}
+    def handle_response(self, topic, payload):
+        resource = str(topic).split("/")[8]
+        self._by_resource.get(resource, self.members[0]).handle_response(
+            topic, payload
+        )
 
 
 class MQTTServer:
@@ -247,7 +559,7 @@ class BumperMQTTServer_Plugin:
                     "ecouser" in didsplit[1] or "bumper" in didsplit[1]
                 ):
                     tmpbotdetail = str(didsplit[1]).split("/")
-                    bumper.bot_add(
+                    await bumper.async_bot_add(
                         username,
                         didsplit[0],
                         tmpbotdetail[0],
@@ -268,13 +580,13 @@ class BumperMQTTServer_Plugin:
                         authenticated = True
                     else:
                         auth = False
-                        if bumper.check_authcode(didsplit[0], password):
+                        if await bumper.async_check_authcode(didsplit[0], password):
                             auth = True
                         elif bumper.use_auth == False:
                             auth = True
 
                         if auth:
-                            bumper.client_add(userid, realm, resource)
+                            await bumper.async_client_add(userid, realm, resource)
                             mqttserverlog.info(f"Bumper Authentication Success - Client - Username: {username} - ClientID: {client_id}")
                             authenticated = True
 
@@ -330,92 +642,71 @@ class BumperMQTTServer_Plugin:
     async def on_broker_client_connected(self, client_id):
 
         didsplit = str(client_id).split("@")
+        session = self.context._broker_instance._sessions.get(client_id, (None,))[0]
 
-        bot = bumper.bot_get(didsplit[0])
+        # Presence is kept in memory, bumper.maintenance() writes it to the db
+        bot = await bumper.async_bot_get(didsplit[0])
         if bot:
-            bumper.bot_set_mqtt(bot["did"], True)
+            bumper.presence_registry.connected(bot["did"], "bot", client_id, session)
+            bumper.bot_commands.bot_connected(bot["did"])
             return
 
         clientresource = didsplit[1].split("/")[1]
-        client = bumper.client_get(clientresource)
+        client = await bumper.async_client_get(clientresource)
         if client:
-            bumper.client_set_mqtt(client["resource"], True)
+            bumper.presence_registry.connected(
+                client["resource"], "client", client_id, session
+            )
             return
 
     async def on_broker_message_received(self, client_id, message):
+        bumper.presence_registry.touch(client_id)
         self.handle_helperbot_msg(client_id, message)
         
     def handle_helperbot_msg(self, client_id, message):
 
-            if str(message.topic).split("/")[6] == "helperbot":
+            topic = str(message.topic).split("/")
+            payload = str(message.data.decode("utf-8"))
+            if topic[6] == "helperbot":
                 # Response to command
                 helperbotlog.debug(
                     "Received Response - Topic: {} - Message: {}".format(
-                        message.topic, str(message.data.decode("utf-8"))
+                        message.topic, payload
                     )
                 )
-                bumper.mqtt_helperbot.command_responses.append(
-                    {
-                        "time": time.time(),
-                        "topic": message.topic,
-                        "payload": str(message.data.decode("utf-8")),
-                    }
-                )
-            elif str(message.topic).split("/")[3] == "helperbot":
+                bumper.mqtt_helperbot.handle_response(message.topic, payload)
+            elif topic[3] == "helperbot":
                 # Helperbot sending command
                 helperbotlog.debug(
                     "Send Command - Topic: {} - Message: {}".format(
-                        message.topic, str(message.data.decode("utf-8"))
+                        message.topic, payload
                     )
                 )
-            elif str(message.topic).split("/")[1] == "atr":
+            elif topic[1] == "atr":
                 # Broadcast message received on atr
-                if str(message.topic).split("/")[2] == "errors":
+                if topic[2] == "errors":
                     boterrorlog.error(
                         "Received Error - Topic: {} - Message: {}".format(
-                            message.topic, str(message.data.decode("utf-8"))
+                            message.topic, payload
                         )
                     )
                 else:
                     helperbotlog.debug(
                         "Received Broadcast - Topic: {} - Message: {}".format(
-                            message.topic, str(message.data.decode("utf-8"))
+                            message.topic, payload
                         )
                     )
+                    bumper.bot_commands.state.broadcast(message.topic, payload)
 
             else:
                 helperbotlog.debug(
                     "Received Message - Topic: {} - Message: {}".format(
-                        message.topic, str(message.data.decode("utf-8"))
+                        message.topic, payload
                     )
                 )
 
-            # Cleanup "expired messages" > 60 seconds from time
-            for msg in bumper.mqtt_helperbot.command_responses:
-                expire_time = (
-                    datetime.fromtimestamp(msg["time"])
-                    + timedelta(seconds=bumper.mqtt_helperbot.expire_msg_seconds)
-                ).timestamp()
-                if time.time() > expire_time:
-                    helperbotlog.debug(
-                        "Pruning Message Due To Expiration - Message Topic: {}".format(
-                            msg["topic"]
-                        )
-                    )
-                    bumper.mqtt_helperbot.command_responses.remove(msg)
-
 
     async def on_broker_client_disconnected(self, client_id):
-
-        didsplit = str(client_id).split("@")
-
-        bot = bumper.bot_get(didsplit[0])
-        if bot:
-            bumper.bot_set_mqtt(bot["did"], False)
-            return
-
-        clientresource = didsplit[1].split("/")[1]
-        client = bumper.client_get(clientresource)
-        if client:
-            bumper.client_set_mqtt(client["resource"], False)
-            return
+        entry = bumper.presence_registry.disconnected_client(client_id)
+        if entry is not None and entry["kind"] == "bot":
+            bumper.bot_commands.bot_disconnected(entry["key"])
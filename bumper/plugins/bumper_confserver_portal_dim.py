@@ -7,8 +7,6 @@ import bumper
 from bumper.models import *
 from bumper import plugins
 from datetime import datetime, timedelta
-import string
-import random
 
 
 class portal_api_dim(plugins.ConfServerApp):
@@ -30,17 +28,19 @@ class portal_api_dim(plugins.ConfServerApp):
         try:
             json_body = json.loads(await request.text())
 
-            randomid = "".join(random.sample(string.ascii_letters, 6))
+            randomid = bumper.mqtt_helperbot.new_request_id()
             did = ""
             if "toId" in json_body:  # Its a command
                 did = json_body["toId"]
 
             if did != "":
-                bot = bumper.bot_get(did)
-                if bot["company"] == "eco-ng" and bot["mqtt_connection"] == True:
-                    retcmd = await bumper.mqtt_helperbot.send_command(
-                        json_body, randomid
-                    )
+                bot = await bumper.async_bot_get(did)
+                if (
+                    bot
+                    and bot["company"] == "eco-ng"
+                    and bumper.presence_registry.is_online(did)
+                ):
+                    retcmd = await bumper.bot_commands.send(json_body, randomid)
                     body = retcmd
                     logging.debug("Send Bot - {}".format(json_body))
                     logging.debug("Bot Response - {}".format(body))
@@ -7,8 +7,6 @@ import bumper
 from bumper.models import *
 from bumper import plugins
 from datetime import datetime, timedelta
-import string
-import random
 
 class portal_api_iot(plugins.ConfServerApp):
 
@@ -20,6 +18,7 @@ class portal_api_iot(plugins.ConfServerApp):
         self.routes = [
  
             web.route("*", "/iot/devmanager.do", self.handle_devmanager_botcommand, name="portal_api_iot_devmanager"),
+            web.route("*", "/iot/devmanager_batch.do", self.handle_devmanager_batch, name="portal_api_iot_devmanager_batch"),
 
         ]
 
@@ -29,17 +28,15 @@ class portal_api_iot(plugins.ConfServerApp):
         try:
             json_body = json.loads(await request.text())
 
-            randomid = "".join(random.sample(string.ascii_letters, 4))
+            randomid = bumper.mqtt_helperbot.new_request_id()
             did = ""
             if "toId" in json_body:  # Its a command
                 did = json_body["toId"]
 
             if did != "":
-                bot = bumper.bot_get(did)
+                bot = await bumper.async_bot_get(did)
                 if bot["company"] == "eco-ng":
-                    retcmd = await bumper.mqtt_helperbot.send_command(
-                        json_body, randomid
-                    )
+                    retcmd = await bumper.bot_commands.send(json_body, randomid)
                     body = retcmd
                     logging.debug("Send Bot - {}".format(json_body))
                     logging.debug("Bot Response - {}".format(body))
@@ -77,5 +74,29 @@ class portal_api_iot(plugins.ConfServerApp):
         except Exception as e:
             logging.exception("{}".format(e))
 
+    async def handle_devmanager_batch(self, request):
+        # Several commands for one bot: {"toId", "toType", "toRes", "cmds": [{"cmdName", "payloadType", "payload", ...}]}
+        try:
+            json_body = json.loads(await request.text())
+            cmds = json_body.pop("cmds", [])
+            did = json_body.get("toId", "")
+
+            bot = await bumper.async_bot_get(did) if did != "" else None
+            if bot and bot["company"] == "eco-ng" and cmds:
+                cmdjsons = [dict(json_body, **cmd) for cmd in cmds]
+                resps = await bumper.bot_commands.send_batch(cmdjsons)
+                body = {"ret": "ok", "resps": resps}
+                logging.debug("Send Bot Batch - {}".format(cmdjsons))
+                logging.debug("Bot Batch Response - {}".format(body))
+                return web.json_response(body)
+
+            else:
+                logging.error("No bots with DID: {} connected to MQTT".format(did))
+                body = {"ret": "fail", "errno": bumper.ERR_COMMON, "resps": []}
+                return web.json_response(body)
+
+        except Exception as e:
+            logging.exception("{}".format(e))
+
 plugin = portal_api_iot()
 
@@ -8,8 +8,6 @@ from bumper.models import *
 from bumper import plugins
 from datetime import datetime, timedelta
 import os
-import string
-import random
 import xml.etree.ElementTree as ET
 
 class portal_api_lg(plugins.ConfServerApp):
@@ -31,10 +29,10 @@ class portal_api_lg(plugins.ConfServerApp):
         try:
             json_body = json.loads(await request.text())
 
-            randomid = "".join(random.sample(string.ascii_letters, 6))
+            randomid = bumper.mqtt_helperbot.new_request_id()
             did = json_body["did"]
 
-            botdetails = bumper.bot_get(did)
+            botdetails = await bumper.async_bot_get(did)
             if botdetails:
                 if not "cmdName" in json_body:
                     if "td" in json_body:
@@ -59,11 +57,9 @@ class portal_api_lg(plugins.ConfServerApp):
                         json_body["payload"] = '<ctl count="30"/>'
 
             if did != "":
-                bot = bumper.bot_get(did)
+                bot = await bumper.async_bot_get(did)
                 if bot["company"] == "eco-ng":                    
-                    retcmd = await bumper.mqtt_helperbot.send_command(
-                        json_body, randomid
-                    )
+                    retcmd = await bumper.bot_commands.send(json_body, randomid)
                     body = retcmd
                     logging.debug("Send Bot - {}".format(json_body))
                     logging.debug("Bot Response - {}".format(body))
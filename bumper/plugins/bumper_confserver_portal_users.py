@@ -67,7 +67,7 @@ class portal_api_users(plugins.ConfServerApp):
 
                 elif todo == "loginByItToken":
                     if "userId" in postbody:
-                        if bumper.check_authcode(postbody["userId"], postbody["token"]):
+                        if await bumper.async_check_authcode(postbody["userId"], postbody["token"]):
                             body = {
                                 "resource": postbody["resource"],
                                 "result": "ok",
@@ -76,7 +76,7 @@ class portal_api_users(plugins.ConfServerApp):
                                 "userId": postbody["userId"],
                             }
                     else:  # EcoVacs Home LoginByITToken
-                        loginToken = bumper.loginByItToken(postbody["token"])
+                        loginToken = await bumper.async_loginByItToken(postbody["token"])
                         if not loginToken == {}:
                             body = {
                                 "resource": postbody["resource"],
@@ -90,21 +90,21 @@ class portal_api_users(plugins.ConfServerApp):
 
                 elif todo == "GetDeviceList":
                     body = {
-                        "devices": bumper.db_get().table("bots").all(),
+                        "devices": await bumper.async_bot_get_all(),
                         "result": "ok",
                         "todo": "result",
                     }
 
                 elif todo == "SetDeviceNick":
-                    bumper.bot_set_nick(postbody["did"], postbody["nick"])
+                    await bumper.async_bot_set_nick(postbody["did"], postbody["nick"])
                     body = {"result": "ok", "todo": "result"}
 
                 elif todo == "AddOneDevice":
-                    bumper.bot_set_nick(postbody["did"], postbody["nick"])
+                    await bumper.async_bot_set_nick(postbody["did"], postbody["nick"])
                     body = {"result": "ok", "todo": "result"}
 
                 elif todo == "DeleteOneDevice":
-                    bumper.bot_remove(postbody["did"])
+                    await bumper.async_bot_remove(postbody["did"])
                     body = {"result": "ok", "todo": "result"}
 
                 return web.json_response(body)
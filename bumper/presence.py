@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+import logging
+import time
+import bumper
+
+mqttserverlog = logging.getLogger("mqttserver")
+
+
+class PresenceRegistry:
+    """Live MQTT sessions of bots (by did) and clients (by resource).
+
+    Kept in memory and updated by the broker plugin, so checking whether a
+    bot is online doesn't touch the database. Changes are written to the
+    mqtt_connection field of the bots/clients tables by snapshot().
+    """
+
+    def __init__(self):
+        self._entries = {}  # did/resource -> session metadata
+        self._client_ids = {}  # MQTT client_id -> did/resource
+        self._dirty = {}  # did/resource -> (kind, online) not yet snapshotted
+
+    def connected(self, key, kind, client_id, session=None):
+        now = time.time()
+        previous = self._entries.get(key)
+        if previous is not None:  # Reconnected before the old session closed
+            self._client_ids.pop(previous["client_id"], None)
+
+        self._entries[key] = {
+            "key": key,
+            "kind": kind,
+            "client_id": client_id,
+            "connected": now,
+            "last_seen": now,
+            "session": session,
+        }
+        self._client_ids[client_id] = key
+        self._dirty[key] = (kind, True)
+
+    def disconnected(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._client_ids.pop(entry["client_id"], None)
+            self._dirty[key] = (entry["kind"], False)
+        return entry
+
+    def disconnected_client(self, client_id):
+        # Ignored if the session was already replaced by a newer one. A
+        # reconnecting bot reuses its client_id, so a late disconnect of the
+        # old connection finds the new session, which is still connected.
+        key = self._client_ids.get(client_id)
+        if key is not None and not _session_connected(self._entries[key]["session"]):
+            return self.disconnected(key)
+
+    def touch(self, client_id):
+        # Record activity from an MQTT client
+        key = self._client_ids.get(client_id)
+        if key is not None:
+            self._entries[key]["last_seen"] = time.time()
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def is_online(self, key):
+        return key in self._entries
+
+    def online(self, kind=None):
+        return [
+            key for key, entry in self._entries.items() if kind is None or entry["kind"] == kind
+        ]
+
+    def clear(self):
+        for key in list(self._entries):
+            self.disconnected(key)
+
+    async def snapshot(self):
+        # Write connection changes since the last snapshot in one batch
+        if not self._dirty:
+            return 0
+
+        dirty, self._dirty = self._dirty, {}
+        await bumper.async_db_batch(_write_snapshot, dirty)
+        return len(dirty)
+
+
+def _session_connected(session):
+    # hbmqtt marks a session disconnected before firing the disconnect event
+    transitions = getattr(session, "transitions", None)
+    return transitions is not None and transitions.state == "connected"
+
+
+def _write_snapshot(dirty):
+    # Only records that still exist, a bot or client removed while connected stays removed
+    for key, (kind, online) in dirty.items():
+        if kind == "bot":
+            if bumper.bot_get(key):
+                bumper.bot_set_mqtt(key, online)
+        elif bumper.client_get(key):
+            bumper.client_set_mqtt(key, online)
@@ -31,6 +31,7 @@ def async_return(result):
 
 
 def remove_existing_db():
+    bumper.db_close()
     if os.path.exists("tests/tmp.db"):
         os.remove("tests/tmp.db")  # Remove existing db
 
@@ -145,6 +146,232 @@ async def test_RemoveClient(aiohttp_client):
     assert resp.status == 200  
 
 
+async def test_Backup(aiohttp_client, tmpdir):
+    remove_existing_db()
+    bumper.db = "tests/tmp.db"  # Set db location for testing
+    bumper.db_backup_dir = str(tmpdir)
+    try:
+        bumper.bot_add("sn_1234", "did_1234", "dev_1234", "res_1234", "eco-ng")
+        client = await aiohttp_client(create_app)
+        resp = await client.get("/backup")
+        assert resp.status == 200
+        jsonresp = json.loads(await resp.text())
+        assert jsonresp["status"] == "complete"
+        assert os.path.dirname(jsonresp["backup"]) == str(tmpdir)
+
+        bumper.bot_remove("did_1234")
+        await bumper.async_db_restore(jsonresp["backup"])
+        assert bumper.bot_get("did_1234")  # Test bot restored from backup
+
+    finally:
+        bumper.db_backup_dir = os.path.join(bumper.data_dir, "backups")
+
+
+async def test_DBImportExport(aiohttp_client):
+    remove_existing_db()
+    bumper.db = "tests/tmp.db"  # Set db location for testing
+    client = await aiohttp_client(create_app)
+
+    body = "\n".join(
+        [
+            json.dumps({"type": "user", "userid": "testuser"}),
+            json.dumps({"type": "bot", "did": "did_1234", "company": "eco-ng"}),
+            json.dumps({"type": "bot"}),
+        ]
+    )
+    resp = await client.post("/db/import", data=body)
+    assert resp.status == 200
+    jsonresp = json.loads(await resp.text())
+    assert jsonresp["status"] == "complete"
+    assert jsonresp["imported"] == 2
+    assert jsonresp["failed"] == 1
+    assert bumper.bot_get("did_1234")["company"] == "eco-ng"
+
+    resp = await client.get("/db/export")
+    assert resp.status == 200
+    assert resp.content_type == "application/x-ndjson"
+    records = [json.loads(line) for line in (await resp.text()).splitlines()]
+    assert [r["type"] for r in records] == ["user", "bot"]
+
+
+async def test_DBStats(aiohttp_client):
+    remove_existing_db()
+    bumper.db = "tests/tmp.db"  # Set db location for testing
+    client = await aiohttp_client(create_app)
+    bumper.bot_get("did_1234")
+
+    resp = await client.get("/db/stats?reset")
+    assert resp.status == 200
+    jsonresp = json.loads(await resp.text())
+    assert jsonresp["functions"]["bot_get"]["calls"] >= 1
+    assert "bytes_written" in jsonresp["storage"]
+
+    resp = await client.get("/db/stats")
+    jsonresp = json.loads(await resp.text())
+    assert "bot_get" not in jsonresp["functions"]  # Test stats were reset
+
+
+async def test_BotsStats(aiohttp_client):
+    client = await aiohttp_client(create_app)
+
+    resp = await client.get("/bots/stats")
+    assert resp.status == 200
+    jsonresp = json.loads(await resp.text())
+    assert "queues" in jsonresp
+    assert "coalesced" in jsonresp
+    assert "commands" in jsonresp["latency"]
+
+
+async def test_BotsCommand(aiohttp_client, monkeypatch):
+    remove_existing_db()
+    bumper.db = "tests/tmp.db"  # Set db location for testing
+    client = await aiohttp_client(create_app)
+    monkeypatch.setattr(bumper, "mqtt_helperbot", bumper.MQTTHelperBot("127.0.0.1"))
+    monkeypatch.setattr(bumper, "bot_commands", bumper.BotCommands())
+    monkeypatch.setattr(bumper, "presence_registry", bumper.PresenceRegistry())
+    for i in range(4):
+        bumper.bot_add("sn_{}".format(i), "did_{}".format(i), "ls1ok3", "res", "eco-ng")
+        bumper.bot_set_mqtt("did_{}".format(i), True)  # Stale for did_3
+        if i != 3:
+            bumper.presence_registry.connected("did_{}".format(i), "bot", str(i))
+    bumper.bot_add("sn_4", "did_4", "126", "res", "eco-ng")
+    bumper.presence_registry.connected("did_4", "bot", "4")
+
+    inflight = []
+    async def send_command(cmdjson, requestid):
+        inflight.append(cmdjson["toId"])
+        await asyncio.sleep(0.01)
+        assert len(inflight) <= 2  # Test concurrency is bounded
+        inflight.remove(cmdjson["toId"])
+        return {"id": requestid, "resp": {"ret": "ok"}, "ret": "ok"}
+
+    monkeypatch.setattr(bumper.mqtt_helperbot, "send_command", send_command)
+    monkeypatch.setattr(bumper, "bot_fanout_concurrency", 2)
+
+    async def fan_out(postbody):
+        resp = await client.post("/bots/command", json=postbody)
+        assert resp.status == 200
+        lines = [json.loads(line) for line in (await resp.text()).splitlines()]
+        return lines[:-1], lines[-1]["summary"]
+
+    # Test all bots
+    results, summary = await fan_out({"all": True, "cmdName": "Charge", "td": "q"})
+    assert sorted(r["did"] for r in results) == [
+        "did_0", "did_1", "did_2", "did_3", "did_4"
+    ]
+    assert summary == {"bots": 5, "ok": 4, "failed": 1}
+    offline = [r for r in results if r["did"] == "did_3"][0]
+    assert offline["resp"]["debug"] == "bot not connected"  # Test presence used
+
+    # Test by class
+    results, summary = await fan_out({"class": "126", "cmdName": "Charge"})
+    assert [r["did"] for r in results] == ["did_4"]
+
+    # Test by did list
+    results, summary = await fan_out({"dids": ["did_0", "did_9"], "cmdName": "Charge"})
+    assert [r["did"] for r in results] == ["did_0"]
+    assert summary == {"bots": 1, "ok": 1, "failed": 0}
+
+    # Test no selector
+    results, summary = await fan_out({"cmdName": "Charge"})
+    assert summary["bots"] == 0
+
+    # Test helperbot not connected
+    monkeypatch.setattr(bumper, "mqtt_helperbot", bumper.MQTTHelperBot("127.0.0.1"))
+    results, summary = await fan_out({"dids": ["did_0"], "cmdName": "Charge"})
+    assert results[0]["resp"]["debug"] == "helperbot not connected"
+    assert summary == {"bots": 1, "ok": 0, "failed": 1}
+
+
+async def test_Jobs(aiohttp_client, monkeypatch):
+    remove_existing_db()
+    bumper.db = "tests/tmp.db"  # Set db location for testing
+    client = await aiohttp_client(create_app)
+    monkeypatch.setattr(bumper, "mqtt_helperbot", bumper.MQTTHelperBot("127.0.0.1"))
+    monkeypatch.setattr(bumper, "bot_commands", bumper.BotCommands())
+    monkeypatch.setattr(bumper, "bot_jobs", bumper.CommandJobs())
+    bumper.bot_add("sn_1234", "did_1234", "ls1ok3", "res_1234", "eco-ng")
+    bumper.bot_set_mqtt("did_1234", True)
+
+    answer = asyncio.Event()
+    async def send_command(cmdjson, requestid):
+        await answer.wait()
+        return {"id": requestid, "resp": cmdjson["toType"], "ret": "ok"}
+
+    bumper.mqtt_helperbot.send_command = send_command
+
+    # Test submit
+    resp = await client.post("/jobs", json={"toId": "did_1234", "cmdName": "Charge"})
+    assert resp.status == 200
+    jsonresp = json.loads(await resp.text())
+    assert jsonresp["ret"] == "ok"
+    jobid = jsonresp["id"]
+
+    # Test plain poll
+    resp = await client.get("/jobs/{}".format(jobid))
+    jsonresp = json.loads(await resp.text())
+    assert jsonresp["status"] == "pending"
+
+    # Test long-poll
+    asyncio.get_event_loop().call_later(0.05, answer.set)
+    resp = await client.get("/jobs/{}?wait=5".format(jobid))
+    jsonresp = json.loads(await resp.text())
+    assert jsonresp["status"] == "done"
+    assert jsonresp["resp"] == {"id": jobid, "resp": "ls1ok3", "ret": "ok"}
+
+    # Test invalid wait
+    for wait in ("soon", "-1", "nan"):
+        resp = await client.get("/jobs/{}?wait={}".format(jobid, wait))
+        assert resp.status == 400
+        assert json.loads(await resp.text())["ret"] == "fail"
+
+    # Test unknown job and bot
+    resp = await client.get("/jobs/unknown")
+    assert resp.status == 404
+    resp = await client.post("/jobs", json={"toId": "did_unknown", "cmdName": "Charge"})
+    jsonresp = json.loads(await resp.text())
+    assert jsonresp["ret"] == "fail"
+
+    # Test expiry
+    monkeypatch.setattr(bumper, "bot_job_ttl_seconds", 0)
+    await asyncio.sleep(0.01)
+    resp = await client.get("/jobs/{}".format(jobid))
+    assert resp.status == 404
+    monkeypatch.setattr(bumper, "bot_job_ttl_seconds", 300)
+
+    # Test bound
+    monkeypatch.setattr(bumper, "bot_job_max", 1)
+    answer.clear()
+    resp = await client.post("/jobs", json={"toId": "did_1234", "cmdName": "Charge"})
+    pending = json.loads(await resp.text())["id"]
+    resp = await client.post("/jobs", json={"toId": "did_1234", "cmdName": "Charge"})
+    assert json.loads(await resp.text())["errno"] == 503
+
+    # Test wait clamped to the longest long-poll
+    monkeypatch.setattr(bumper, "bot_job_wait_max_seconds", 0.05)
+    resp = await client.get("/jobs/{}?wait=3600".format(pending))
+    assert json.loads(await resp.text())["status"] == "pending"
+    assert bumper.bot_jobs.status()["rejected"] == 1
+    answer.set()
+
+
+async def test_Jobs_helperbot_disconnected(aiohttp_client, monkeypatch):
+    remove_existing_db()
+    bumper.db = "tests/tmp.db"  # Set db location for testing
+    client = await aiohttp_client(create_app)
+    monkeypatch.setattr(bumper, "mqtt_helperbot", bumper.MQTTHelperBot("127.0.0.1"))
+    monkeypatch.setattr(bumper, "bot_commands", bumper.BotCommands())
+    monkeypatch.setattr(bumper, "bot_jobs", bumper.CommandJobs())
+    bumper.bot_add("sn_1234", "did_1234", "ls1ok3", "res_1234", "eco-ng")
+
+    resp = await client.post("/jobs", json={"toId": "did_1234", "cmdName": "Charge"})
+    jobid = json.loads(await resp.text())["id"]
+    resp = await client.get("/jobs/{}?wait=1".format(jobid))
+    jsonresp = json.loads(await resp.text())
+    assert jsonresp["status"] == "failed"  # Test never sent isn't done
+    assert jsonresp["resp"]["errno"] == 503
+
+
 async def test_login(aiohttp_client):
     remove_existing_db()
     bumper.db = "tests/tmp.db"  # Set db location for testing
@@ -920,6 +1147,35 @@ async def test_devmgr(aiohttp_client):
     test_resp = json.loads(text)
     assert test_resp["ret"] == "fail"
 
+    # Test batch of commands
+    async def send_commands(cmdjsons, requestids):
+        return [
+            {"id": requestid, "resp": cmdjson["cmdName"], "ret": "ok"}
+            for cmdjson, requestid in zip(cmdjsons, requestids)
+        ]
+
+    bumper.mqtt_helperbot.send_commands = send_commands
+    postbody = {
+        "toId": "did_1234",
+        "toType": "dev_1234",
+        "toRes": "res_1234",
+        "cmds": [{"cmdName": "Charge"}, {"cmdName": "PlaySound"}],
+    }
+    resp = await client.post("/api/iot/devmanager_batch.do", json=postbody)
+    assert resp.status == 200
+    text = await resp.text()
+    test_resp = json.loads(text)
+    assert test_resp["ret"] == "ok"
+    assert [r["resp"] for r in test_resp["resps"]] == ["Charge", "PlaySound"]
+
+    # Test batch for unknown bot
+    postbody["toId"] = "did_unknown"
+    resp = await client.post("/api/iot/devmanager_batch.do", json=postbody)
+    assert resp.status == 200
+    text = await resp.text()
+    test_resp = json.loads(text)
+    assert test_resp["ret"] == "fail"
+
 
 async def test_dim_devmanager(aiohttp_client):
     remove_existing_db()
@@ -947,7 +1203,9 @@ async def test_dim_devmanager(aiohttp_client):
 
     # Test BotCommand
     bumper.bot_add("sn_1234", "did_1234", "dev_1234", "res_1234", "eco-ng")
-    bumper.bot_set_mqtt("did_1234", True)
+    bumper.presence_registry.connected(
+        "did_1234", "bot", "did_1234@dev_1234/res_1234"
+    )  # Bot connected to mqtt
     postbody = {"toId": "did_1234"}
 
     # Test return get status
@@ -978,7 +1236,7 @@ async def test_dim_devmanager(aiohttp_client):
     assert test_resp["errno"] == "timeout"
 
     # Set bot not on mqtt
-    bumper.bot_set_mqtt("did_1234", False)
+    bumper.presence_registry.disconnected_client("did_1234@dev_1234/res_1234")
     bumper.mqtt_helperbot.send_command = mock.MagicMock(
         return_value=async_return(command_getstatus_resp)
     )
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import bumper
+import pytest
 from bumper.models import VacBotClient, VacBotDevice, BumperUser, EcoVacsHomeProducts
 from tinydb import TinyDB, Query
 from tinydb.storages import MemoryStorage
@@ -7,6 +8,10 @@ from datetime import datetime, timedelta
 import os
 import json
 import logging
+import sqlite3
+import threading
+import time
+import gzip
 
 
 def test_db_path():
@@ -73,8 +78,7 @@ def test_user_db():
     bumper.user_revoke_all_tokens("testuser")  # Revoke all tokens
     assert len(bumper.user_get_tokens("testuser")) == 0  # Test 0 tokens are available
 
-    db = TinyDB("tests/tmp.db")
-    tokens = db.table("tokens")
+    tokens = bumper.db_get().table("tokens")
     tokens.insert(
         {
             "userid": "testuser",
@@ -82,13 +86,11 @@ def test_user_db():
             "expiration": "{}".format(datetime.now() + timedelta(seconds=-10)),
         }
     )  # Add expired token
-    db.close()
     assert len(bumper.user_get_tokens("testuser")) == 1  # Test 1 tokens are available
     bumper.user_revoke_expired_tokens("testuser")  # Revoke expired tokens
     assert len(bumper.user_get_tokens("testuser")) == 0  # Test 0 tokens are available
 
-    db = TinyDB("tests/tmp.db")
-    tokens = db.table("tokens")
+    tokens = bumper.db_get().table("tokens")
     tokens.insert(
         {
             "userid": "testuser",
@@ -96,7 +98,6 @@ def test_user_db():
             "expiration": "{}".format(datetime.now() + timedelta(seconds=-10)),
         }
     )  # Add expired token
-    db.close()
     assert len(bumper.user_get_tokens("testuser")) == 1  # Test 1 tokens are available
     bumper.revoke_expired_tokens()  # Revoke expired tokens
     assert len(bumper.user_get_tokens("testuser")) == 0  # Test 0 tokens are available
@@ -133,3 +134,450 @@ def test_client_db():
 
     bumper.client_remove("resource_123")
     assert bumper.client_get("resource_123") == None
+
+
+def test_db_write_behind():
+    bumper.db_close()
+    if os.path.exists("tests/tmp.db"):
+        os.remove("tests/tmp.db")  # Remove existing db
+
+    bumper.db = "tests/tmp.db"  # Set db location for testing
+    bumper.bot_add("sn_123", "did_123", "dev_123", "res_123", "co_123")
+    assert bumper.bot_get("did_123")  # Test that bot is available from cache
+
+    with open("tests/tmp.db") as f:
+        assert "did_123" not in f.read()  # Test that write was not flushed yet
+
+    bumper.db_flush()
+    with open("tests/tmp.db") as f:
+        assert "did_123" in json.dumps(json.load(f))  # Test that flush wrote bot
+
+    bumper.client_add("user_123", "realm_123", "resource_123")
+    bumper.db_close()  # Closing flushes pending writes
+    with open("tests/tmp.db") as f:
+        assert "resource_123" in json.dumps(json.load(f))
+
+    assert bumper.client_get("resource_123")  # Test that db reopens after close
+
+
+def _on_disk(text):
+    # Whether text has been written out, as seen by another reader of the db
+    if bumper.db_backend == "sqlite":
+        conn = sqlite3.connect("tests/tmp.db")
+        try:
+            return any(text in row[0] for row in conn.execute("SELECT data FROM users"))
+        finally:
+            conn.close()
+
+    with open("tests/tmp.db") as f:
+        return text in f.read()
+
+
+def test_db_batch():
+    bumper.db_close()
+    if os.path.exists("tests/tmp.db"):
+        os.remove("tests/tmp.db")  # Remove existing db
+
+    bumper.db = "tests/tmp.db"  # Set db location for testing
+    bumper.db_close()
+    bumper.db_write_cache_size = 1  # Write every change straight to disk
+    try:
+        with bumper.db_batch():
+            bumper.user_add("testuser")
+            bumper.user_add_device("testuser", "dev_1234")
+            bumper.user_add_bots("testuser", ["did_1", "did_2", "did_1"])
+            assert bumper.user_get("testuser")["bots"] == ["did_1", "did_2"]
+            assert not _on_disk("testuser")  # Test that batch was not flushed
+
+        assert _on_disk("did_2")  # Test that batch flushed once done
+
+        user = bumper.user_login("testuser", "dev_5678", "token_1234", ["did_3"])
+        assert user["devices"] == ["dev_1234", "dev_5678"]
+        assert user["bots"] == ["did_1", "did_2", "did_3"]
+        assert bumper.check_token("testuser", "token_1234")
+        assert bumper.user_login("newuser", "dev_9", "token_9", [])["devices"] == [
+            "dev_9"
+        ]  # Test that login adds missing users
+
+        # Each batch is one cached write under the write-behind policy
+        bumper.db_write_cache_size = 100
+        bumper.db_flush()
+        writes = bumper.db_storage_stats["writes"]
+        for i in range(20):
+            bumper.user_login("testuser", "dev_{}".format(i), "token_{}".format(i), [])
+        assert bumper.db_storage_stats["writes"] == writes  # Test nothing flushed yet
+        assert not _on_disk("dev_19")
+        bumper.db_flush()
+        assert bumper.db_storage_stats["writes"] == writes + 1
+        assert _on_disk("dev_19")
+
+    finally:
+        bumper.db_close()
+        bumper.db_write_cache_size = 100
+
+
+def test_db_backup(tmpdir):
+    bumper.db_close()
+    if os.path.exists("tests/tmp.db"):
+        os.remove("tests/tmp.db")  # Remove existing db
+
+    bumper.db = "tests/tmp.db"  # Set db location for testing
+    bumper.user_add("testuser")
+    bumper.user_add_device("testuser", "dev_1234")
+    bumper.user_add_token("testuser", "token_1234")
+    bumper.bot_add("sn_123", "did_123", "dev_123", "res_123", "co_123")
+    bumper.client_add("testuser", "realm_123", "resource_123")
+
+    backup = bumper.db_backup(str(tmpdir), keep=2, compress=True)
+    assert backup.endswith(".json.gz")
+    with gzip.open(backup, "rt") as f:
+        assert json.load(f)["bots"]["1"]["did"] == "did_123"  # Test image contents
+
+    plain = bumper.db_backup(str(tmpdir), keep=2, compress=False)
+    bumper.db_backup(str(tmpdir), keep=2)
+    assert len(tmpdir.listdir()) == 2  # Test oldest backup rotated out
+    assert not os.path.exists(backup)
+
+    bumper.bot_remove("did_123")
+    bumper.user_add_device("testuser", "dev_5678")
+    bumper.client_add("testuser", "realm_123", "resource_456")
+    assert bumper.db_restore(plain) == 4  # Test all records restored
+    assert bumper.bot_get("did_123")
+    assert bumper.user_get("testuser")["devices"] == ["dev_1234"]
+    assert bumper.user_by_deviceid("dev_5678") is None  # Test indexes rebuilt
+    assert bumper.client_get("resource_456") is None
+    assert bumper.check_token("testuser", "token_1234")
+
+
+def test_db_import_export():
+    bumper.db_close()
+    if os.path.exists("tests/tmp.db"):
+        os.remove("tests/tmp.db")  # Remove existing db
+
+    bumper.db = "tests/tmp.db"  # Set db location for testing
+    bumper.bot_add("sn_1", "did_1", "dev_123", "res_123", "co_123")
+    lines = [json.dumps({"type": "bot", "did": "did_1", "nick": "nick_1"})]
+    lines += [
+        json.dumps({"type": "bot", "did": "did_{}".format(i), "name": "sn_{}".format(i)})
+        for i in range(2, 2500)
+    ]
+    lines += [
+        json.dumps({"type": "user", "userid": "testuser", "devices": ["dev_1234"]}),
+        json.dumps({"type": "client", "userid": "testuser", "resource": "res_1"}),
+        "",
+        "not json",
+        json.dumps({"type": "bot", "did": "did_x", "color": "red"}),
+        json.dumps({"type": "user", "userid": "baduser", "devices": "dev_1"}),
+        json.dumps({"type": "client", "userid": "testuser"}),
+        json.dumps({"type": "token", "token": "token_1234"}),
+    ]
+    bumper.db_import_batch_size = 1000
+    summary = bumper.db_import(lines)
+    assert summary["imported"] == 2501
+    assert summary["failed"] == 5  # Test invalid records skipped
+    assert summary["errors"][0].startswith("line 2503:")
+
+    assert bumper.bot_get("did_1")["nick"] == "nick_1"  # Test existing bot updated
+    assert bumper.bot_get("did_1")["name"] == ""
+    assert bumper.bot_get("did_2499")["name"] == "sn_2499"
+    assert bumper.user_by_deviceid("dev_1234")["userid"] == "testuser"
+    assert bumper.client_get("res_1")["mqtt_connection"] == False  # Test defaults
+
+    bumper.db_export_page_size = 1000
+    exported = [json.loads(line) for line in bumper.db_export()]
+    assert len(exported) == 2501  # Test every record exported across pages
+    assert exported[0] == {"type": "user", "userid": "testuser", "devices": ["dev_1234"], "bots": []}
+    assert exported[-1]["type"] == "client"
+
+    bumper.db_close()
+    os.remove("tests/tmp.db")
+    assert bumper.db_import(json.dumps(r) + "\n" for r in exported)["imported"] == 2501
+    assert [json.loads(line) for line in bumper.db_export()] == exported  # Round trip
+
+
+def test_db_compact():
+    bumper.db_close()
+    if os.path.exists("tests/tmp.db"):
+        os.remove("tests/tmp.db")  # Remove existing db
+
+    bumper.db = "tests/tmp.db"  # Set db location for testing
+    bumper.user_add("testuser")
+    bumper.user_add_bots("testuser", ["did_1", "did_2"])
+    bumper.user_add_token("testuser", "token_1234")
+    bumper.user_add_token("olduser", "token_4321")  # Token of a missing user
+    bumper.bot_add("sn_1", "did_1", "dev_123", "res_123", "co_123")
+    for i in range(200):
+        bumper.client_add("testuser", "realm_123", "resource_{}".format(i))
+    bumper.client_set_mqtt("resource_2", True)  # Stale flag from before a restart
+    clients = bumper.db_get().table("clients")
+    old = [c.doc_id for c in clients.all() if c["resource"] != "resource_0"]
+    clients.update({"last_seen": time.time() - 7200}, old)  # Idle 2 hours
+    bumper.client_add("testuser", "realm_123", "resource_legacy")
+    legacy = bumper.client_get("resource_legacy")
+    clients.update({"last_seen": 0.0}, [legacy.doc_id])  # Never stamped
+
+    presence_registry = bumper.presence_registry
+    bumper.presence_registry = bumper.PresenceRegistry()
+    bumper.presence_registry.connected("resource_1", "client", "client_1")  # Kept
+    try:
+        report = bumper.db_compact(client_max_idle_seconds=3600)
+    finally:
+        bumper.presence_registry = presence_registry
+    assert report["clients"] == 198  # Test idle clients removed
+    assert report["tokens"] == 1  # Test orphaned token removed
+    assert report["user_bots"] == 1  # Test deleted bot removed from user
+    assert report["records"] == 200
+    assert report["bytes_reclaimed"] == report["bytes_before"] - report["bytes_after"]
+    assert report["bytes_reclaimed"] > 0  # Test storage rewritten smaller
+
+    assert [c["resource"] for c in bumper.client_get_all()] == [
+        "resource_0",
+        "resource_1",
+        "resource_legacy",
+    ]
+    assert bumper.client_get("resource_legacy")["last_seen"] > 0  # Test stamped
+    assert bumper.user_get("testuser")["bots"] == ["did_1"]
+    assert bumper.check_token("testuser", "token_1234")
+    assert bumper.user_get_tokens("olduser") == []
+
+
+def test_db_stats():
+    bumper.db_close()
+    if os.path.exists("tests/tmp.db"):
+        os.remove("tests/tmp.db")  # Remove existing db
+
+    bumper.db = "tests/tmp.db"  # Set db location for testing
+    bumper.db_stats_reset()
+    bumper.bot_add("sn_123", "did_123", "dev_123", "res_123", "co_123")
+    bumper.bot_get("did_123")
+    bumper.bot_get("did_404")
+    bumper.db_flush()
+
+    stats = bumper.db_stats()
+    assert stats["backend"] == bumper.db_backend
+    assert stats["functions"]["bot_get"]["calls"] == 3  # Including bot_add's lookup
+    assert stats["functions"]["bot_add"]["calls"] == 1
+    latency = stats["functions"]["bot_get"]["latency"]
+    assert latency["count"] == 3 and latency["p99"] >= latency["p50"] > 0
+    assert stats["storage"]["writes"] >= 1  # Test flush counted
+    assert stats["storage"]["bytes_written"] > 0
+    assert stats["file_size"] >= os.path.getsize("tests/tmp.db")  # Plus SQLite WAL
+
+    with pytest.raises(TypeError):
+        bumper.bot_get()  # Test errors counted
+    assert bumper.db_stats()["functions"]["bot_get"]["errors"] == 1
+
+    bumper.db_stats_reset()
+    assert bumper.db_stats()["functions"] == {}
+
+
+def test_histogram():
+    histogram = bumper.metrics.Histogram()
+    assert histogram.percentile(50) is None
+    for value in [0.0002] * 98 + [0.02, 100]:
+        histogram.observe(value)
+    assert histogram.percentile(50) == 0.00025
+    assert histogram.percentile(99) == 0.025
+    assert histogram.percentile(100) == 100  # Test overflow reports max
+    assert histogram.asdict()["buckets"] == {"0.00025": 98, "0.025": 1, "inf": 1}
+
+
+def test_db_indexes():
+    bumper.db_close()
+    if os.path.exists("tests/tmp.db"):
+        os.remove("tests/tmp.db")  # Remove existing db
+
+    bumper.db = "tests/tmp.db"  # Set db location for testing
+    bumper.user_add("testuser")
+    bumper.user_add_device("testuser", "dev_1234")
+    bumper.user_add_token("testuser", "token_1234")
+    bumper.user_add_authcode("testuser", "token_1234", "auth_1234")
+    bumper.bot_add("sn_123", "did_123", "dev_123", "res_123", "co_123")
+    bumper.client_add("testuser", "realm_123", "resource_123")
+
+    bumper.db_close()  # Reopen from disk so indexes are rebuilt on load
+
+    assert bumper.user_by_deviceid("dev_1234")["userid"] == "testuser"
+    assert bumper.check_token("fuid_testuser", "token_1234")
+    assert bumper.check_authcode("testuser", "auth_1234")
+    assert bumper.loginByItToken("auth_1234") == {
+        "token": "token_1234",
+        "userid": "testuser",
+    }
+    assert bumper.bot_get("did_123")["name"] == "sn_123"
+    assert bumper.client_get("resource_123")["userid"] == "testuser"
+
+    # Test indexes follow updates and removals
+    bumper.user_remove_device("testuser", "dev_1234")
+    assert bumper.user_by_deviceid("dev_1234") == None
+    bumper.user_revoke_authcode("testuser", "token_1234", "auth_1234")
+    assert bumper.loginByItToken("auth_1234") == {}
+    bumper.bot_remove("did_123")
+    assert bumper.bot_get("did_123") == None
+
+    # Test returned documents are copies
+    bumper.user_get("testuser")["bots"].append("bot_1234")
+    assert "bot_1234" not in bumper.user_get("testuser")["bots"]
+
+
+async def test_db_async():
+    bumper.db_close()
+    if os.path.exists("tests/tmp.db"):
+        os.remove("tests/tmp.db")  # Remove existing db
+
+    bumper.db = "tests/tmp.db"  # Set db location for testing
+    await bumper.async_bot_add("sn_123", "did_123", "dev_123", "res_123", "co_123")
+    bot = await bumper.async_bot_get("did_123")
+    assert bot["name"] == "sn_123"  # Test that bot was added and returned
+    assert bumper.bot_get("did_123")  # Test sync API sees the same data
+
+    await bumper.async_user_add("testuser")
+    await bumper.async_user_add_token("testuser", "token_1234")
+    assert await bumper.async_check_token("testuser", "token_1234")
+
+    # Test that calls run on the database executor, not the event loop thread
+    thread = await bumper.async_db_call(lambda: threading.current_thread().name)
+    assert thread.startswith("bumper-db")
+
+
+def test_db_ttl():
+    bumper.db_close()
+    if os.path.exists("tests/tmp.db"):
+        os.remove("tests/tmp.db")  # Remove existing db
+
+    bumper.db = "tests/tmp.db"  # Set db location for testing
+    bumper.user_add_token("testuser", "token_1234")
+    token = bumper.user_get_token("testuser", "token_1234")
+    assert isinstance(token["expiration"], float)  # Test expiration stored as epoch
+
+    tokens = bumper.db_get().table("tokens")
+    tokens.insert(
+        {
+            "userid": "testuser",
+            "token": "token_legacy",
+            "expiration": "{}".format(datetime.now() + timedelta(seconds=-10)),
+        }
+    )  # Add expired token with a legacy ISO expiration
+    assert isinstance(
+        bumper.user_get_token("testuser", "token_legacy")["expiration"], float
+    )  # Test ISO expiration converted to epoch
+    tokens.insert(
+        {"userid": "testuser", "token": "token_5678", "expiration": 100}
+    )  # Add expired token
+
+    removes = []
+    if bumper.db_backend == "tinydb":
+        table_remove = tokens._table.remove
+
+        def remove(*args, **kwargs):
+            removes.append(kwargs)
+            return table_remove(*args, **kwargs)
+
+        tokens._table.remove = remove
+
+    expired = tokens.expire()
+    assert sorted(t["token"] for t in expired) == ["token_5678", "token_legacy"]
+    if bumper.db_backend == "tinydb":
+        assert len(removes) == 1  # Test one table rewrite for the whole sweep
+        tokens._table.remove = table_remove
+    assert tokens.expire() == []  # Test nothing left to expire
+    assert bumper.user_get_token("testuser", "token_1234")  # Test valid token kept
+
+    tokens.update({"expiration": 100}, [token.doc_id])  # Expire the valid token
+    assert [t["token"] for t in tokens.expire()] == ["token_1234"]
+    bumper.db_close()
+
+    with open("tests/tmp.db", "w") as f:  # Write a db with ISO expirations
+        json.dump(
+            {
+                "tokens": {
+                    "1": {
+                        "userid": "testuser",
+                        "token": "token_1234",
+                        "expiration": "{}".format(datetime.now() + timedelta(seconds=-10)),
+                    },
+                    "2": {
+                        "userid": "testuser",
+                        "token": "token_4321",
+                        "expiration": "{}".format(datetime.now() + timedelta(seconds=60)),
+                    },
+                }
+            },
+            f,
+        )
+
+    if bumper.db_backend == "sqlite":
+        bumper.db = "tests/tmp.sqlite"
+        bumper.db_migrate_tinydb("tests/tmp.db")
+
+    bumper.revoke_expired_tokens()
+    tokens = bumper.user_get_tokens("testuser")
+    assert [t["token"] for t in tokens] == ["token_4321"]  # Test legacy file expired
+    assert isinstance(tokens[0]["expiration"], float)  # Test legacy file converted
+    bumper.db_close()
+    bumper.db = "tests/tmp.db"
+    if os.path.exists("tests/tmp.sqlite"):
+        os.remove("tests/tmp.sqlite")
+
+
+def test_sqlite_db(tmpdir):
+    bumper.db_backend = "sqlite"
+    try:
+        for test in (
+            test_user_db,
+            test_bot_db,
+            test_client_db,
+            test_db_batch,
+            test_db_import_export,
+            test_db_compact,
+            test_db_stats,
+            test_db_indexes,
+        ):
+            bumper.db_close()
+            if os.path.exists("tests/tmp.db"):
+                os.remove("tests/tmp.db")  # Remove existing db
+
+            test()  # Run the TinyDB tests against SQLite
+
+        test_db_backup(tmpdir)
+        journal = bumper.db_get().connection.execute("PRAGMA journal_mode").fetchone()
+        assert journal[0] == "wal"  # Test that WAL journaling is enabled
+
+        test_db_ttl()
+
+    finally:
+        bumper.db_close()
+        bumper.db_backend = "tinydb"
+        bumper.db_close()
+        if os.path.exists("tests/tmp.db"):
+            os.remove("tests/tmp.db")  # Remove SQLite db
+
+
+def test_sqlite_migrate():
+    bumper.db_close()
+    for path in ["tests/tmp.db", "tests/tmp.sqlite"]:
+        if os.path.exists(path):
+            os.remove(path)  # Remove existing db
+
+    bumper.db = "tests/tmp.db"  # Create a TinyDB database to migrate
+    bumper.user_add("testuser")
+    bumper.user_add_device("testuser", "dev_1234")
+    bumper.user_add_token("testuser", "token_1234")
+    bumper.bot_add("sn_123", "did_123", "dev_123", "res_123", "co_123")
+    bumper.client_add("testuser", "realm_123", "resource_123")
+    bumper.db_close()
+
+    bumper.db_backend = "sqlite"
+    bumper.db = "tests/tmp.sqlite"
+    try:
+        assert bumper.db_migrate_tinydb("tests/tmp.db") == 4  # Test all records copied
+        assert bumper.user_by_deviceid("dev_1234")["userid"] == "testuser"
+        assert bumper.check_token("testuser", "token_1234")
+        assert bumper.bot_get("did_123")["name"] == "sn_123"
+        assert bumper.client_get("resource_123")
+
+    finally:
+        bumper.db_close()
+        bumper.db_backend = "tinydb"
+        bumper.db = "tests/tmp.db"
+        os.remove("tests/tmp.sqlite")
@@ -19,6 +19,7 @@ def test_strtobool():
 
 async def test_start_stop():
     with LogCapture() as l:
+        bumper.db_close()
         if os.path.exists("tests/tmp.db"):
             os.remove("tests/tmp.db")  # Remove existing db
 
@@ -41,6 +42,7 @@ async def test_start_stop():
 
 async def test_start_stop_debug():
     with LogCapture() as l:
+        bumper.db_close()
         if os.path.exists("tests/tmp.db"):
             os.remove("tests/tmp.db")  # Remove existing db
 
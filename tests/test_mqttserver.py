@@ -165,42 +165,26 @@ async def test_helperbot_expire_message():
             mqtt_helperbot.Client._connected_state._value == True
         )  # Check helperbot is connected
 
-        expire_msg_payload = '{"ret":"ok","ver":"0.13.5"}'
-        expire_msg_topic_name = "iot/p2p/GetWKVer/bot_serial/ls1ok3/wC3g/helperbot/bumper/helperbot/p/testgood/j"
-        currenttime = time.time()
-        mqtt_helperbot.command_responses.append(
-            {
-                "time": currenttime,
-                "topic": expire_msg_topic_name,
-                "payload": expire_msg_payload,
-            }
-        )
-
-        assert {
-            "time": currenttime,
-            "topic": expire_msg_topic_name,
-            "payload": expire_msg_payload,
-        } in mqtt_helperbot.command_responses  # check message is in command_responses
-
-        await asyncio.sleep(0.1)
         mqtt_helperbot.expire_msg_seconds = (
             0.1
         )  # Set expire message seconds to 0.1 so we don't wait 10 seconds
-        msg_payload = "<ctl ts='1547822804960' td='DustCaseST' st='0'/>"
-        msg_topic_name = "iot/atr/DustCaseST/bot_serial/ls1ok3/wC3g/x"
+        expire_msg_payload = '{"ret":"ok","ver":"0.13.5"}'
+        expire_msg_topic_name = "iot/p2p/GetWKVer/bot_serial/ls1ok3/wC3g/helperbot/bumper/helperbot/p/testgood/j"
         await mqtt_helperbot.Client.publish(
-            msg_topic_name, msg_payload.encode(), hbmqtt.client.QOS_0
-        )  # Send another message to force get_msg
-
-
+            expire_msg_topic_name, expire_msg_payload.encode(), hbmqtt.client.QOS_0
+        )  # Response nobody waits for
         await asyncio.wait_for(mqtt_helperbot.Client.deliver_message(), timeout=0.1)
 
+        assert (
+            "testgood" in mqtt_helperbot.command_responses
+        )  # check message is in command_responses
 
-        assert {
-            "time": currenttime,
-            "topic": expire_msg_topic_name,
-            "payload": expire_msg_payload,
-        } not in mqtt_helperbot.command_responses  # check message was expired and removed from command_responses
+        await asyncio.sleep(0.2)  # No other message needed to expire it
+
+        assert (
+            "testgood" not in mqtt_helperbot.command_responses
+        )  # check message was expired and removed from command_responses
+        assert mqtt_helperbot._expire_timer is None  # Test timer stopped when empty
 
         l.check_present(
             (
@@ -211,6 +195,15 @@ async def test_helperbot_expire_message():
                 ),
             )
         )  # Check received message was logged
+
+        # Unclaimed responses are bounded, oldest dropped first
+        mqtt_helperbot.max_unclaimed_responses = 2
+        for requestid in ["one", "two", "three"]:
+            mqtt_helperbot.store_response(requestid, requestid, "")
+        assert list(mqtt_helperbot.command_responses) == ["two", "three"]
+        l.check_present(
+            ("helperbot", "DEBUG", "Dropping Unclaimed Message - Message Topic: one")
+        )
         mqtt_helperbot.Client.disconnect()
 
     await mqtt_server.broker.shutdown()
@@ -361,13 +354,250 @@ async def test_helperbot_sendcommand():
         "ret": "ok",
     }
 
+    # Concurrent commands, answered out of order
+    ids = [mqtt_helperbot.new_request_id() for _ in range(3)]
+    assert len(set(ids)) == 3  # Test request ids are unique
+    mqtt_helperbot.wait_resp_timeout_seconds = 1
+    cmdjson["cmdName"] = "GetWKVer"
+    commands = [
+        asyncio.ensure_future(mqtt_helperbot.send_command(cmdjson, requestid))
+        for requestid in ids
+    ]
+    await asyncio.sleep(0.1)
+    assert set(mqtt_helperbot.pending) == set(ids)  # Test waiters registered
+    for requestid in reversed(ids):
+        await mqtt_helperbot.Client.publish(
+            "iot/p2p/GetWKVer/bot_serial/ls1ok3/wC3g/helperbot/bumper/helperbot/p/{}/j".format(
+                requestid
+            ),
+            '{{"ret":"ok","id":"{}"}}'.format(requestid).encode(),
+            hbmqtt.client.QOS_0,
+        )
+
+    results = await asyncio.gather(*commands)
+    for requestid, commandresult in zip(ids, results):
+        assert commandresult == {
+            "id": requestid,
+            "resp": {"ret": "ok", "id": requestid},
+            "ret": "ok",
+        }
+    assert mqtt_helperbot.pending == {}  # Test waiters cleaned up
+
+    # Batch of commands, one answered
+    ids = [mqtt_helperbot.new_request_id() for _ in range(2)]
+    mqtt_helperbot.wait_resp_timeout_seconds = 0.5
+    batch = asyncio.ensure_future(
+        mqtt_helperbot.send_commands([cmdjson, dict(cmdjson, cmdName="GetLifeSpan")], ids)
+    )
+    await asyncio.sleep(0.1)
+    assert set(mqtt_helperbot.pending) == set(ids)  # Test all published up front
+    await mqtt_helperbot.Client.publish(
+        "iot/p2p/GetLifeSpan/bot_serial/ls1ok3/wC3g/helperbot/bumper/helperbot/p/{}/j".format(
+            ids[1]
+        ),
+        b'{"ret":"ok"}',
+        hbmqtt.client.QOS_0,
+    )
+    results = await batch
+    assert results[0]["ret"] == "fail"  # Test timeout
+
+    # Cancelled waits are not reported as timeouts
+    wait = asyncio.ensure_future(mqtt_helperbot.send_command(cmdjson, "testcancel"))
+    await asyncio.sleep(0.05)
+    wait.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await wait
+    assert "testcancel" not in mqtt_helperbot.pending
+    assert results[1] == {"id": ids[1], "resp": {"ret": "ok"}, "ret": "ok"}
+
     mqtt_helperbot.Client.disconnect()
 
     await mqtt_server.broker.shutdown()
-    
+
+
+
+async def test_helperbot_pool():
+    mqtt_address = ("127.0.0.1", 8883)
+    mqtt_server = bumper.MQTTServer(mqtt_address, password_file="tests/passwd")
+    await mqtt_server.broker_coro()
+
+    pool = bumper.MQTTHelperBotPool(mqtt_address, 2)
+    bumper.mqtt_helperbot = pool
+    await pool.start_helper_bot()
+    assert [member.client_id for member in pool.members] == [
+        "helperbot@bumper/helperbot",
+        "helperbot@bumper/helperbot1",
+    ]
+    assert pool.Client is pool.members[0].Client
+    assert all(member["state"] == "connected" for member in pool.status())
+
+    # Find a did for each member
+    dids = {}
+    for i in range(100):
+        dids.setdefault(pool.member_for("bot_{}".format(i)), "bot_{}".format(i))
+    assert len(dids) == 2  # Test commands are sharded over both
+    assert pool.member_for(dids[pool.members[1]]) is pool.members[1]  # Stable
+
+    bot = pool.members[1]
+    bot.wait_resp_timeout_seconds = 1
+    cmdjson = {
+        "toType": "ls1ok3",
+        "payloadType": "j",
+        "toRes": "wC3g",
+        "payload": {},
+        "td": "q",
+        "toId": dids[bot],
+        "cmdName": "GetWKVer",
+    }
+    command = asyncio.ensure_future(pool.send_command(cmdjson, "testpool"))
+    await asyncio.sleep(0.1)
+    assert "testpool" in bot.pending  # Test command sent by the shard's member
+    await pool.members[0].Client.publish(
+        "iot/p2p/GetWKVer/{}/ls1ok3/wC3g/helperbot/bumper/helperbot1/p/testpool/j".format(
+            dids[bot]
+        ),
+        b'{"ret":"ok"}',
+        hbmqtt.client.QOS_0,
+    )
+    assert await command == {"id": "testpool", "ret": "ok", "resp": {"ret": "ok"}}
+    assert bot.health()["commands"] == 1
+    assert bot.health()["responses"] == 1  # Test response routed to the member
+
+    # A disconnected member's bots go to the next member meanwhile
+    await bot.disconnect()
+    assert pool.member_for(dids[bot]) is pool.members[0]
+    await asyncio.sleep(0.5)
+    assert bot.is_connected()  # Test member reconnected
+    assert bot.connects == 2
+    assert pool.member_for(dids[bot]) is bot
+
+    await pool.disconnect()
+    await mqtt_server.broker.shutdown()
+
+
+async def test_helperbot_in_process():
+    mqtt_address = ("127.0.0.1", 8883)
+    mqtt_server = bumper.MQTTServer(mqtt_address, password_file="tests/passwd")
+    await mqtt_server.broker_coro()
+
+    mqtt_helperbot = bumper.MQTTHelperBotInProcess(mqtt_server.broker)
+    bumper.mqtt_helperbot = mqtt_helperbot
+    await mqtt_helperbot.start_helper_bot()
+    assert mqtt_helperbot.is_connected()
+    assert mqtt_helperbot.status()[0]["state"] == "connected"
+
+    # Fake bot answering commands
+    fake_bot = hbmqtt.client.MQTTClient(
+        client_id="bot_serial@ls1ok3/wC3g", config={"check_hostname": False}
+    )
+    await fake_bot.connect(
+        "mqtts://{}:{}/".format(mqtt_address[0], mqtt_address[1]),
+        cafile=bumper.ca_cert,
+    )
+    await fake_bot.subscribe(
+        [("iot/p2p/+/+/+/+/bot_serial/ls1ok3/wC3g/+/+/+", hbmqtt.client.QOS_0)]
+    )
+
+    async def answer():
+        message = await fake_bot.deliver_message()
+        topic = message.topic.split("/")
+        assert topic[3:6] == ["helperbot", "bumper", "helperbot"]
+        assert json.loads(message.data.decode("utf-8")) == {"test": 1}
+        await fake_bot.publish(
+            "iot/p2p/{}/bot_serial/ls1ok3/wC3g/helperbot/bumper/helperbot/p/{}/j".format(
+                topic[2], topic[10]
+            ),
+            b'{"ret":"ok"}',
+            hbmqtt.client.QOS_0,
+        )
+
+    cmdjson = {
+        "toType": "ls1ok3",
+        "payloadType": "j",
+        "toRes": "wC3g",
+        "payload": {"test": 1},
+        "td": "q",
+        "toId": "bot_serial",
+        "cmdName": "GetWKVer",
+    }
+    mqtt_helperbot.wait_resp_timeout_seconds = 1
+    with LogCapture("helperbot") as l:
+        responder = asyncio.ensure_future(answer())
+        commandresult = await mqtt_helperbot.send_command(cmdjson, "testlocal")
+        await responder
+        assert commandresult == {"id": "testlocal", "ret": "ok", "resp": {"ret": "ok"}}
+        l.check_present(
+            (
+                "helperbot",
+                "DEBUG",
+                'Send Command - Topic: iot/p2p/GetWKVer/helperbot/bumper/helperbot/bot_serial/ls1ok3/wC3g/q/testlocal/j - Message: {"test": 1}',
+            )
+        )  # Check command was logged
+
+    await fake_bot.disconnect()
+    await mqtt_server.broker.shutdown()
+    assert not mqtt_helperbot.is_connected()
+
+
+async def test_presence_registry():
+    bumper.db_close()
+    if os.path.exists("tests/tmp.db"):
+        os.remove("tests/tmp.db")  # Remove existing db
+
+    bumper.db = "tests/tmp.db"  # Set db location for testing
+    bumper.bot_add("sn_123", "did_123", "dev_123", "res_123", "eco-ng")
+    bumper.client_add("user_123", "ecouser.net", "resource_123")
+    presence = bumper.PresenceRegistry()
+
+    presence.connected("did_123", "bot", "did_123@dev_123/res_123")
+    presence.connected("resource_123", "client", "user_123@ecouser.net/resource_123")
+    assert presence.is_online("did_123")
+    assert presence.online("bot") == ["did_123"]
+    assert bumper.bot_get("did_123")["mqtt_connection"] == False  # Not written yet
+
+    assert await presence.snapshot() == 2  # Test both changes written
+    assert bumper.bot_get("did_123")["mqtt_connection"] == True
+    assert bumper.client_get("resource_123")["mqtt_connection"] == True
+    assert await presence.snapshot() == 0  # Test nothing left to write
+
+    connected = presence.get("did_123")["connected"]
+    presence.touch("did_123@dev_123/res_123")
+    assert presence.get("did_123")["last_seen"] >= connected  # Test activity
+
+    # Reconnect before the old session is closed
+    presence.connected("did_123", "bot", "did_123@dev_123/res_456")
+    presence.disconnected_client("did_123@dev_123/res_123")
+    assert presence.is_online("did_123")  # Test old session ignored
+    presence.disconnected_client("did_123@dev_123/res_456")
+    assert not presence.is_online("did_123")
+
+    await presence.snapshot()
+    assert bumper.bot_get("did_123")["mqtt_connection"] == False
+
+    # Reconnect with the same client_id, the old session's disconnect comes late
+    old = mock.Mock()
+    new = mock.Mock()
+    old.transitions.state = "connected"
+    presence.connected("did_123", "bot", "did_123@dev_123/res_123", old)
+    new.transitions.state = "connected"
+    old.transitions.state = "disconnected"
+    presence.connected("did_123", "bot", "did_123@dev_123/res_123", new)
+    assert presence.disconnected_client("did_123@dev_123/res_123") is None
+    assert presence.is_online("did_123")  # Test new session kept
+    new.transitions.state = "disconnected"
+    assert presence.disconnected_client("did_123@dev_123/res_123")["key"] == "did_123"
+    assert not presence.is_online("did_123")
+
+    # Removed while connected, the snapshot doesn't bring it back
+    presence.connected("did_123", "bot", "did_123@dev_123/res_123")
+    bumper.bot_remove("did_123")
+    await presence.snapshot()
+    assert bumper.bot_get("did_123") is None
+    assert all("did" in bot for bot in bumper.bot_get_all())
 
 
 async def test_mqttserver():
+    bumper.db_close()
     if os.path.exists("tests/tmp.db"):
         os.remove("tests/tmp.db")  # Remove existing db
 
@@ -416,7 +646,11 @@ async def test_mqttserver():
     assert (
         fake_bot.Client._connected_state._value == True
     )  # Check fake_bot is connected
+    await asyncio.sleep(0.1)
+    assert bumper.presence_registry.is_online("bot_serial")  # Check presence
     await fake_bot.Client.disconnect()
+    await asyncio.sleep(0.1)
+    assert not bumper.presence_registry.is_online("bot_serial")
 
     # Test file auth client connect
     test_client = bumper.MQTTHelperBot(mqtt_address)
@@ -479,3 +713,337 @@ async def test_nofileauth_mqttserver():
         ("hbmqtt.broker.plugins.bumper", "WARNING", 'Password file tests/passwd-notfound not found'),
         order_matters=False
     )
+
+
+@pytest.fixture
+def bot_commands():
+    # Fresh BotCommands and helperbot, the bumper globals tests change are restored
+    names = [
+        "mqtt_helperbot",
+        "bot_commands",
+        "bot_command_concurrency",
+        "bot_command_queue_depth",
+        "bot_command_queue_timeout_seconds",
+        "bot_breaker_failures",
+        "bot_breaker_cooldown_seconds",
+    ]
+    saved = {name: getattr(bumper, name) for name in names}
+    state_ttl = dict(bumper.bot_state_ttl_seconds)
+    bumper.mqtt_helperbot = bumper.MQTTHelperBot("127.0.0.1")
+    bumper.bot_commands = bumper.BotCommands()
+    try:
+        yield bumper.bot_commands
+    finally:
+        for name, value in saved.items():
+            setattr(bumper, name, value)
+        bumper.bot_state_ttl_seconds.clear()
+        bumper.bot_state_ttl_seconds.update(state_ttl)
+
+
+async def test_bot_commands_coalesce(bot_commands):
+    sent = []
+
+    async def send_command(cmdjson, requestid):
+        sent.append(requestid)
+        await asyncio.sleep(0.1)
+        return {"id": requestid, "ret": "ok", "resp": "<ctl ret='ok' power='100'/>"}
+
+    bumper.mqtt_helperbot.send_command = send_command
+
+    def command(cmdname, did="did_1234", ts="1"):
+        return {
+            "toId": did,
+            "cmdName": cmdname,
+            "payloadType": "j",
+            "payload": {"header": {"ts": ts}, "body": {}},
+        }
+
+    results = await asyncio.gather(
+        bot_commands.send(command("getBattery", ts="1"), "req_1"),
+        bot_commands.send(command("getBattery", ts="2"), "req_2"),
+        bot_commands.send(command("getBattery", did="did_5678"), "req_3"),
+        bot_commands.send(command("clean"), "req_4"),
+        bot_commands.send(command("clean"), "req_5"),
+    )
+    assert sorted(sent) == ["req_1", "req_3", "req_4", "req_5"]  # Test one send per query
+    assert [result["id"] for result in results] == [
+        "req_1",
+        "req_2",
+        "req_3",
+        "req_4",
+        "req_5",
+    ]  # Test each caller gets its own id
+    assert results[1]["resp"] == results[0]["resp"]
+    status = bot_commands.status()
+    assert (status["sent"], status["coalesced"], status["inflight"]) == (4, 1, 0)
+
+    bot_commands.state.clear()  # Would be answered from the cache otherwise
+    await bot_commands.send(command("getBattery"), "req_6")
+    assert sent[-1] == "req_6"  # Test finished commands aren't reused
+
+
+async def test_bot_state_cache(bot_commands):
+    sent = []
+
+    async def send_command(cmdjson, requestid):
+        sent.append(cmdjson["cmdName"])
+        return {"id": requestid, "ret": "ok", "resp": "<ctl ret='ok' type='Brush' left='4142'/>"}
+
+    bumper.mqtt_helperbot.send_command = send_command
+    getbattery = {
+        "toId": "did_1234",
+        "cmdName": "GetBatteryInfo",
+        "payloadType": "x",
+        "payload": "<ctl/>",
+    }
+
+    # XML broadcast
+    bot_commands.state.broadcast(
+        "iot/atr/BatteryInfo/did_1234/ls1ok3/wC3g/x",
+        "<ctl ts='1547822804960' td='BatteryInfo'><battery power='100'/></ctl>",
+    )
+    resp = await bot_commands.send(getbattery, "req_1")
+    assert resp == {
+        "id": "req_1",
+        "ret": "ok",
+        "resp": '<ctl ret="ok"><battery power="100" /></ctl>',
+    }  # Test answered from the broadcast
+    assert sent == []
+
+    # JSON broadcast
+    bot_commands.state.broadcast(
+        "iot/atr/onBattery/did_5678/yna5xi/wC3g/j",
+        '{"header":{"ts":"1"},"body":{"data":{"value":80,"isLow":0}}}',
+    )
+    resp = await bot_commands.send(
+        {"toId": "did_5678", "cmdName": "getBattery", "payloadType": "j", "payload": {"header": {"ts": "2"}}},
+        "req_2",
+    )
+    assert resp["resp"]["body"] == {"code": 0, "msg": "ok", "data": {"value": 80, "isLow": 0}}
+
+    # Responses feed the cache, per command arguments
+    getlifespan = {
+        "toId": "did_1234",
+        "cmdName": "GetLifeSpan",
+        "payloadType": "x",
+        "payload": "<ctl type='Brush'/>",
+    }
+    await bot_commands.send(getlifespan, "req_3")
+    await bot_commands.send(getlifespan, "req_4")
+    assert sent == ["GetLifeSpan"]
+    await bot_commands.send(dict(getlifespan, payload="<ctl type='SideBrush'/>"), "req_5")
+    assert sent == ["GetLifeSpan", "GetLifeSpan"]  # Test other arguments sent
+    assert bot_commands.status()["cached"] == 3
+
+    # Stale state is asked for
+    bumper.bot_state_ttl_seconds["LifeSpan"] = 0
+    await asyncio.sleep(0.01)
+    await bot_commands.send(getlifespan, "req_6")
+    assert sent[-1] == "GetLifeSpan"
+
+    # Other commands may change state
+    await bot_commands.send({"toId": "did_1234", "cmdName": "Charge", "payloadType": "x", "payload": "<ctl><charge type='go'/></ctl>"}, "req_7")
+    await bot_commands.send(getbattery, "req_8")
+    assert sent[-2:] == ["Charge", "GetBatteryInfo"]  # Test cache dropped
+
+
+async def test_bot_command_queue(bot_commands):
+    release = asyncio.Event()
+
+    async def send_command(cmdjson, requestid):
+        await release.wait()
+        return {"id": requestid, "ret": "ok", "resp": "<ctl ret='ok'/>"}
+
+    bumper.mqtt_helperbot.send_command = send_command
+    bumper.bot_command_concurrency = 1
+    bumper.bot_command_queue_depth = 1
+
+    def command():
+        return {"toId": "did_1234", "cmdName": "Clean", "payloadType": "x", "payload": "<ctl/>"}
+
+    first = asyncio.ensure_future(bot_commands.send(command(), "req_1"))
+    second = asyncio.ensure_future(bot_commands.send(command(), "req_2"))
+    await asyncio.sleep(0.01)
+    assert bot_commands.status()["queues"]["did_1234"]["inflight"] == 1
+    assert bot_commands.status()["queues"]["did_1234"]["queued"] == 1
+
+    # Full queue is rejected straight away
+    resp = await bot_commands.send(command(), "req_3")
+    assert resp == {
+        "id": "req_3",
+        "errno": 503,
+        "ret": "fail",
+        "debug": "bot busy, command queue full",
+    }
+
+    release.set()
+    assert (await first)["ret"] == "ok"
+    assert (await second)["ret"] == "ok"  # Test queued command sent afterwards
+    assert bot_commands.status()["queues"]["did_1234"] == {
+        "inflight": 0,
+        "queued": 0,
+        "max_queued": 1,
+        "sent": 2,
+        "rejected": 1,
+    }
+
+    # Waiting too long in the queue
+    release.clear()
+    bumper.bot_command_queue_timeout_seconds = 0.05
+    first = asyncio.ensure_future(bot_commands.send(command(), "req_4"))
+    await asyncio.sleep(0.01)
+    resp = await bot_commands.send(command(), "req_5")
+    assert resp["debug"] == "bot busy, timed out waiting in command queue"
+    release.set()
+    await first
+    assert bot_commands.status()["queues"]["did_1234"]["inflight"] == 0
+
+
+async def test_helperbot_adaptive_timeout():
+    latency = bumper.MQTTHelperBot.latency
+    latency.reset()
+    mqtt_helperbot = bumper.MQTTHelperBot("127.0.0.1")
+    cmdjson = {"toId": "did_1234", "toType": "ls1ok3", "cmdName": "GetBatteryInfo"}
+    assert mqtt_helperbot.response_timeout(cmdjson) == 10  # Test default until known
+
+    for i in range(latency.min_samples):
+        latency.observe(cmdjson, 0.2)
+    assert mqtt_helperbot.response_timeout(cmdjson) == 1  # Test 2 * 0.25 raised to floor
+    other = dict(cmdjson, cmdName="GetCleanLogs")
+    assert mqtt_helperbot.response_timeout(other) == 1  # Test did's latency used
+
+    slow = dict(cmdjson, toId="did_5678", cmdName="GetCleanLogs")
+    for i in range(latency.min_samples):
+        latency.observe(slow, 3, timedout=i % 2 == 0)
+    assert mqtt_helperbot.response_timeout(slow) == 10  # Test 2 * 5 capped at ceiling
+
+    # Timeouts are observed at the timeout applied, cancellations not at all
+    async def timed_out(requestid, timeout):
+        return mqtt_helperbot._timeout(requestid)
+
+    async def cancelled(requestid, timeout):
+        raise asyncio.CancelledError()
+
+    unknown = {"toId": "did_9", "toType": "126", "cmdName": "GetCleanState"}
+    mqtt_helperbot.wait_for_resp = timed_out
+    await mqtt_helperbot._wait_command(unknown, "req_timeout", time.perf_counter())
+    assert latency.commands[("126", "GetCleanState")].max == 10
+    assert latency.timeouts[("126", "GetCleanState")] == 1
+    mqtt_helperbot.wait_for_resp = cancelled
+    with pytest.raises(asyncio.CancelledError):
+        await mqtt_helperbot._wait_command(
+            dict(unknown, cmdName="GetStats"), "req_cancelled", time.perf_counter()
+        )
+    assert ("126", "GetStats") not in latency.commands
+
+    stats = latency.asdict()
+    assert stats["commands"]["ls1ok3/GetBatteryInfo"]["count"] == latency.min_samples
+    assert stats["commands"]["ls1ok3/GetBatteryInfo"]["timeout"] == 1
+    assert stats["commands"]["ls1ok3/GetCleanLogs"]["timeouts"] == latency.min_samples // 2
+    assert stats["bots"]["did_1234"]["count"] == latency.min_samples
+    latency.reset()
+
+
+async def test_bot_circuit_breaker(bot_commands):
+    answer = {"ok": False}
+    sent = []
+
+    async def send_command(cmdjson, requestid):
+        sent.append(requestid)
+        if answer.get("hang"):
+            await asyncio.sleep(10)
+        if answer["ok"]:
+            return {"id": requestid, "ret": "ok", "resp": "<ctl ret='ok'/>"}
+        return {
+            "id": requestid,
+            "errno": 500,
+            "ret": "fail",
+            "debug": "wait for response timed out",
+        }
+
+    bumper.mqtt_helperbot.send_command = send_command
+    command = {"toId": "did_1234", "cmdName": "Clean", "payloadType": "x", "payload": "<ctl/>"}
+
+    for i in range(bumper.bot_breaker_failures):
+        assert bot_commands.breaker_state("did_1234") == "closed"
+        await bot_commands.send(command, "req_{}".format(i))
+    assert bot_commands.breaker_state("did_1234") == "open"  # Test opened by timeouts
+
+    resp = await bot_commands.send(command, "req_fast")
+    assert resp == {
+        "id": "req_fast",
+        "errno": 503,
+        "ret": "fail",
+        "debug": "bot unreachable, circuit open",
+    }
+    assert "req_fast" not in sent  # Test failed fast
+    assert bot_commands.status()["failed_fast"] == 1
+
+    # Bot reconnects, it's closed and concurrent commands all go through
+    bot_commands.bot_connected("did_1234")
+    assert bot_commands.breaker_state("did_1234") == "closed"
+    answer["ok"] = True
+    resps = await asyncio.gather(
+        *[bot_commands.send(command, "req_reconnect_{}".format(i)) for i in range(3)]
+    )
+    assert [resp["ret"] for resp in resps] == ["ok", "ok", "ok"]
+    assert bot_commands.status()["failed_fast"] == 1
+
+    # A failed probe opens it again
+    bot_commands.bot_disconnected("did_1234")
+    assert bot_commands.breaker_state("did_1234") == "open"
+    bumper.bot_breaker_cooldown_seconds = 0  # Cooldown over
+    answer["ok"] = False
+    await bot_commands.send(command, "req_probe_2")
+    assert sent[-1] == "req_probe_2"
+    assert bot_commands.status()["breakers"]["did_1234"]["state"] == "open"
+
+    # A cancelled probe lets the next command probe instead
+    answer["hang"] = True
+    probe = asyncio.ensure_future(bot_commands.send(command, "req_cancelled"))
+    await asyncio.sleep(0.01)
+    probe.cancel()
+    await asyncio.sleep(0.01)
+    answer["hang"] = False
+    answer["ok"] = True
+    assert (await bot_commands.send(command, "req_probe_3"))["ret"] == "ok"
+    assert bot_commands.breaker_state("did_1234") == "closed"
+
+
+async def test_bot_command_lanes(bot_commands):
+    release = asyncio.Event()
+    sent = []
+
+    async def send_command(cmdjson, requestid):
+        sent.append(requestid)
+        await release.wait()
+        return {"id": requestid, "ret": "ok", "resp": "<ctl ret='ok'/>"}
+
+    bumper.mqtt_helperbot.send_command = send_command
+
+    def command(cmdname):
+        return {"toId": "did_1234", "cmdName": cmdname, "payloadType": "x", "payload": "<ctl/>"}
+
+    assert bot_commands.lane(command("GetCleanLogs")) == "background"
+    assert bot_commands.lane(command("GetBatteryInfo")) == "interactive"  # App status query
+    assert bot_commands.lane(command("Charge")) == "interactive"
+    assert bot_commands.lane(command("SetTime")) == "interactive"
+
+    # With 2 slots, log pulls only get one
+    logs = [
+        asyncio.ensure_future(bot_commands.send(command("GetCleanLogs"), "logs_{}".format(i)))
+        for i in range(2)
+    ]
+    await asyncio.sleep(0.01)
+    assert sent == ["logs_0"]
+    stop = asyncio.ensure_future(bot_commands.send(command("Charge"), "charge"))
+    await asyncio.sleep(0.01)
+    assert sent == ["logs_0", "charge"]  # Test interactive not behind the queued pull
+
+    release.set()
+    await asyncio.gather(stop, *logs)
+    assert sent == ["logs_0", "charge", "logs_1"]
+    lanes = bot_commands.status()["lanes"]
+    assert lanes["interactive"]["latency"]["count"] == 1
+    assert lanes["background"]["latency"]["count"] == 2
+    assert lanes["background"]["queue_wait"]["max"] > lanes["interactive"]["queue_wait"]["max"]
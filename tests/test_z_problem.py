@@ -42,6 +42,24 @@ def test_argparse(mock_start):
     assert mock_start.called == True
 
 
+@patch("bumper.start")
+def test_argparse_import_export(mock_start, tmpdir):
+    bumper.db_close()
+    if os.path.exists("tests/tmp.db"):
+        os.remove("tests/tmp.db")  # Remove existing db
+
+    bumper.db = "tests/tmp.db"  # Set db location for testing
+    records = tmpdir.join("import.ndjson")
+    records.write(json.dumps({"type": "bot", "did": "did_1234", "name": "sn_1234"}) + "\n")
+    bumper.main(["import", str(records)])
+    assert bumper.bot_get("did_1234")["name"] == "sn_1234"
+
+    export = tmpdir.join("export.ndjson")
+    bumper.main(["export", str(export)])
+    assert json.loads(export.read())["did"] == "did_1234"
+    assert mock_start.called == False  # Test server not started
+
+
 @patch("subprocess.run")
 @patch("platform.system")
 @patch("platform.machine")